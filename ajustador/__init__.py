@@ -1,8 +1,11 @@
+from . import cache
 from . import compat
 from . import detect
+from . import executors
 from . import features
 from . import fitnesses
 from . import loader
 from . import optimize
+from . import tracestore
 from . import utilities
 from . import vartype
@@ -18,6 +18,19 @@ in parallel, where each one should be run out-of-process::
       -i=-5.0000000000000034e-11 \\
       --save-vm=ivdata--5.0000000000000034e-11.npy
 
+Several injection currents can be simulated with a single model build
+by passing a comma separated list. In that case --save-vm must contain
+a '{}' placeholder which is replaced by each current in turn::
+
+  $ python3 -m ajustador.basic_simulation ... \\
+      --injection-currents=-5e-10,-2e-10,3.6e-10 \\
+      --save-vm=ivdata-{}.npy
+
+With --trace-store the traces are appended to a shared
+:class:`ajustador.tracestore.TraceStore` instead, under the name of the
+current directory (or --trace-key), with --junction-potential
+subtracted.
+
 This module is not automatically imported as a child of ajustador.
 An explicit import is needed:
 >>> import ajustador.basic_simulation
@@ -66,6 +79,7 @@ from moose_nerp.prototypes import print_params
 from ajustador.regulate_chan_kinetics import chan_setting
 from ajustador.regulate_chan_kinetics import scale_voltage_dependents_tau_muliplier
 from ajustador.regulate_chan_kinetics import offset_voltage_dependents_vshift
+from ajustador import tracestore
 from ajustador.helpers.loggingsystem import getlogger
 
 import logging
@@ -80,6 +94,10 @@ def real(s):
         raise ValueError
     return f
 
+def currents_list(s):
+    "Splits '-5e-10,3.6e-10' → [-5e-10, 3.6e-10]"
+    return [real(part) for part in s.split(',')]
+
 def cond_setting(s):
     "Splits 'NaF,0=123.4' → ('NaF', 0, 123.4)"
     lhs, rhs = s.split('=', 1)
@@ -115,6 +133,13 @@ def option_parser():
 
     p.add_argument('--cond', default=[], nargs='+', type=cond_setting, action=standard_options.AppendFlat)
     p.add_argument('--save-vm')
+    p.add_argument('--trace-store',
+                   help='append the traces to this TraceStore instead of using --save-vm')
+    p.add_argument('--trace-key',
+                   help='key of the traces in --trace-store (default: name of current directory)')
+    p.add_argument('--junction-potential', type=real, default=0,
+                   help='subtracted from the traces written to --trace-store')
+    p.add_argument('--injection-currents', type=currents_list)
     p.add_argument('--chan', default=[], nargs='+', type=chan_setting, action=standard_options.AppendFlat)
     p.add_argument('--CaPoolTauDend', type=real)
     p.add_argument('--CaPoolTauSoma', type=real)
@@ -332,22 +357,96 @@ def run_simulation(injection_current, simtime, param_sim, model):
             reset_baseline(param_sim.neuron_type, param_sim.baseline, Cond_Kir)
     moose.start(simtime)
 
-def main(args):
-    global param_sim, pulse_gen
-    param_sim = option_parser().parse_args(args)
-    model = importlib.import_module('moose_nerp.' + param_sim.model)
+# Elements which MOOSE creates itself and which must survive reset_moose().
+_MOOSE_SYSTEM_ELEMENTS = ('Msgs', 'clock', 'classes', 'postmaster')
+
+def reset_moose():
+    """Delete all elements created by a previous simulation in this process
+
+    MOOSE keeps its object tree for the lifetime of the interpreter, so a
+    long-lived worker has to remove the old neuron, tables and pulse
+    generator before the next model is built.
+    """
+    for child in moose.element('/').children:
+        elem = moose.element(child)
+        if elem.name not in _MOOSE_SYSTEM_ELEMENTS:
+            moose.delete(elem)
+
+def load_model(param_sim, fresh=False):
+    """Import the moose_nerp model named by param_sim.model
+
+    setup() modifies the model module in place (conductances, channel
+    kinetics, morphology file). With fresh=True the model package and
+    its submodules are dropped from sys.modules and imported again, so
+    that overrides from a previous simulation in the same process do not
+    leak into the next one. moose and moose_nerp.prototypes stay loaded.
+    """
+    name = 'moose_nerp.' + param_sim.model
+    if fresh:
+        for mod in [m for m in sys.modules if m == name or m.startswith(name + '.')]:
+            del sys.modules[mod]
+    model = importlib.import_module(name)
     model.param_cond.neurontypes=util.neurontypes(model.param_cond,[param_sim.neuron_type])
-    logger.debug("param_sim::::::::: {}".format(param_sim))
-    pulse_gen, hdf5writer = setup(param_sim, model)
-    run_simulation(param_sim.injection_current[0], param_sim.simtime, param_sim, model)
-    #hdf5writer.close()
-
-    if param_sim.plot_vm:
-        neuron_graph.graphs(model,model.vmtab, param_sim.plot_current, param_sim.simtime, compartments=[0])
-        util.block_if_noninteractive()
-    if param_sim.save_vm:
+    return model
+
+# Options which only say what to run and where to save the results,
+# the others describe the model.
+_RUN_OPTIONS = ('injection_current', 'injection_currents',
+                'save_vm', 'trace_store', 'trace_key', 'junction_potential')
+
+# (options, model, pulse generator) of the model built by the last
+# persistent call of main in this process
+_persistent_model = None
+
+def _model_options(param_sim):
+    return sorted((name, repr(value)) for name, value in vars(param_sim).items()
+                  if name not in _RUN_OPTIONS)
+
+def main(args, persistent=False):
+    """Build the model described by args, run it and save the results
+
+    With persistent=True the call is assumed to happen in a long-lived
+    process (see optimize.execute_persistent). If the previous call
+    built a model with the same options, only the currents differ and
+    that model is run again, moose.reinit() resets its state like
+    between the currents of --injection-currents. Otherwise the MOOSE
+    tree and the model module are reset first. Either way the outcome
+    is the same as in a fresh ``python -m ajustador.basic_simulation``
+    process.
+    """
+    global param_sim, pulse_gen, _persistent_model
+    parser = option_parser()
+    param_sim = parser.parse_args(args)
+    currents = param_sim.injection_currents or param_sim.injection_current[:1]
+    if len(currents) > 1 and param_sim.save_vm and '{}' not in param_sim.save_vm:
+        parser.error('--save-vm needs a {} placeholder with multiple --injection-currents')
+    options = _model_options(param_sim)
+    if persistent and _persistent_model is not None and _persistent_model[0] == options:
+        _, model, pulse_gen = _persistent_model
+    else:
+        if persistent:
+            _persistent_model = None
+            reset_moose()
+        model = load_model(param_sim, fresh=persistent)
+        logger.debug("param_sim::::::::: {}".format(param_sim))
+        pulse_gen, hdf5writer = setup(param_sim, model)
+        if persistent:
+            _persistent_model = options, model, pulse_gen
+    # The model is built once, only the pulse amplitude differs between runs.
+    for current in currents:
+        run_simulation(current, param_sim.simtime, param_sim, model)
+        #hdf5writer.close()
+
+        if param_sim.plot_vm:
+            neuron_graph.graphs(model,model.vmtab, param_sim.plot_current, param_sim.simtime, compartments=[0])
+            util.block_if_noninteractive()
         elemname = '/data/Vm{}_c0'.format(param_sim.neuron_type)
-        np.save(param_sim.save_vm, moose.element(elemname).vector)
+        if param_sim.trace_store:
+            key = param_sim.trace_key or os.path.basename(os.getcwd())
+            vm = moose.element(elemname).vector - param_sim.junction_potential
+            tracestore.open_store(param_sim.trace_store).append(key, current, vm)
+        elif param_sim.save_vm:
+            np.save(param_sim.save_vm.format(current), moose.element(elemname).vector)
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,165 @@
+"""A persistent store of simulated traces and their fitness
+
+Evaluations are keyed by a hash of everything which determines the
+simulation result: the full (unscaled) parameter set, the model, the
+neuron type, the simulation time and the injection protocol. The store
+is an SQLite database, so it survives restarts and can be shared by all
+fits of the same model to the same measurement:
+
+>>> fit = aju.optimize.Fit(..., cache='d1-042811.sqlite')
+
+Traces are always reused. Fitness values are stored per fitness
+function signature and measurement (see :func:`fitness_signature`), so a
+refit with different weights or to other recordings reuses the
+simulations but recomputes the fitness.
+"""
+
+import hashlib
+import io
+import numbers
+import pickle
+import sqlite3
+import time
+
+import numpy as np
+
+from . import loader
+from ajustador.helpers.loggingsystem import getlogger
+logger = getlogger(__name__)
+
+def measurement_digest(measurement):
+    "The dirname of measurement and a hash of its traces and injections"
+    digest = hashlib.sha1()
+    for wave in measurement.waves:
+        digest.update(np.float64(wave.injection).tobytes())
+        digest.update(np.ascontiguousarray(wave.wave.x, dtype=float).tobytes())
+        digest.update(np.ascontiguousarray(wave.wave.y, dtype=float).tobytes())
+    return '{}:{}'.format(getattr(measurement, 'dirname', None), digest.hexdigest())
+
+def fitness_signature(func, measurement=None):
+    """A string which changes when the fitness function or its weights change
+
+    If measurement is given, its :func:`measurement_digest` is included,
+    so that fitness values against different recordings are kept apart.
+    """
+    pairs = getattr(func, 'pairs', None)
+    if pairs is not None:
+        text = '{}({}; error={})'.format(
+            func.__class__.__name__,
+            ', '.join('{}={!r}'.format(f.__name__, w) for w, f in pairs),
+            getattr(func, 'error', None))
+    else:
+        text = '{}.{}'.format(func.__module__, func.__name__)
+    if measurement is not None:
+        text += ' @ ' + measurement_digest(measurement)
+    return text
+
+def _normalized(value):
+    "Plain python floats and ints for numpy scalars, so that repr is stable"
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, (tuple, list, np.ndarray)):
+        return tuple(_normalized(v) for v in value)
+    return value
+
+class StoredSimulation(loader.Attributable):
+    "A simulation result restored from an :class:`EvaluationCache`"
+    def __init__(self, key, params, waves, features):
+        super().__init__(features)
+        self.name = key[:12]
+        self.key = key
+        self.params = params
+        self.features = features
+        self.waves = waves
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, self.name)
+
+    def wait(self):
+        pass
+
+    def ready(self):
+        return True
+
+class EvaluationCache:
+    """Content-addressed storage of traces and fitness values in SQLite
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = sqlite3.connect(filename)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS traces
+                                (key TEXT PRIMARY KEY, params BLOB, simtime REAL,
+                                 traces BLOB, created REAL)''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS fitness
+                                (key TEXT, signature TEXT, value BLOB,
+                                 PRIMARY KEY (key, signature))''')
+
+    @staticmethod
+    def key(params, **context):
+        """Hash of params (a ParamSet or a name→value mapping) and context
+
+        Values are hashed through their repr, so floats are compared
+        exactly. Numpy scalars are converted to python numbers first, so
+        ``np.float64(x)`` and ``float(x)`` give the same key.
+        """
+        items = params.items() if hasattr(params, 'items') else params
+        values = sorted((name, _normalized(getattr(value, 'value', value)))
+                        for name, value in items)
+        context = sorted((name, _normalized(value)) for name, value in context.items())
+        text = repr((values, context))
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def __contains__(self, key):
+        cur = self._db.execute('SELECT 1 FROM traces WHERE key=?', (key,))
+        return cur.fetchone() is not None
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM traces').fetchone()[0]
+
+    def store(self, key, sim, simtime):
+        "Save the traces of sim (which must be finished) under key"
+        injection = np.array([wave.injection for wave in sim.waves])
+        ys = {'y{}'.format(i): wave.wave.y for i, wave in enumerate(sim.waves)}
+        buf = io.BytesIO()
+        np.savez_compressed(buf, injection=injection, **ys)
+        params = pickle.dumps(dict(sim.params))
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO traces VALUES (?, ?, ?, ?, ?)',
+                             (key, params, float(simtime), buf.getvalue(), time.time()))
+
+    def load(self, key, params, features):
+        "Return a StoredSimulation for key, or None if it was never stored"
+        row = self._db.execute('SELECT simtime, traces FROM traces WHERE key=?',
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        simtime, blob = row
+        data = np.load(io.BytesIO(blob))
+        waves = []
+        for i, injection in enumerate(data['injection']):
+            y = data['y{}'.format(i)]
+            waves.append(loader.IVCurve(None, None,
+                                        injection=float(injection),
+                                        x=loader.Timebase(0, simtime, y.size), y=y,
+                                        features=features))
+        logger.debug('restored {} traces for {}'.format(len(waves), key))
+        return StoredSimulation(key, params, np.array(waves, dtype=object), features)
+
+    def store_fitness(self, key, signature, value):
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO fitness VALUES (?, ?, ?)',
+                             (key, signature, pickle.dumps(value)))
+
+    def fitness(self, key, signature):
+        "Return the stored fitness value, or None"
+        row = self._db.execute('SELECT value FROM fitness WHERE key=? AND signature=?',
+                               (key, signature)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def close(self):
+        self._db.close()
@@ -1,3 +1,16 @@
+"""Peak detection with hysteresis
+
+A peak is reported when the signal falls from its running maximum by
+more than P_high of the current low-to-high swing. The search then
+waits until the signal rises again by more than P_low of the swing
+before looking for the next peak.
+
+:func:`detect_peaks` works on a whole trace, :class:`PeakDetector` on a
+trace delivered in chunks. Both scan the samples in NumPy blocks instead
+of one at a time and give the same indices as the sample-by-sample
+:func:`detect_peaks_loop`.
+"""
+
 import functools
 import numpy as np
 
@@ -9,7 +22,8 @@ def arrayize(type):
     return decorator
 
 @arrayize(int)
-def detect_peaks(y, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False):
+def detect_peaks_loop(y, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False):
+    "The reference implementation of detect_peaks, one sample at a time"
     low_i, low = 0, y[0]
     high_i, high = 0, y[0]
 
@@ -43,3 +57,120 @@ def detect_peaks(y, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False):
         if both:
             yield low_i
         high_i, high = i, y[i]
+
+def _scan(y, start, low_i, low, high_i, high, P, rising, block=32):
+    """Find the first i >= start where the swing condition holds
+
+    Running extremes are computed with accumulate over blocks which
+    double in size, so a long quiet stretch costs O(length) overall.
+    Returns (i, low_i, low, high_i, high), with i None if the end of y
+    was reached first; the extremes then cover all of y[start:].
+
+    The comparisons use the same types as the loop: the swing is
+    computed in the dtype of y, then multiplied by P as a Python float.
+    """
+    n = len(y)
+    while start < n:
+        end = min(start + block, n)
+        seg = y[start:end]
+        lows = np.minimum(np.minimum.accumulate(seg), low)
+        highs = np.maximum(np.maximum.accumulate(seg), high)
+        limit = (highs - lows).astype(float) * P
+        rise = seg - lows
+        cond = rise > limit if rising else rise < limit
+        hit = cond.argmax()
+        stop = hit + 1 if cond[hit] else seg.size
+
+        j = seg[:stop].argmin()
+        if seg[j] < low:
+            low_i, low = start + j, seg[j]
+        j = seg[:stop].argmax()
+        if seg[j] > high:
+            high_i, high = start + j, seg[j]
+
+        if cond[hit]:
+            return start + hit, low_i, low, high_i, high
+        start = end
+        block *= 2
+    return None, low_i, low, high_i, high
+
+class PeakDetector:
+    """Detect peaks in a signal which arrives in chunks
+
+    >>> detector = PeakDetector(threshold=0, P_low=0.75, P_high=0.50)
+    >>> peaks = np.concatenate([detector.feed(chunk) for chunk in chunks])
+
+    :meth:`feed` returns the indices (counted from the start of the
+    signal) of the peaks which were completed in the chunk. The search
+    starts at the first sample above threshold, or immediately if
+    threshold is None. Unlike :func:`detect_peaks`, which can look at
+    the whole trace, the threshold must be given up front. Otherwise the
+    results are the same as for the concatenated signal.
+
+    If the beginning of the signal is skipped, start is the index of the
+    first sample which will be fed, and initial the value of sample 0,
+    which the low and high start from.
+    """
+    def __init__(self, threshold=None, P_low=0.5, P_high=0.5, both=False,
+                 start=0, initial=None):
+        self.threshold = threshold
+        self.P_low = P_low
+        self.P_high = P_high
+        self.both = both
+
+        self._n = start         # samples seen so far
+        self._started = threshold is None
+        self._rising = False
+        self._low_i = self._high_i = 0
+        self._low = self._high = initial
+
+    def feed(self, chunk):
+        chunk = np.asarray(chunk)
+        if self._low is None and chunk.size:
+            self._low = self._high = chunk[0]
+            self._low_i = self._high_i = self._n
+
+        peaks = []
+        i = 0
+        if not self._started:
+            above = chunk > self.threshold
+            i = above.argmax() if chunk.size else 0
+            self._started = chunk.size > 0 and above[i]
+        if self._started:
+            while True:
+                P = self.P_low if self._rising else self.P_high
+                i, low_i, low, high_i, high = _scan(chunk, i,
+                                                    self._low_i - self._n, self._low,
+                                                    self._high_i - self._n, self._high,
+                                                    P, self._rising)
+                self._low_i, self._low = low_i + self._n, low
+                self._high_i, self._high = high_i + self._n, high
+                if i is None:
+                    break
+                if self._rising:
+                    if self.both:
+                        peaks.append(self._low_i)
+                    self._high_i, self._high = i + self._n, chunk[i]
+                else:
+                    peaks.append(self._high_i)
+                    self._low_i, self._low = i + self._n, chunk[i]
+                self._rising = not self._rising
+
+        self._n += chunk.size
+        return np.array(peaks, dtype=int)
+
+def detect_peaks(y, min_high_ratio=0.25, P_low=0.5, P_high=0.5, both=False):
+    """Return the indices of peaks in y (and of the troughs if both)
+
+    The search starts at the first sample above min_high_ratio times
+    the maximum of y (or at the beginning if there is none).
+    """
+    y = np.asarray(y)
+    if np.isnan(y).any():
+        # nan compares false in the loop, which accumulate cannot mimic
+        return detect_peaks_loop(y, min_high_ratio, P_low, P_high, both)
+
+    start = (y > y.max() * min_high_ratio).argmax()
+    detector = PeakDetector(P_low=P_low, P_high=P_high, both=both,
+                            start=start, initial=y[0])
+    return detector.feed(y[start:])
@@ -255,7 +255,7 @@ def plot_param_space(group, measurement=None, *what, **options):
     if age:
         fitness = np.arange(1, len(values)+1)
     else:
-        fitness = [fitness_func(item, measurement) for item in group]
+        fitness = fitnesses.group_fitness(group, measurement, fitness_func)
 
     f = _get_graph('param space')
     f.canvas.manager.set_window_title('3-param view for {}'.format(fitness_func.__name__))
@@ -304,10 +304,9 @@ def plot_history(groups, measurement=None, *,
     for i, group in enumerate(groups):
         func = fitness or group.fitness_func
         
-        fitnesses = [func(item, measurement) for item in group]
-        fitnesses = pd.DataFrame(fitnesses)
+        values = pd.DataFrame(fitnesses.group_fitness(group, measurement, func))
         if show_quit:
-            quit = fitnesses.fit_finished(fitnesses)
+            quit = fitnesses.fit_finished(values)
 
         color = colors[i % len(colors)]
         marker = markers[i % len(markers)]
@@ -315,10 +314,10 @@ def plot_history(groups, measurement=None, *,
         label = (labels[i] if labels is not None else
                  '{} {}'.format(group.name, func.__name__))
         if show_quit:
-            ax.plot(fitnesses[-quit], color + marker, label=label, picker=5)
-            ax.plot(fitnesses[quit], marker=marker, color='0.5', picker=5)
+            ax.plot(values[-quit], color + marker, label=label, picker=5)
+            ax.plot(values[quit], marker=marker, color='0.5', picker=5)
         else:
-            ax.plot(fitnesses, color + marker, label=label, picker=5)
+            ax.plot(values, color + marker, label=label, picker=5)
 
     if ymax is not None:
         ax.set_ylim(top=ymax)
@@ -380,7 +379,7 @@ def plot_param_view(group, measurement, *what, **options):
     fitness_func = options.get('fitness', fitnesses.combined_fitness)
 
     values = group.param_values(*what)
-    fitness = [fitness_func(item, measurement) for item in group]
+    fitness = fitnesses.group_fitness(group, measurement, fitness_func)
 
     f = _get_graph('param space')
     f.canvas.manager.set_window_title('2-param view for {}'.format(fitness_func.__name__))
@@ -0,0 +1,431 @@
+"""Backends which run the simulations of a fit
+
+All executors share the same small interface: :meth:`Executor.submit`
+and :meth:`Executor.map` return :class:`concurrent.futures.Future`
+objects, :meth:`Executor.wait` collects their results honouring the
+per-task timeout, :meth:`Executor.cancel` drops queued tasks and
+:meth:`Executor.shutdown` stops the workers.
+
+>>> from ajustador import executors, optimize
+>>> optimize.set_executor(executors.ProcessExecutor(workers=6, timeout=600))
+
+Available backends:
+
+* :class:`ProcessExecutor` — a local process pool (the default),
+* :class:`ThreadExecutor` — a thread pool, enough for
+  :func:`ajustador.optimize.execute`, which runs every simulation in a
+  subprocess,
+* :class:`FarmExecutor` — a worker farm built on
+  :mod:`multiprocessing.managers`, to which workers on other hosts can
+  connect (``python -m ajustador.executors HOST:PORT AUTHKEY``),
+* :class:`SerialExecutor` — runs everything in the calling process,
+  for debugging.
+"""
+
+import concurrent.futures
+import itertools
+import multiprocessing
+import multiprocessing.managers
+import os
+import queue
+import threading
+import time
+import traceback
+
+from ajustador.helpers.loggingsystem import getlogger
+logger = getlogger(__name__)
+
+def wait(futures, timeout=None, poll_interval=0.1):
+    """Return the results of futures, in order
+
+    timeout is counted separately for each task, from the time it
+    started in its worker. The executors in this module record that
+    time in future.started. For other futures, the time the future was
+    first seen running is used instead, which for a process pool
+    includes the time spent in its call queue.
+
+    When a task exceeds the timeout, all unfinished futures are
+    cancelled and :class:`concurrent.futures.TimeoutError` is raised.
+    Tasks which are already running cannot be interrupted. They are
+    marked with future.abandoned, so that :meth:`Executor.shutdown`
+    does not wait for them.
+    """
+    if timeout is None:
+        return [f.result() for f in futures]
+
+    seen = {}
+    pending = set(futures)
+    while pending:
+        done, pending = concurrent.futures.wait(pending, timeout=poll_interval)
+        now = time.time()
+        for f in pending:
+            started = getattr(f, 'started', None)
+            # futures of the pool executors get .started from the worker
+            if started is None and f.running() and not hasattr(f, 'task_id'):
+                started = seen.setdefault(f, now)
+            if started is not None and now - started > timeout:
+                for g in futures:
+                    if not g.cancel() and not g.done():
+                        g.abandoned = True
+                raise concurrent.futures.TimeoutError(
+                    'task did not finish in {} s'.format(timeout))
+    return [f.result() for f in futures]
+
+_worker_started = None
+
+def _init_worker(started):
+    global _worker_started
+    _worker_started = started
+
+class _Timed:
+    """func, which reports when it starts running in a worker
+
+    (task_id, time) is put into started, or into the queue given to
+    the worker process by _init_worker.
+    """
+    def __init__(self, func, task_id, started=None):
+        self.func = func
+        self.task_id = task_id
+        self.started = started
+
+    def __call__(self, arg):
+        started = self.started if self.started is not None else _worker_started
+        started.put((self.task_id, time.time()))
+        return self.func(arg)
+
+class Executor:
+    """Base class for the backends
+
+    workers is the number of tasks run in parallel (default: one per
+    CPU), queue_depth limits the number of submitted but unfinished
+    tasks (submit blocks when the limit is reached), and timeout is the
+    per-task limit used by :meth:`wait`.
+    """
+    def __init__(self, workers=None, *, queue_depth=None, timeout=None):
+        self.workers = workers if workers is not None else multiprocessing.cpu_count()
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self._slots = (threading.BoundedSemaphore(queue_depth)
+                       if queue_depth is not None else None)
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def _submit(self, func, arg):
+        raise NotImplementedError
+
+    def submit(self, func, arg):
+        "Schedule func(arg) and return a future"
+        if self._slots is not None:
+            self._slots.acquire()
+        future = self._submit(func, arg)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        if self._slots is not None:
+            self._slots.release()
+
+    def map(self, func, iterable):
+        "Submit func(arg) for every arg and return a list of futures"
+        return [self.submit(func, arg) for arg in iterable]
+
+    def wait(self, futures):
+        "Return the results of futures, see :func:`wait`"
+        return wait(futures, timeout=self.timeout)
+
+    def cancel(self):
+        "Cancel all tasks which have not started yet"
+        with self._lock:
+            futures = list(self._futures)
+        return sum(f.cancel() for f in futures)
+
+    def _abandoned(self):
+        "Whether tasks given up by :func:`wait` are still running"
+        with self._lock:
+            return any(getattr(f, 'abandoned', False) and not f.done()
+                       for f in self._futures)
+
+    def shutdown(self, wait=True, cancel=False):
+        if cancel:
+            self.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(cancel=exc[0] is not None)
+
+    def __repr__(self):
+        return '{}(workers={}, queue_depth={}, timeout={})'.format(
+            self.__class__.__name__, self.workers, self.queue_depth, self.timeout)
+
+class _PoolExecutor(Executor):
+    """Common code of the concurrent.futures based executors
+
+    Tasks report their start through the queue self._started, a
+    collector thread copies the times to future.started.
+    """
+    def __init__(self, workers=None, **kwargs):
+        super().__init__(workers, **kwargs)
+        self._pool = self._make_pool()
+        self._tasks = {}
+        self._ids = itertools.count()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def _make_pool(self):
+        raise NotImplementedError
+
+    def _submit(self, func, arg):
+        # the collector waits for the lock, so the task is registered
+        # before its start is looked up
+        with self._lock:
+            task_id = next(self._ids)
+            future = self._pool.submit(self._timed(func, task_id), arg)
+            future.task_id = task_id
+            self._tasks[task_id] = future
+        return future
+
+    def _timed(self, func, task_id):
+        return _Timed(func, task_id, self._started)
+
+    def _collect(self):
+        while True:
+            item = self._started.get()
+            if item is None:
+                break
+            task_id, started = item
+            with self._lock:
+                future = self._tasks.pop(task_id, None)
+            if future is not None:
+                future.started = started
+
+    def _task_done(self, future):
+        with self._lock:
+            self._tasks.pop(future.task_id, None)
+        super()._task_done(future)
+
+    def shutdown(self, wait=True, cancel=False):
+        super().shutdown(wait=wait, cancel=cancel)
+        if wait and self._abandoned():
+            self._kill()
+            wait = False
+        self._pool.shutdown(wait=wait, cancel_futures=not wait)
+        self._started.put(None)
+
+    def _kill(self):
+        "Stop the workers which might be running abandoned tasks"
+
+class ProcessExecutor(_PoolExecutor):
+    """Run tasks in a :class:`concurrent.futures.ProcessPoolExecutor`
+
+    At shutdown, worker processes still running tasks abandoned by
+    :meth:`wait` are terminated.
+    """
+    def _make_pool(self):
+        self._started = multiprocessing.Queue()
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                      initializer=_init_worker,
+                                                      initargs=(self._started,))
+
+    def _timed(self, func, task_id):
+        # the queue was given to the worker processes when they started
+        return _Timed(func, task_id)
+
+    def _kill(self):
+        for process in list(getattr(self._pool, '_processes', {}).values()):
+            process.terminate()
+
+class ThreadExecutor(_PoolExecutor):
+    """Run tasks in a :class:`concurrent.futures.ThreadPoolExecutor`
+
+    Only suitable for tasks which release the GIL or run a subprocess,
+    like :func:`ajustador.optimize.execute`. MOOSE itself is not thread
+    safe, and :func:`ajustador.optimize.execute_persistent` changes the
+    working directory of the process, so it cannot be used. Threads
+    cannot be killed: shutdown does not wait for abandoned tasks, but
+    the interpreter still does at exit.
+    """
+    def _make_pool(self):
+        self._started = queue.Queue()
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+class SerialExecutor(Executor):
+    """Run each task immediately in the calling process
+
+    Exceptions are stored in the future as usual, so that tracebacks
+    and pdb.post_mortem point at the failing code.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(1, **kwargs)
+
+    def _submit(self, func, arg):
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(func(arg))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+_farm_tasks = queue.Queue()
+_farm_results = queue.Queue()
+_farm_cancelled = {}
+
+def _get_farm_tasks():
+    return _farm_tasks
+
+def _get_farm_results():
+    return _farm_results
+
+def _get_farm_cancelled():
+    return _farm_cancelled
+
+class _FarmManager(multiprocessing.managers.BaseManager):
+    pass
+
+_FarmManager.register('tasks', callable=_get_farm_tasks)
+_FarmManager.register('results', callable=_get_farm_results)
+_FarmManager.register('cancelled', callable=_get_farm_cancelled,
+                      proxytype=multiprocessing.managers.DictProxy)
+
+class FarmTaskError(Exception):
+    "An exception raised by a task in a farm worker, with the remote traceback"
+
+def farm_worker(address, authkey):
+    """Connect to the farm at address and run tasks until told to stop
+
+    This is what ``python -m ajustador.executors HOST:PORT AUTHKEY``
+    runs. The functions and arguments of the tasks must be importable
+    on the worker host.
+    """
+    manager = _FarmManager(address=address, authkey=authkey)
+    manager.connect()
+    tasks, results, cancelled = manager.tasks(), manager.results(), manager.cancelled()
+    results.put((None, 'joined', os.getpid()))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, func, arg = task
+        if cancelled.pop(task_id, False):
+            continue
+        results.put((task_id, 'started', None))
+        try:
+            results.put((task_id, 'done', func(arg)))
+        except Exception:
+            results.put((task_id, 'failed', traceback.format_exc()))
+
+class FarmExecutor(Executor):
+    """Run tasks on a farm of worker processes, possibly on other hosts
+
+    A manager process holding a task queue and a result queue is started
+    at address (by default on a random local port). workers local
+    worker processes are started; more can join from other machines
+    with ``python -m ajustador.executors HOST:PORT AUTHKEY``, using
+    :attr:`address` and authkey. Every worker which joined is sent a
+    stop signal at shutdown.
+
+    Cancelling a future which has not started tells the farm to skip
+    its task. A worker which took the task just before that still runs
+    it, and running tasks are not stopped. Only the local worker
+    processes are terminated at shutdown if tasks were abandoned.
+    """
+    def __init__(self, workers=None, *, address=('127.0.0.1', 0), authkey=b'ajustador', **kwargs):
+        super().__init__(workers, **kwargs)
+        self.authkey = authkey
+        self._manager = _FarmManager(address=address, authkey=authkey)
+        self._manager.start()
+        self._tasks = self._manager.tasks()
+        self._results = self._manager.results()
+        self._cancelled = self._manager.cancelled()
+        # task_id → future, guarded by self._lock like _PoolExecutor._tasks
+        self._pending = {}
+        self._ids = itertools.count()
+        self._joined = 0
+
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        self._processes = [multiprocessing.Process(target=farm_worker,
+                                                   args=(self.address, authkey),
+                                                   daemon=True)
+                           for _ in range(self.workers)]
+        for process in self._processes:
+            process.start()
+
+    @property
+    def address(self):
+        return self._manager.address
+
+    def _submit(self, func, arg):
+        future = concurrent.futures.Future()
+        with self._lock:
+            task_id = next(self._ids)
+            future.task_id = task_id
+            self._pending[task_id] = future
+        self._tasks.put((task_id, func, arg))
+        return future
+
+    def _task_done(self, future):
+        with self._lock:
+            pending = self._pending.pop(future.task_id, None)
+        if pending is not None and future.cancelled():
+            # still queued in the farm, let the workers skip it
+            self._cancelled[future.task_id] = True
+        super()._task_done(future)
+
+    def _collect(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                break
+            task_id, state, value = item
+            if state == 'joined':
+                self._joined += 1
+                continue
+            with self._lock:
+                future = (self._pending.get(task_id) if state == 'started' else
+                          self._pending.pop(task_id, None))
+            if future is None:
+                if state == 'started':
+                    # cancelled after a worker took it
+                    self._cancelled.pop(task_id, None)
+                continue
+            if state == 'started':
+                future.started = time.time()
+                future.set_running_or_notify_cancel()
+                continue
+            if future.cancelled():
+                continue
+            if state == 'done':
+                future.set_result(value)
+            else:
+                future.set_exception(FarmTaskError(value))
+
+    def shutdown(self, wait=True, cancel=False):
+        super().shutdown(wait=wait, cancel=cancel)
+        # one stop signal for each worker, local or remote, which joined
+        for _ in range(max(self._joined, len(self._processes))):
+            self._tasks.put(None)
+        if wait and self._abandoned():
+            for process in self._processes:
+                process.terminate()
+        if wait:
+            for process in self._processes:
+                process.join()
+        self._results.put(None)
+        self._collector.join()
+        self._manager.shutdown()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a worker for FarmExecutor')
+    parser.add_argument('address', help='HOST:PORT of the farm manager')
+    parser.add_argument('authkey')
+    args = parser.parse_args()
+    host, port = args.address.rsplit(':', 1)
+    farm_worker((host, int(port)), args.authkey.encode())
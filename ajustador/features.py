@@ -5,7 +5,7 @@ import numpy as np
 from scipy import optimize
 
 from . import utilities, detect, vartype
-from .signal_smooth import smooth
+from .signal_smooth import smooth_range
 from ajustador.helpers.loggingsystem import getlogger
 import logging
 logger = getlogger(__name__)
@@ -40,6 +40,12 @@ class Feature:
     array_attributes = ()
     mean_attributes = ()
 
+    # Optionally a classmethod batch(features, x, Y), which computes the
+    # provided values for the features of many waves at once. x is the
+    # common time base and Y the stacked (n_waves, n_samples) voltages.
+    # It is called by Attributable before gathering an array attribute.
+    batch = None
+
     def __init__(self, obj):
         self._obj = obj
 
@@ -94,7 +100,7 @@ class Feature:
         prefix = '{} = '.format(name)
         if hasattr(val, 'report'):
             ans = val.report(prefix=prefix)
-        elif isinstance(val, np.ndarray) and hasattr(val, 'dev'):
+        elif isinstance(val, (np.ndarray, vartype.vararray)) and hasattr(val, 'dev'):
             ans = vartype.vartype.format_array(val, prefix=prefix)
         elif hasattr(val, '__len__'):
             joiner = '\n' + len(prefix)*' '
@@ -129,25 +135,27 @@ class SteadyState(Feature):
     array_attributes = ('baseline', 'steady', 'response',
                         'baseline_pre', 'baseline_post')
 
+    @property
+    @utilities.once
+    def _regions(self):
+        return _steady_regions(self._obj.wave.x,
+                               self._obj.baseline_before, self._obj.baseline_after,
+                               self._obj.steady_after, self._obj.steady_before)
+
     @property
     @utilities.once
     def baseline(self):
         """The mean voltage of the area outside of injection interval
 
         Returns mean value of wave after excluding "outliers", values
-        > 95th or < 5th percentile.
+        > 60th or < 40th percentile.
         """
-        wave = self._obj.wave
         before = self._obj.baseline_before
         after = self._obj.baseline_after
         if before is None and after is None:
             raise ValueError('cannot determine baseline')
-        region = ((wave.x < before if before is not None else False) |
-                  (wave.x > after if after is not None else False))
-        what = wave.y[region]
-        cutoffa, cutoffb = np.percentile(what, (40, 60))
-        cut = what[(what >= cutoffa) & (what <= cutoffb)]
-        return vartype.array_mean(cut)
+        y, regions = self._obj.wave.y, self._regions
+        return _trimmed_mean(np.concatenate((y[regions.pre], y[regions.post])), 40, 60)
 
     @property
     @utilities.once
@@ -155,17 +163,11 @@ class SteadyState(Feature):
         """The mean voltage of the area before the injection interval
 
         Returns mean value of wave after excluding "outliers", values
-        > 95th or < 5th percentile.
+        > 60th or < 40th percentile.
         """
-        wave = self._obj.wave
-        before = self._obj.baseline_before
-        if before is None:
+        if self._obj.baseline_before is None:
             return vartype.vartype.nan
-
-        what = wave.y[(wave.x < before)]
-        cutoffa, cutoffb = np.percentile(what, (40, 60))
-        cut = what[(what >= cutoffa) & (what <= cutoffb)]
-        return vartype.array_mean(cut)
+        return _trimmed_mean(self._obj.wave.y[self._regions.pre], 40, 60)
 
     @property
     @utilities.once
@@ -173,17 +175,11 @@ class SteadyState(Feature):
         """The mean voltage of the area after the injection interval
 
         Returns mean value of wave after excluding "outliers", values
-        > 95th or < 5th percentile.
+        > 60th or < 40th percentile.
         """
-        wave = self._obj.wave
-        after = self._obj.baseline_after
-        if after is None:
+        if self._obj.baseline_after is None:
             return vartype.vartype.nan
-
-        what = wave.y[(wave.x > after)]
-        cutoffa, cutoffb = np.percentile(what, (40, 60))
-        cut = what[(what >= cutoffa) & (what <= cutoffb)]
-        return vartype.array_mean(cut)
+        return _trimmed_mean(self._obj.wave.y[self._regions.post], 40, 60)
 
     @property
     @utilities.once
@@ -193,21 +189,49 @@ class SteadyState(Feature):
         "Outliers", values > 80th percentile (which is a parameter), are excluded.
         80th percentile excludes the spikes.
         """
-        wave = self._obj.wave
-        after = self._obj.steady_after
-        before = self._obj.steady_before
-        cutoff = self._obj.steady_cutoff
-
-        data = wave.y[(wave.x > after) & (wave.x < before)]
-        cutoff = np.percentile(data, cutoff)
-        cut = data[data <= cutoff]
-        return vartype.array_mean(cut)
+        return _cut_mean(self._obj.wave.y[self._regions.steady], self._obj.steady_cutoff)
 
     @property
     @utilities.once
     def response(self):
         return self.steady - self.baseline
 
+    @classmethod
+    def batch(cls, features, x, Y):
+        """Compute the trimmed means of all rows of Y
+
+        Only done when all waves use the same region boundaries, so
+        the regions are located once for all rows.
+        """
+        names = ('baseline_before', 'baseline_after',
+                 'steady_after', 'steady_before', 'steady_cutoff')
+        params = [tuple(getattr(f._obj, name) for name in names) for f in features]
+        if any(p != params[0] for p in params[1:]):
+            return
+        before, after, steady_after, steady_before, cutoff = params[0]
+
+        def provide(name, compute, *args):
+            if all(hasattr(f, '_{}_value'.format(name)) for f in features):
+                return
+            if isinstance(Y, np.ndarray) and Y.ndim == 2:
+                values = compute(Y, *args)
+            else:
+                # ragged rows
+                values = [compute(row, *args) for row in Y]
+            for f, value in zip(features, values):
+                utilities.set_once(f, name, value)
+
+        regions = _steady_regions(x, before, after, steady_after, steady_before)
+        baseline = lambda rows, *args: _trimmed_mean(
+            np.concatenate((rows[..., regions.pre], rows[..., regions.post]), axis=-1), *args)
+        if before is not None or after is not None:
+            provide('baseline', baseline, 40, 60)
+        if before is not None:
+            provide('baseline_pre', lambda rows: _trimmed_mean(rows[..., regions.pre], 40, 60))
+        if after is not None:
+            provide('baseline_post', lambda rows: _trimmed_mean(rows[..., regions.post], 40, 60))
+        provide('steady', lambda rows: _cut_mean(rows[..., regions.steady], cutoff))
+
     def plot(self, figure=None, pre_post=False):
         wave = self._obj.wave
         before = self._obj.baseline_before
@@ -249,27 +273,160 @@ class SteadyState(Feature):
         ax.figure.tight_layout()
 
 
+steady_regions = namedtuple('steady_regions', 'pre post steady')
+
+def _steady_regions(x, before, after, steady_after, steady_before):
+    """Slices of x < before, x > after and steady_after < x < steady_before
+
+    x must be sorted. A boundary which is None gives an empty slice.
+    """
+    n = x.size
+    pre = slice(0, x.searchsorted(before, 'left') if before is not None else 0)
+    post = slice(x.searchsorted(after, 'right') if after is not None else n, n)
+    steady = slice(x.searchsorted(steady_after, 'right'),
+                   x.searchsorted(steady_before, 'left'))
+    return steady_regions(pre, post, steady)
+
+def _percentiles(data, q):
+    """np.percentile(data, q) of 1-d data, for a sequence of q
+
+    The default 'linear' method of numpy is followed step by step, so
+    the results are identical, but only the few order statistics which
+    are needed are found with a single np.partition. For 2-d data the
+    percentiles of each row are returned, one row per row of data.
+    """
+    n = data.shape[-1]
+    q = np.true_divide(np.atleast_1d(q), 100)
+    virtual = (n - 1) * q
+    prev = np.floor(virtual)
+    next = prev + 1
+    above = virtual >= n - 1
+    prev[above] = next[above] = -1
+    below = virtual < 0
+    prev[below] = next[below] = 0
+    prev, next = prev.astype(np.intp), next.astype(np.intp)
+    gamma = virtual - prev
+
+    kth = np.unique(np.concatenate(([0, -1], prev, next)))
+    part = np.partition(data, kth, axis=-1)
+    if data.ndim == 1 and np.isnan(part[-1]):
+        return np.full(q.shape, np.nan)
+    a, b = part[..., prev], part[..., next]
+    diff = b - a
+    ans = np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+    if data.ndim > 1:
+        ans[np.isnan(part[..., -1])] = np.nan
+    return ans
+
+def _row_means(data, mask):
+    """array_mean of the selected values in each row of data
+
+    The sums are taken in double precision over whole rows, with the
+    values which are not selected replaced by zero.
+    """
+    count = mask.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(mask, data, 0).sum(axis=1, dtype=float) / count
+        dev = np.where(mask, data - mean[:, None], 0)
+        var = (dev * dev).sum(axis=1) / (count - 1)
+    var[count < 2] = np.nan
+    return [vartype.vartype(m, v**0.5) for m, v in zip(mean, var)]
+
+def _trimmed_mean(data, low, high):
+    """array_mean of the values between the low and high percentile
+
+    For 2-d data, a list with the value for each row. 1-d data is
+    treated as a single row, so both give bitwise identical values.
+    """
+    rows = np.atleast_2d(data)
+    a, b = _percentiles(rows, (low, high)).T
+    ans = _row_means(rows, (rows >= a[:, None]) & (rows <= b[:, None]))
+    return ans if data.ndim > 1 else ans[0]
+
+def _cut_mean(data, cutoff):
+    """array_mean of the values up to the cutoff percentile
+
+    For 2-d data, a list with the value for each row, like _trimmed_mean.
+    """
+    rows = np.atleast_2d(data)
+    c, = _percentiles(rows, cutoff).T
+    ans = _row_means(rows, rows <= c[:, None])
+    return ans if data.ndim > 1 else ans[0]
+
 peak_and_threshold = namedtuple('peak_and_threshold', 'peaks thresholds')
 
 def _find_spikes(wave, min_height=0.0, max_charge_time=0.004, charge_threshold=0.02):
     peaks = detect.detect_peaks(wave.y, P_low=0.75, P_high=0.50)
     peaks = peaks[wave.y[peaks] > min_height]
-
-    thresholds = np.empty(peaks.size)
-    for i in range(len(peaks)):
-        start = (wave.x >= wave.x[peaks[i]] - max_charge_time).argmax()
-        x = wave.x[start:peaks[i] + 1]
-        y = wave.y[start:peaks[i] + 1]
-        yderiv = np.diff(y)
-        #spike threshold is point where derivative is 2% of steepest
-        try:
-            ythresh = charge_threshold * yderiv.max()
-            thresh = y[1:][yderiv > ythresh].min()
-            thresholds[i] = thresh
-        except Exception:
-            thresholds[i] = np.nan
+    thresholds = _spike_thresholds(wave, peaks, max_charge_time, charge_threshold)
     return peak_and_threshold(peaks, thresholds)
 
+def _spike_thresholds(wave, peaks, max_charge_time, charge_threshold):
+    """The threshold of each spike, for all peaks at once
+
+    The threshold is the lowest point in the max_charge_time before the
+    peak where the derivative is above charge_threshold of its maximum
+    in that window, or nan if there is no such point.
+
+    The windows are rows of a strided view of np.diff(wave.y), starting
+    at indices found with searchsorted in wave.x.
+    """
+    thresholds = np.full(peaks.size, np.nan)
+    if peaks.size == 0:
+        return thresholds
+    x, y = wave.x, wave.y
+    starts = x.searchsorted(x[peaks] - max_charge_time, side='left')
+    lengths = peaks - starts            # number of derivative points
+    width = max(lengths.max(), 1)
+
+    deriv = np.diff(y)
+    pad = np.full(width, np.nan, dtype=deriv.dtype)
+    deriv = np.lib.stride_tricks.sliding_window_view(np.concatenate((deriv, pad)), width)[starts]
+    after = np.lib.stride_tricks.sliding_window_view(np.concatenate((y[1:], pad)), width)[starts]
+    valid = np.arange(width) < lengths[:, None]
+
+    dmax = np.where(valid, deriv, -np.inf).max(axis=1)
+    # the scalar code compares yderiv with a float64 threshold in the dtype of y
+    ythresh = (charge_threshold * dmax.astype(float)).astype(deriv.dtype)
+    above = valid & (deriv > ythresh[:, None])
+    found = above.any(axis=1)
+    thresholds[found] = np.where(above, after, np.inf).min(axis=1)[found]
+    return thresholds
+
+def _advance(start, keep_going, step=1, width=8):
+    """For each i, the first j in start[i], start[i]+step, ... where keep_going is False
+
+    keep_going(rows, j) is called with row numbers of shape (k, 1) and
+    candidate indices of shape (k, width), and must return a boolean
+    array. It must be False before j runs out of the array, and cope
+    with j outside of it. The candidates are examined in blocks which
+    double in width, which is the array version of a while loop which
+    moves j by step.
+    """
+    result = np.array(start, dtype=int)
+    base = result.copy()
+    todo = np.arange(result.size)
+    while todo.size:
+        j = base[todo, None] + step * np.arange(width)
+        stop = ~keep_going(todo[:, None], j)
+        found = stop.any(axis=1)
+        result[todo[found]] = j[found, stop[found].argmax(axis=1)]
+        base[todo] += step * width
+        todo = todo[~found]
+        width *= 2
+    return result
+
+region_indices = namedtuple('region_indices', 'left_i right_i')
+
+def _region_edges(x, regions):
+    "The left and right x coordinates of WaveRegions given by region_indices"
+    left_i, right_i = regions
+    left = np.where(left_i > 0, (x[np.maximum(left_i - 1, 0)] + x[left_i]) / 2, x[0])
+    right = np.where(right_i + 1 < x.size,
+                     (x[right_i] + x[np.minimum(right_i + 1, x.size - 1)]) / 2,
+                     x[right_i])
+    return left, right
+
 class WaveRegion:
     def __init__(self, wave, left_i, right_i):
         self._wave = wave
@@ -330,7 +487,7 @@ class Spikes(Feature):
                 'spike_threshold','mean_spike_threshold',
                 'mean_isi', 'isi_spread',
                 'spike_latency',
-                'spike_bounds',
+                'spike_bounds_i', 'spike_bounds',
                 'spike_height', 'spike_width',
                 'mean_spike_height', # TODO: is it OK to have mean_spike_height as
                                      #       here and as an aggregated attribute?
@@ -347,6 +504,19 @@ class Spikes(Feature):
         "Indices of spike maximums in the wave.x, wave.y arrays"
         return _find_spikes(self._obj.wave)
 
+    @classmethod
+    def batch(cls, features, x, Y):
+        """Skip spike detection for all rows which never cross 0 V
+
+        _find_spikes only accepts peaks above min_height=0, so such
+        rows have no spikes. The others are left to _find_spikes.
+        """
+        quiet = Y.max(axis=1) <= 0.0
+        for f, q in zip(features, quiet):
+            if q:
+                utilities.set_once(f, 'spike_i_and_threshold',
+                                   peak_and_threshold(np.empty(0, dtype=int), np.empty(0)))
+
     @property
     def spike_i(self):
         "Indices of spike maximums in the wave.x, wave.y arrays"
@@ -416,22 +586,30 @@ class Spikes(Feature):
 
     @property
     @utilities.once
-    def spike_bounds(self):
-        "The FWHM box and other measurements for each spike"
-        spikes, thresholds = self.spike_i_and_threshold
+    def spike_bounds_i(self):
+        """Indices of the FWHM box of each spike
 
-        ans = []
+        The box extends from the spike maximum in both directions as
+        long as the wave stays above half height.
+        """
+        spikes, thresholds = self.spike_i_and_threshold
         y = self._obj.wave.y
+        last = y.size - 1
         halfheight = (self.spikes.y - thresholds) / 2 + thresholds
 
-        for i, k in enumerate(self.spike_i):
-            beg = end = k
-            while beg > 1 and y[beg - 1] > halfheight[i]:
-                beg -= 1
-            while end + 2 < y.size and y[end + 1] > halfheight[i]:
-                end += 1
-            ans.append(WaveRegion(self._obj.wave, beg, end))
-        return ans
+        left_i = _advance(spikes,
+                          lambda i, j: (j > 1) & (y[np.clip(j - 1, 0, last)] > halfheight[i]),
+                          step=-1)
+        right_i = _advance(spikes,
+                           lambda i, j: (j + 2 < y.size) & (y[np.clip(j + 1, 0, last)] > halfheight[i]))
+        return region_indices(left_i, right_i)
+
+    @property
+    @utilities.once
+    def spike_bounds(self):
+        "The FWHM box and other measurements for each spike"
+        return [WaveRegion(self._obj.wave, beg, end)
+                for beg, end in zip(*self.spike_bounds_i)]
 
     @property
     @utilities.once
@@ -444,7 +622,8 @@ class Spikes(Feature):
     @property
     @utilities.once
     def spike_width(self):
-        return np.array([bounds.width for bounds in self.spike_bounds])
+        left, right = _region_edges(self._obj.wave.x, self.spike_bounds_i)
+        return right - left
 
     @property
     @utilities.once
@@ -520,54 +699,83 @@ class AHP(Feature):
     """
     requires = ('wave',
                 'injection_start', 'injection_end', 'injection_interval',
-                'spikes', 'spike_count', 'spike_bounds', 'spike_threshold')
-    provides = ('spike_ahp_window', 'spike_ahp', 'spike_ahp_position')
+                'spikes', 'spike_count', 'spike_bounds_i', 'spike_threshold')
+    provides = ('spike_ahp_window_i', 'spike_ahp_window', 'spike_ahp', 'spike_ahp_position')
     array_attributes = ('spike_ahp_window', 'spike_ahp', 'spike_ahp_position')
     mean_attributes = ('spike_ahp',)
 
     @property
     @utilities.once
-    def spike_ahp_window(self):
-        spikes = self._obj.spikes
-        spike_bounds = self._obj.spike_bounds
+    def spike_ahp_window_i(self):
+        """Indices of the AHP window after each spike
+
+        The window starts where the wave stops going down after the
+        FWHM box of the spike, and ends where the wave gets back above
+        the spike threshold (but includes at least 5 points). It never
+        extends past the next spike or an injection edge.
+        """
+        bounds = self._obj.spike_bounds_i
         thresholds = self._obj.spike_threshold
         injection_start = self._obj.injection_start
         injection_end = self._obj.injection_end
 
         x = self._obj.wave.x
         y = self._obj.wave.y
-        ans = []
-        for i in range(len(spikes)):
-            beg = spike_bounds[i].right_i
-
-            # Don't allow the ahp to straddle an injection start/stop edge.
-            # The ahp will be invalid anyway.
-            rlimit = min(spike_bounds[i+1].left if i < len(spikes)-1 else x[-1],
-                         injection_start if injection_start > x[beg] else np.infty,
-                         injection_end if injection_end > x[beg] else np.infty)
-
-            w = spike_bounds[i].width
-            if not np.isnan(w):
-                n_rolling_window = int(w // (x[1] - x[0])) + 1
-            else:
-                # FIXME: consider rejecting those outright
-                n_rolling_window = 5
+        last = y.size - 1
+        if bounds.left_i.size == 0:
+            return region_indices(bounds.left_i, bounds.right_i)
+        left, right = _region_edges(x, bounds)
+        width = right - left
+        start = bounds.right_i
+
+        # Don't allow the ahp to straddle an injection start/stop edge.
+        # The ahp will be invalid anyway.
+        rlimit = np.append(left[1:], x[-1])
+        rlimit = np.minimum(rlimit, np.where(injection_start > x[start], injection_start, np.inf))
+        rlimit = np.minimum(rlimit, np.where(injection_end > x[start], injection_end, np.inf))
+
+        # FIXME: consider rejecting spikes without a width outright
+        n_rolling_window = np.where(np.isnan(width), 5,
+                                    np.nan_to_num(width // (x[1] - x[0])) + 1).astype(int)
+
+        def index(j):
+            return np.clip(j, 0, last)
+
+        # if we are before the AHP, or mostly going down, advance
+        beg = _advance(start,
+                       lambda i, j: ((j < y.size - n_rolling_window[i]) &
+                                     (y[index(j)] >= thresholds[i]) &
+                                     (x[index(j + 1)] < rlimit[i]) &
+                                     (y[index(j)] > y[index(j + n_rolling_window[i])])))
+        end = _advance(beg + n_rolling_window,
+                       lambda i, j: ((j < y.size) &
+                                     ((y[index(j)] < thresholds[i]) | (j - beg[i] < 5)) &
+                                     (x[index(j)] < rlimit[i])))
+        return region_indices(beg, end)
 
-            # if we are before the AHP, or mostly going down, advance
-            while (beg < y.size - n_rolling_window and
-                   y[beg] >= thresholds[i] and x[beg + 1] < rlimit and
-                   y[beg] > y[beg + n_rolling_window]):
-                beg += 1
-
-            end = beg + n_rolling_window
-            while (end < x.size and
-                   (y[end] < thresholds[i] or end - beg < 5) and
-                   x[end] < rlimit):
-                end += 1
+    @property
+    @utilities.once
+    def spike_ahp_window(self):
+        return [WaveRegion(self._obj.wave, beg, end)
+                for beg, end in zip(*self.spike_ahp_window_i)]
 
-            ans.append(WaveRegion(self._obj.wave, beg, end))
+    def _ahp_bottoms(self, min_points=0):
+        """The cut of each AHP window around its minimum, as (x, y) pairs
 
-        return ans
+        The cut is the width of the spike, but at least min_points
+        sampling steps.
+        """
+        x = self._obj.wave.x
+        y = self._obj.wave.y
+        left, right = _region_edges(x, self._obj.spike_bounds_i)
+        widths = right - left
+        for beg, end, w in zip(*self.spike_ahp_window_i, widths):
+            wx, wy = x[beg:end + 1], y[beg:end + 1]
+            if min_points:
+                w = max(w, min_points * (wx[1] - wx[0]))
+            bottom = wx[wy.argmin()]
+            cut = (wx >= bottom - w/2) & (wx <= bottom + w/2)
+            yield wx[cut], wy[cut]
 
     @property
     @utilities.once
@@ -581,20 +789,12 @@ class AHP(Feature):
         thresh=spikes.spike_threshold
         mean=vartype.array_mean(cut.y)-thresh[i], or ans[i]=mean.x-spikes.spike_threshold[i],mean.dev
         """
-        windows = self.spike_ahp_window
-        spikes = self._obj.spikes
-        spike_bounds = self._obj.spike_bounds
-
-        ans = np.empty((len(windows), 2))
-        for i in range(len(windows)):
-            w = spike_bounds[i].width
-            left = windows[i].x[windows[i].y.argmin()] - w/2
-            right = windows[i].x[windows[i].y.argmin()] + w/2
-            cut = windows[i].wave[(windows[i].x >= left) & (windows[i].x <= right)]
-            mean = vartype.array_mean(cut.y)
+        ans = np.empty((self._obj.spike_count, 2))
+        for i, (cx, cy) in enumerate(self._ahp_bottoms()):
+            mean = vartype.array_mean(cy)
             ans[i] = mean.x, mean.dev
 
-        return np.rec.fromarrays(ans.T, names='x,dev')
+        return vartype.vararray(*ans.T)
 
     @property
     @utilities.once
@@ -607,31 +807,22 @@ class AHP(Feature):
 
         TODO: add to plot
         """
-        windows = self.spike_ahp_window
-        spikes = self._obj.spikes
-        spike_bounds = self._obj.spike_bounds
-
-        ans = np.empty((len(windows), 2))
-        for i in range(len(windows)):
-            step = windows[i].x[1] - windows[i].x[0]
-            # Make sure that we have at least a few points in the window,
-            # even if the spike is very narrow.
-            w = max(spike_bounds[i].width, 8 * step)
-            left = windows[i].x[windows[i].y.argmin()] - w/2
-            right = windows[i].x[windows[i].y.argmin()] + w/2
-            cut = windows[i].wave[(windows[i].x >= left) & (windows[i].x <= right)]
-            bottom = vartype.array_mean(cut.y)
-            relative = cut.y - bottom.x
+        ans = np.empty((self._obj.spike_count, 2))
+        # Make sure that we have at least a few points in the window,
+        # even if the spike is very narrow.
+        for i, (cx, cy) in enumerate(self._ahp_bottoms(min_points=8)):
+            bottom = vartype.array_mean(cy)
+            relative = cy - bottom.x
             weights = (relative / relative.ptp())**-2
             weights = np.fmin(weights, 100)
-            avg = (cut.x * weights).sum() / weights.sum()
+            avg = (cx * weights).sum() / weights.sum()
             assert not np.isnan(avg)
-            dev = ((cut.x-avg)**2 * weights).sum()**0.5 / weights.sum()**0.5
+            dev = ((cx-avg)**2 * weights).sum()**0.5 / weights.sum()**0.5
             assert not np.isnan(dev)
             # TODO: check the formula for dev
             ans[i] = (avg, dev)
 
-        return np.rec.fromarrays(ans.T, names='x,dev')
+        return vartype.vararray(*ans.T)
 
     def _do_plots(self, axes):
         spikes = self._obj.spikes
@@ -695,28 +886,169 @@ class AHP(Feature):
             diff = r - l
             axes[i].set_xlim(l - diff*0.15, r + diff*0.15)
 
-def _find_falling_curve(wave, window=20, after=0.2, before=0.6):
-    d = vartype.array_diff(wave)
-    dd = smooth(d.y, window='hanning', window_len=window)[(d.x > after) & (d.x < before)]
-    start = end = dd.argmin() + (d.x <= after).sum()
-    while start > 0 and wave[start - 1].y > wave[start].y and wave[start].x > after:
-        start -= 1
-    sm = smooth(wave.y, window='hanning', window_len=window)
-    smallest = sm[end]
-    # find minimum
-    while (end+window < wave.size and wave[end+window].x < before
-           and sm[end:end + window].min() < smallest):
-        smallest = sm[end]
-        end += window // 2
-    start_override = (d.x > after).argmax()
-    ccut = wave[start_override + 1 : end]
-    return ccut
+smoothed_range = namedtuple('smoothed_range', 'start y')
+
+class SmoothedWave(Feature):
+    """The smoothed voltage and its derivative after the injection start
+
+    Both are computed once per wave, and only over the window from
+    `injection_start` to `steady_before` which the falling curve search
+    looks at. The indices of the injection window are shared by the
+    charging and post-injection curves.
+    """
+    requires = ('wave',
+                'injection_start', 'injection_end', 'steady_before',
+                'falling_curve_window')
+    provides = ('injection_window_i', 'post_injection_i',
+                'smoothed_derivative', 'smoothed_wave')
+
+    @property
+    @utilities.once
+    def injection_window_i(self):
+        "The indices of the samples with injection_start < x < injection_end, as a slice"
+        x = self._obj.wave.x
+        return slice(x.searchsorted(self._obj.injection_start, 'right'),
+                     x.searchsorted(self._obj.injection_end, 'left'))
+
+    @property
+    @utilities.once
+    def post_injection_i(self):
+        "The index of the first sample with x > injection_end"
+        return self._obj.wave.x.searchsorted(self._obj.injection_end, 'right')
+
+    @property
+    @utilities.once
+    def smoothed_derivative(self):
+        """The smoothed difference of consecutive samples, as a smoothed_range
+
+        Covers the differences with x between injection_start and
+        steady_before. The x of a difference is that of vartype.array_diff.
+        """
+        wave = self._obj.wave
+        dx = wave.x[:1] + wave.x[1:]
+        start = dx.searchsorted(self._obj.injection_start, 'right')
+        stop = dx.searchsorted(self._obj.steady_before, 'left')
+        dy = smooth_range(np.diff(wave.y), start, stop,
+                          window_len=self._obj.falling_curve_window, window='hanning')
+        return smoothed_range(start, dy)
+
+    @property
+    @utilities.once
+    def smoothed_wave(self):
+        "The smoothed voltage from the start of smoothed_derivative to steady_before"
+        wave = self._obj.wave
+        derivative = self.smoothed_derivative
+        start = derivative.start
+        stop = max(wave.x.searchsorted(self._obj.steady_before, 'left'),
+                   start + derivative.y.size)
+        y = smooth_range(wave.y, start, stop,
+                         window_len=self._obj.falling_curve_window, window='hanning')
+        return smoothed_range(start, y)
+
+def _find_falling_curve(wave, derivative, smoothed, window=20, before=0.6):
+    """The part of wave from the injection start to the bottom of the fall
+
+    The bottom is searched from the steepest point of the smoothed
+    derivative, moving in steps of window//2 as long as the smoothed
+    wave dips below its value at the previous step within the next
+    window.
+    """
+    end = derivative.start + derivative.y.argmin()
+    step = window // 2
+    x = wave.x
+
+    def keep_going(rows, j):
+        ok = j + window < x.size
+        ok[ok] = x[j[ok] + window] < before
+        # j + window is now before steady_before, inside of smoothed
+        i = j[ok] - smoothed.start
+        dip = smoothed.y[i[:, None] + np.arange(window)].min(axis=1)
+        ok[ok] = dip < smoothed.y[np.maximum(i - step, end - smoothed.start)]
+        return ok
+
+    end = _advance([end], keep_going, step=step)[0]
+    return wave[derivative.start + 1 : end]
 
 def simple_exp(x, amp, tau):
     return float(amp) * np.exp(-(x-x[0]) / float(tau))
 def negative_exp(x, amp, tau):
     return float(amp) * (1-np.exp(-(x-x[0]) / float(tau)))
 
+def _fit_negative_exp(x, y, p0, **kwargs):
+    """Least-squares fit of negative_exp(x, amp, tau) to y
+
+    Returns (popt, pcov) like optimize.curve_fit. The starting tau comes
+    from the integral form of the equation, y(t) - y(0) = amp/tau*t -
+    1/tau*integral(y), which is linear in the parameters. It is refined
+    with Gauss-Newton steps, with amp always set to its optimal value
+    for the current tau. The result does not depend on p0. curve_fit is
+    started from p0 (with kwargs) only if this does not converge to a
+    finite positive tau.
+    """
+    t = np.asarray(x, dtype=float) - x[0]
+    y = np.asarray(y, dtype=float)
+    tau = _integral_exp_tau(t, y)
+    fit = _gauss_newton_exp(t, y, tau) if tau is not None else None
+    if fit is None:
+        return optimize.curve_fit(negative_exp, x, y, p0, **kwargs)
+    return fit
+
+def _integral_exp_tau(t, y):
+    "Closed-form tau from a linear regression of y on t and the integral of y"
+    integral = np.concatenate(([0], np.cumsum((y[1:] + y[:-1]) / 2 * np.diff(t))))
+    A = np.column_stack((np.ones_like(t), t, integral))
+    with np.errstate(all='ignore'):
+        tau = -1 / np.linalg.lstsq(A, y, rcond=None)[0][2]
+    return tau if np.isfinite(tau) and tau > 0 else None
+
+def _gauss_newton_exp(t, y, tau, max_iter=100, rtol=1e-10):
+    """Minimize the residuals of negative_exp starting at tau
+
+    Returns (popt, pcov), with pcov scaled by the residual variance
+    as curve_fit does, or None if the iteration fails.
+    """
+    def project(tau):
+        e = np.exp(-t / tau)
+        g = 1 - e
+        amp = (g @ y) / (g @ g)
+        r = y - amp * g
+        return amp, e, g, r, r @ r
+
+    def normal_matrix(amp, tau, e, g):
+        dtau = -amp * e * t / tau**2
+        return np.array([[g @ g, g @ dtau],
+                         [g @ dtau, dtau @ dtau]]), dtau
+
+    with np.errstate(all='ignore'):
+        amp, e, g, r, cost = project(tau)
+        for _ in range(max_iter):
+            JJ, dtau = normal_matrix(amp, tau, e, g)
+            # amp is optimal, so the residuals are orthogonal to g
+            step = (dtau @ r) * JJ[0, 0] / (JJ[0, 0] * JJ[1, 1] - JJ[0, 1]**2)
+            for _ in range(30):
+                if tau + step > 0:
+                    new = project(tau + step)
+                    if new[-1] <= cost:
+                        break
+                step /= 2
+            else:
+                break
+            tau += step
+            amp, e, g, r, cost = new
+            if abs(step) <= rtol * tau or cost == 0:
+                break
+        else:
+            return None
+
+        JJ, _ = normal_matrix(amp, tau, e, g)
+        try:
+            pcov = np.linalg.inv(JJ) * cost / (t.size - 2)
+        except np.linalg.LinAlgError:
+            return None
+    if not (np.isfinite(amp) and np.isfinite(tau) and tau > 0 and np.isfinite(pcov).all()):
+        return None
+    return np.array([amp, tau]), pcov
+
 falling_param = namedtuple('falling_param', 'amp tau')
 function_fit = namedtuple('function_fit', 'function params good')
 
@@ -730,7 +1062,7 @@ def _fit_falling_curve(ccut, baseline, steady):
         init = (ccut.y.min()-baseline.x, ccut.x.ptp())
         func = negative_exp
         try:
-            popt, pcov = optimize.curve_fit(func, ccut.x, ccut.y-baseline.x, (-1,1))
+            popt, pcov = _fit_negative_exp(ccut.x, ccut.y-baseline.x, (-1,1))
             pcov = np.zeros((2,2)) + pcov
             params = falling_param(vartype.vartype(popt[0], pcov[0,0]**0.5),
                                 vartype.vartype(popt[1], pcov[1,1]**0.5))
@@ -746,6 +1078,7 @@ class FallingCurve(Feature):
     requires = ('wave',
                 'injection_start', 'steady_before',
                 'falling_curve_window',
+                'smoothed_derivative', 'smoothed_wave',
                  'baseline', 'steady')
     provides = ('falling_curve', 'falling_curve_fit',
                 'falling_curve_amp', 'falling_curve_tau',
@@ -757,8 +1090,9 @@ class FallingCurve(Feature):
     @utilities.once
     def falling_curve(self):
         return _find_falling_curve(self._obj.wave,
+                                   self._obj.smoothed_derivative,
+                                   self._obj.smoothed_wave,
                                    window=self._obj.falling_curve_window,
-                                   after=self._obj.injection_start,
                                    before=self._obj.steady_before)
 
     @property
@@ -807,7 +1141,7 @@ class FallingCurve(Feature):
 class PostInjectionCurve(Feature):
     requires = ('wave',
                 'injection_start', 'injection_end', 'steady_before',
-                'falling_curve_window',
+                'falling_curve_window', 'post_injection_i',
                  'baseline_after', 'steady')
     provides = ('post_injection_curve', 'post_injection_curve_fit',
                 'post_injection_curve_amp', 'post_injection_curve_tau',
@@ -818,8 +1152,7 @@ class PostInjectionCurve(Feature):
     @property
     @utilities.once
     def post_injection_curve(self):
-        window = self._obj.wave[(self._obj.wave.x > self._obj.injection_end)]
-        return window
+        return self._obj.wave[self._obj.post_injection_i:]
 
     @property
     @utilities.once
@@ -891,6 +1224,17 @@ class Rectification(Feature):
         bottom = vartype.array_mean(ccut[end-self.window_len : end+self.window_len+1].y)
         return steady - bottom
 
+    @classmethod
+    def batch(cls, features, x, Y):
+        """Make sure steady is computed for all rows at once
+
+        The bottom of the rectification lies on the falling curve of each
+        wave, so the rest is done one wave at a time.
+        """
+        steady = [f._obj._feature('steady') for f in features]
+        if getattr(steady[0], 'batch', None) is not None:
+            type(steady[0]).batch(steady, x, Y)
+
     def plot(self, figure=None):
         ax = super().plot(figure)
 
@@ -941,7 +1285,7 @@ def _fit_charging_curve(ccut, baseline, steady):
         init = (ccut.y.min()-baseline.x, ccut.x.ptp())
         func = negative_exp
         try:
-            popt, pcov = optimize.curve_fit(func, ccut.x-ccut.x[0], ccut.y-ccut.y[0], p0 = (.02,.02), maxfev = 100000)
+            popt, pcov = _fit_negative_exp(ccut.x-ccut.x[0], ccut.y-ccut.y[0], (.02,.02), maxfev=100000)
             pcov = np.zeros((2,2)) + pcov
             params = charging_param(vartype.vartype(popt[0], pcov[0,0]**0.5),
                             vartype.vartype(popt[1], pcov[1,1]**0.5))
@@ -955,7 +1299,8 @@ def _fit_charging_curve(ccut, baseline, steady):
 class ChargingCurve(Feature):
     requires = ('wave', 'injection_start', 'steady_before',
                 'baseline', 'baseline_before',
-                'spikes', 'spike_count', 'spike_threshold', 'injection_end')
+                'spikes', 'spike_count', 'spike_threshold', 'injection_end',
+                'injection_window_i')
     provides = ('charging_curve_halfheight', 'charging_curve','charging_curve_fit', 'charging_curve_amp', 'charging_curve_tau','charging_curve_function')
     array_attributes = ('charging_curve', 'charging_curve_halfheight','charging_curve_amp', 'charging_curve_tau','charging_curve_function')
 
@@ -986,23 +1331,21 @@ class ChargingCurve(Feature):
         #    return None
         wave = self._obj.wave
         injection_start = self._obj.injection_start
-        injection_end = self._obj.injection_end
+        window = self._obj.injection_window_i
         baseline = self._obj.baseline.x
         if self._obj.spike_count < 1:
             #threshold_y =  (np.max(wave.y) - baseline) * 0.9
-            what = wave[(wave.x > injection_start) & (wave.x < injection_end)]
-            return what
+            return wave[window]
         else:
             first_spike_after_injection = (self._obj.spikes.x > injection_start).argmax()
-            cut = wave[(wave.x<self._obj.spikes[first_spike_after_injection].x)]
+            cut = wave[:wave.x.searchsorted(self._obj.spikes[first_spike_after_injection].x, 'left')]
             threshold_y = 0.95*(self._obj.spike_threshold[first_spike_after_injection] - baseline)
             if np.isnan(threshold_y):
                 threshold_x = cut.x[-1]
             else:
                 threshold_x = cut[(cut.y-baseline < threshold_y)][-1].x #x value of last y value below threshold before first spike
-            what = wave[(wave.x > injection_start) & (wave.x < threshold_x)]
             #what = what[what.y < threshold]
-            return what
+            return wave[window.start:wave.x.searchsorted(threshold_x, 'left')]
 
     @property
     @utilities.once
@@ -1055,6 +1398,7 @@ class ChargingCurve(Feature):
 
 standard_features = (
     SteadyState,
+    SmoothedWave,
     Spikes,
     AHP,
     FallingCurve,
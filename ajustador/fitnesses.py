@@ -2,6 +2,9 @@ from __future__ import print_function, division
 
 import collections
 import enum
+import functools
+import operator
+import weakref
 import numpy as np
 import pandas as pd
 
@@ -20,6 +23,96 @@ RELATIVE_MAX_RATIO = 10
 
 NAN_REPLACEMENT = 1.5
 
+def requires(*attributes):
+    """Declare the attributes of the simulation which a fitness function uses
+
+    >>> @requires('response')
+    ... def response_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
+    ...     ...
+
+    They are collected by :attr:`combined_fitness.requires`.
+    """
+    def decorator(func):
+        func.requires = attributes
+        return func
+    return decorator
+
+class MeasurementProfile:
+    """The measurement side of the fitness functions, computed once
+
+    A fit compares every simulation with the same measurement. The
+    profile computes the attributes of the measurement which the
+    fitness functions use when it is created, and keeps what they
+    derive from the measurement waves: the spike tables of
+    :func:`spike_time_fitness` and the sorted voltages of
+    :func:`spike_range_y_histogram_fitness`. Fit creates it, the fitness
+    functions find it with :func:`measurement_profile`.
+
+    >>> fitnesses.MeasurementProfile(measurement, fitness.requires)
+
+    Only the given attributes are precomputed. If attributes is None
+    (the fitness function does not declare what it requires), nothing
+    is, and all attributes are computed when they are first used. The
+    profile stays valid as long as measurement.waves is not replaced.
+    """
+    def __init__(self, measurement, attributes=None):
+        self.measurement = measurement
+        self.waves = measurement.waves
+        self.index = {id(wave): i for i, wave in enumerate(self.waves)}
+        self._spikes = {}
+        self._sorted = {}
+
+        for attr in sorted(attributes or ()):
+            try:
+                if attr in measurement._array_attributes:
+                    getattr(measurement, attr)
+                    if attr in measurement._mean_attributes:
+                        getattr(measurement, 'mean_' + attr)
+                else:
+                    for wave in self.waves:
+                        getattr(wave, attr)
+            except Exception as e:
+                # leave it to the fitness functions, which might only
+                # need it for some of the waves
+                logger.warning('cannot precompute {} of {}: {!r}'.format(
+                    attr, getattr(measurement, 'name', measurement), e))
+        measurement._fitness_profile = self
+
+    def _key(self, waves):
+        key = tuple(self.index.get(id(wave)) for wave in waves)
+        return None if None in key else key
+
+    def spikes(self, obj):
+        """The result of _spike_times(obj) for a selection of the waves
+
+        The returned arrays must not be modified.
+        """
+        key = self._key(obj.waves)
+        if key is None:
+            return _spike_times(obj)
+        try:
+            return self._spikes[key]
+        except KeyError:
+            return self._spikes.setdefault(key, _spike_times(obj))
+
+    def sorted_y(self, wave, left, right):
+        "The sorted voltages of wave between left and right"
+        key = id(wave), left, right
+        try:
+            return self._sorted[key]
+        except KeyError:
+            pass
+        x, y = wave.wave.x, wave.wave.y
+        return self._sorted.setdefault(key, np.sort(y[(x >= left) & (x <= right)]))
+
+def measurement_profile(measurement):
+    "The MeasurementProfile of measurement, or None"
+    profile = getattr(measurement, '__dict__', {}).get('_fitness_profile')
+    if (profile is not None and profile.measurement is measurement
+            and profile.waves is measurement.waves):
+        return profile
+    return None
+
 def sub_mes_dev(reca, recb):
     ''' Calculates difference and root over sum of squares of deviation of raca and racb.
     '''
@@ -34,14 +127,44 @@ def sub_mes_dev(reca, recb):
         return vartype.vartype.nan
 
     if hasattr(reca, 'x'):
-        xy = (reca.x - recb.x, (reca.dev**2 + recb.dev**2)**0.5)
-        if isinstance(reca, vartype.vartype):
-            return vartype.vartype(*xy)
-        else:
-            return np.rec.fromarrays(xy, names='x,dev')
+        return vartype.array_sub(reca, recb)
     else:
         return reca - recb
 
+INJECTION_TOLERANCE = 1e-12
+
+def join_injections(a, b):
+    """Pairs of indices (i, j) with |a[i] - b[j]| < INJECTION_TOLERANCE
+
+    The same as np.where(np.abs(a[:,None] - b) < INJECTION_TOLERANCE),
+    ordered by i and then j, so every repeated current is paired with
+    every match. It is computed with a sorted merge: a[i] is compared
+    only with the values of b within twice the tolerance. The result
+    depends only on the currents, so it is remembered for each pair of
+    injection arrays and must not be modified.
+    """
+    a = np.ascontiguousarray(a, dtype=float)
+    b = np.ascontiguousarray(b, dtype=float)
+    return _join_injections(a.tobytes(), b.tobytes())
+
+@functools.lru_cache(maxsize=256)
+def _join_injections(a, b):
+    a, b = np.frombuffer(a), np.frombuffer(b)
+    order = np.argsort(b, kind='stable')
+    sorted_b = b[order]
+    lo = sorted_b.searchsorted(a - 2 * INJECTION_TOLERANCE, 'left')
+    hi = sorted_b.searchsorted(a + 2 * INJECTION_TOLERANCE, 'right')
+    counts = hi - lo
+    i = np.repeat(np.arange(a.size), counts)
+    k = np.arange(counts.sum()) + np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    j = order[k]
+    keep = np.abs(a[i] - b[j]) < INJECTION_TOLERANCE
+    i, j = i[keep], j[keep]
+    pairs = np.lexsort((j, i))
+    i, j = i[pairs], j[pairs]
+    i.flags.writeable = j.flags.writeable = False
+    return i, j
+
 def _select(a, b, which=None):
     ''' a -> sim, b -> measurments and which -> filter condition
         Note:- If filter condtion is not satisfied by any of the value, when indexed
@@ -50,10 +173,7 @@ def _select(a, b, which=None):
         bsel = b[which]
     else:
         bsel = b
-    fitting = np.abs(a.injection[:,None] - bsel.injection) < 1e-12
-    logger.debug("{}".format(fitting))
-    ind1, ind2 = np.where(fitting)
-    logger.debug("{} {}".format(ind1, ind2))
+    ind1, ind2 = join_injections(a.injection, bsel.injection)
     return a[ind1], bsel[ind2]
 
 def relative_diff_single(a, b, extra=0):
@@ -115,58 +235,191 @@ def _evaluate_single(a, b, error=ErrorCalc.relative):
     else:
         return ans
 
+def _rms_rows(diff, nan_replacement=NAN_REPLACEMENT):
+    "vartype.array_rms of each row of a 2-d array or vararray"
+    if hasattr(diff, 'x'):
+        squares = (diff.x / diff.dev)**2
+    else:
+        diff[np.isnan(diff)] = nan_replacement
+        squares = diff ** 2
+    if squares.shape[1] == 0:
+        return np.full(squares.shape[0], np.nan)
+    # np.power rounds like the scalar **, array ** 0.5 is a sqrt
+    return np.power(squares.mean(axis=1), 0.5)
+
+def _evaluate_rows(a, b, error=ErrorCalc.relative):
+    "_evaluate(a[i], b) for each row of a, with the rows as long as b"
+    if error == ErrorCalc.normal:
+        diff = a - b
+    elif error == ErrorCalc.relative:
+        diff = relative_diff_single(a, b)
+    else:
+        assert False, error
+    ans = _rms_rows(diff)
+    ans[np.isnan(ans)] = NAN_REPLACEMENT
+    return ans
+
+def _batch_value(func, sim, measurement, error):
+    r = func(sim, measurement, error=error)
+    return NAN_REPLACEMENT if r is vartype.vartype.nan else r
+
+def stacked(attr, which=None, nan_if_empty=False):
+    """Make a fitness function which compares attr of the paired waves
+
+    The decorated function only gives the name and the docstring, the
+    fitness function computes
+
+        m1, m2 = _select(sim, measurement, which(measurement))
+        if nan_if_empty and len(m2) == 0:
+            return vartype.vartype.nan
+        return _evaluate(m1.<attr>, m2.<attr>, error=error)
+
+    attr may be a path like 'steady.dev'. The function gets a
+    batch_values(sims, measurement, error) method which returns its values for
+    many simulations, with vartype.nan counted as NAN_REPLACEMENT.
+    Simulations with the same injection currents are compared with the
+    measurement in one array operation. See :meth:`combined_fitness.batch`.
+    """
+    name, _, path = attr.partition('.')
+    get = operator.attrgetter(attr)
+    part = operator.attrgetter(path) if path else lambda values: values
+
+    def decorator(func):
+        @functools.wraps(func)
+        def fitness(sim, measurement, full=False, error=ErrorCalc.relative):
+            m1, m2 = _select(sim, measurement,
+                             which(measurement) if which is not None else None)
+            if nan_if_empty and len(m2) == 0:
+                return vartype.vartype.nan
+            return _evaluate(get(m1), get(m2), error=error)
+
+        def batch_values(sims, measurement, error=ErrorCalc.relative):
+            bsel = measurement[which(measurement)] if which is not None else measurement
+            ans = np.empty(len(sims))
+            groups = collections.OrderedDict()
+            for i, sim in enumerate(sims):
+                key = np.asarray(sim.injection, dtype=float).tobytes()
+                groups.setdefault(key, []).append(i)
+
+            for members in groups.values():
+                ind1, ind2 = join_injections(sims[members[0]].injection, bsel.injection)
+                if nan_if_empty and ind2.size == 0:
+                    ans[members] = NAN_REPLACEMENT
+                    continue
+                rows, indices = [], []
+                for i in members:
+                    sim = sims[i]
+                    values = getattr(sim, name)
+                    # only values of one element per wave can be indexed like the waves
+                    lengths = sim._batch_state().lengths.get(name)
+                    if lengths is None or (lengths != 1).any():
+                        ans[i] = _batch_value(fitness, sim, measurement, error)
+                    else:
+                        rows.append(vartype._x_dev(part(values[ind1])))
+                        indices.append(i)
+                if not indices:
+                    continue
+                devs = [dev is None for x, dev in rows]
+                if all(devs):
+                    a = np.vstack([x for x, dev in rows])
+                elif not any(devs):
+                    a = vartype.vararray(np.vstack([x for x, dev in rows]),
+                                         np.vstack([dev for x, dev in rows]))
+                else:
+                    ans[indices] = [_batch_value(fitness, sims[i], measurement, error)
+                                    for i in indices]
+                    continue
+                ans[indices] = _evaluate_rows(a, get(bsel[ind2]), error=error)
+            return ans
+
+        fitness.batch_values = batch_values
+        return fitness
+    return decorator
+
+def stacked_mean(attr):
+    """Make a fitness function which compares the means of attr
+
+    Like :func:`stacked`, the fitness function returns
+    _evaluate_single(sim.mean_<attr>, measurement.mean_<attr>, error=error)
+    and has a batch_values method.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def fitness(sim, measurement, full=False, error=ErrorCalc.relative):
+            return _evaluate_single(getattr(sim, 'mean_' + attr),
+                                    getattr(measurement, 'mean_' + attr),
+                                    error=error)
+
+        def batch_values(sims, measurement, error=ErrorCalc.relative):
+            a = vartype.vararray.from_items(getattr(sim, 'mean_' + attr) for sim in sims)
+            b = getattr(measurement, 'mean_' + attr)
+            if error == ErrorCalc.normal:
+                ans = abs(a.x - getattr(b, 'x', b))
+            elif error == ErrorCalc.relative:
+                ans = relative_diff_single(a, b)
+            else:
+                raise AssertionError
+            ans = np.array(ans, dtype=float)
+            ans[np.isnan(ans)] = NAN_REPLACEMENT
+            return ans
+
+        fitness.batch_values = batch_values
+        return fitness
+    return decorator
+
+@requires('response')
+@stacked('response', lambda measurement: measurement.spike_count < 1)
 def response_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of response to hyperpolarizing injection"
-    m1, m2 = _select(sim, measurement, measurement.spike_count < 1)
-    return _evaluate(m1.response, m2.response, error=error)
 
+@requires('steady')
+@stacked('steady.dev', lambda measurement: measurement.spike_count < 1)
 def response_variance_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     '''Variance of steady state response for non-spiking responses'''
-    m1, m2 = _select(sim, measurement, measurement.spike_count < 1)
-    return _evaluate(m1.steady.dev, m2.steady.dev, error=error)
 
 
+@requires('baseline')
+@stacked('baseline')
 def baseline_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of baselines"
-    m1, m2 = _select(sim, measurement)
-    return _evaluate(m1.baseline, m2.baseline, error=error)
 
+@requires('baseline_pre')
+@stacked('baseline_pre')
 def baseline_pre_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of baselines"
-    m1, m2 = _select(sim, measurement)
-    return _evaluate(m1.baseline_pre, m2.baseline_pre, error=error)
 
+@requires('baseline_post')
+@stacked('baseline_post')
 def baseline_post_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of baselines"
-    m1, m2 = _select(sim, measurement)
-    return _evaluate(m1.baseline_post, m2.baseline_post, error=error)
 
+@requires('rectification')
+@stacked('rectification', lambda measurement: measurement.injection <= -10e-12)
 def rectification_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.injection <= -10e-12)
-    return _evaluate(m1.rectification, m2.rectification, error=error)
+    "Similarity of rectification to hyperpolarizing injection"
 
 #This should be calculated for positive current injection, even if no spike.  Maybe only if no spike
+@requires('charging_curve_halfheight')
+@stacked('charging_curve_halfheight', lambda measurement: measurement.injection > 0,
+         nan_if_empty=True)
 def charging_curve_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.injection > 0)
-    if len(m2) == 0:
-        return vartype.vartype.nan
-    return _evaluate(m1.charging_curve_halfheight, m2.charging_curve_halfheight,
-                     error=error)
+    "Similarity of the half height of the charging curve"
 
 
+@requires('post_injection_curve_tau')
+@stacked('post_injection_curve_tau')
 def post_injection_curve_tau_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     "Similarity of time constants fit to post injection curve"
-    m1, m2 = _select(sim, measurement)
-    return _evaluate(m1.post_injection_curve_tau, m2.post_injection_curve_tau, error=error)
 
 
+@requires('charging_curve_tau')
+@stacked('charging_curve_tau', lambda measurement: measurement.injection > 0,
+         nan_if_empty=True)
 def charging_curve_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.injection >0)
-    if len(m2) == 0:
-        return vartype.vartype.nan
-    return _evaluate(m1.charging_curve_tau, m2.charging_curve_tau, error=error)
+    "Similarity of time constants fit to the charging curve"
 
 
+@requires('charging_curve')
 def charging_curve_full_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     ''''''
     m1, m2 = _select(sim, measurement, measurement.injection > 0)
@@ -187,23 +440,21 @@ def charging_curve_full_fitness(sim, measurement, full=False, error=ErrorCalc.re
 
 
 #alternatively, could do falling curve for positive current injection if no spike
+@requires('falling_curve_tau')
+@stacked('falling_curve_tau', lambda measurement: measurement.injection <= -10e-12,
+         nan_if_empty=True)
 def falling_curve_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.injection <= -10e-12)
-    if len(m2) == 0:
-        return vartype.vartype.nan
-    return _evaluate(m1.falling_curve_tau, m2.falling_curve_tau, error=error)
+    "Similarity of time constants fit to the falling curve"
 
+@requires('spike_count', 'mean_isi')
+@stacked('mean_isi', lambda measurement: measurement.spike_count >= 2, nan_if_empty=True)
 def mean_isi_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.spike_count >= 2)
-    if len(m2) == 0:
-        return vartype.vartype.nan
-    return _evaluate(m1.mean_isi, m2.mean_isi, error=error)
+    "Similarity of mean interspike intervals"
 
+@requires('spike_count', 'isi_spread')
+@stacked('isi_spread', lambda measurement: measurement.spike_count >= 2, nan_if_empty=True)
 def isi_spread_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.spike_count >= 2)
-    if len(m2) == 0:
-        return vartype.vartype.nan
-    return _evaluate(m1.isi_spread, m2.isi_spread, error=error)
+    "Similarity of interspike interval spreads"
 
 def _measurement_to_spikes(meas):
     frames = [pd.DataFrame(wave.spikes) for wave in meas]
@@ -213,6 +464,61 @@ def _measurement_to_spikes(meas):
         frame.set_index(['index', 'injection'], inplace=True)
     return pd.concat(frames)
 
+spike_times = collections.namedtuple('spike_times', 'number injection x')
+
+def _spike_times(meas):
+    """The spikes of all waves of meas, numbered within each wave
+
+    The same rows as in _measurement_to_spikes, but as arrays.
+    """
+    xs = [wave.spikes.x for wave in meas]
+    counts = np.array([x.size for x in xs], dtype=int)
+    total = counts.sum()
+    number = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    injection = np.repeat(np.array([wave.injection for wave in meas], dtype=float), counts)
+    x = np.concatenate(xs) if xs else np.empty(0)
+    return spike_times(number, injection, x)
+
+def _align_spike_times(spikes1, spikes2, fill):
+    """Pad the spike times of two measurements to the same (number, injection) rows
+
+    Missing spikes get fill. This gives the same rows, in the same order,
+    as DataFrame.align of the _measurement_to_spikes frames: the rows are
+    left alone if they are the same on both sides or one side is empty,
+    otherwise they are the sorted union. Returns None if a row occurs
+    twice on one side.
+    """
+    n1 = spikes1.x.size
+    if (n1 == spikes2.x.size and
+        np.array_equal(spikes1.number, spikes2.number) and
+        np.array_equal(spikes1.injection, spikes2.injection)):
+        return spikes1.x, spikes2.x
+    # an empty side takes the rows of the other one
+    if n1 == 0:
+        return np.full(spikes2.x.size, fill, dtype=float), spikes2.x
+    if spikes2.x.size == 0:
+        return spikes1.x, np.full(n1, fill, dtype=float)
+
+    number = np.concatenate((spikes1.number, spikes2.number))
+    injection = np.concatenate((spikes1.injection, spikes2.injection))
+    order = np.lexsort((injection, number))
+    number, injection = number[order], injection[order]
+    new = np.ones(order.size, dtype=bool)
+    new[1:] = (number[1:] != number[:-1]) | (injection[1:] != injection[:-1])
+    row = np.cumsum(new) - 1
+    rows = row[-1] + 1 if row.size else 0
+
+    first = order < n1
+    aligned = []
+    for side, src, offset in ((first, spikes1.x, 0), (~first, spikes2.x, n1)):
+        if np.bincount(row[side], minlength=rows).max(initial=0) > 1:
+            return None
+        x = np.full(rows, fill, dtype=float)
+        x[row[side]] = src[order[side] - offset]
+        aligned.append(x)
+    return tuple(aligned)
+
+@requires('spike_count', 'spikes', 'injection_interval')
 def spike_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     m1, m2 = _select(sim, measurement, measurement.spike_count >= 2)
     if len(m1) == 0:
@@ -221,35 +527,47 @@ def spike_time_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
             # neither is spiking, cannot determine spike timing (Good thing)
             print('************')
             return 0 # If both are not spiking (rare but possible), cannot imporve spike_time_fitness
-    spikes1 = _measurement_to_spikes(m1)
-    spikes2 = _measurement_to_spikes(m2)
-    # spikes1, spikes2 are pandas DataFrames indexed by injection level and spike number
-    # The align method below will insert nans for missing spikes (only in the data frame missing a spike; the other dataframe will preserve its times)
-    spikes1, spikes2 = spikes1.align(spikes2,axis=0)
-    # Missing spikes contribute error scaled by injection_interval (could be left simply as NaNs and handled by NAN_REPLACEMENT)
-    spikes1.fillna(sim[0].injection_interval, inplace=True)
-    spikes2.fillna(sim[0].injection_interval, inplace=True) 
-    return _evaluate(spikes1['x'], spikes2['x'], error=error)
-
+    profile = measurement_profile(measurement)
+    spikes1, spikes2 = (profile.spikes(m) if profile is not None else _spike_times(m)
+                        for m in (m1, m2))
+    # Spikes are matched by injection level and spike number. Missing spikes
+    # contribute error scaled by injection_interval (could be left simply as
+    # NaNs and handled by NAN_REPLACEMENT)
+    aligned = _align_spike_times(spikes1, spikes2, sim[0].injection_interval)
+    if aligned is None:
+        # repeated injections, let pandas pair up the duplicate rows
+        spikes1, spikes2 = _measurement_to_spikes(m1).align(_measurement_to_spikes(m2), axis=0)
+        spikes1.fillna(sim[0].injection_interval, inplace=True)
+        spikes2.fillna(sim[0].injection_interval, inplace=True)
+        aligned = spikes1['x'], spikes2['x']
+    return _evaluate(*aligned, error=error)
+
+@requires('spike_count')
+@stacked('spike_count')
 def spike_count_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement)
-    return _evaluate(m1.spike_count, m2.spike_count, error=error)
+    "Similarity of spike counts"
 
+@requires('spike_latency')
+@stacked('spike_latency', lambda measurement: measurement.spike_count >= 1)
 def spike_latency_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    m1, m2 = _select(sim, measurement, measurement.spike_count >= 1)
-    return _evaluate(m1.spike_latency, m2.spike_latency, error=error)
+    "Similarity of the latencies of the first spike"
 
+@requires('spike_width')
+@stacked_mean('spike_width')
 def spike_width_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    return _evaluate_single(sim.mean_spike_width, measurement.mean_spike_width,
-                            error=error)
+    "Similarity of mean spike widths"
 
+@requires('spike_height')
+@stacked_mean('spike_height')
 def spike_height_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    return _evaluate_single(sim.mean_spike_height, measurement.mean_spike_height,
-                            error=error)
+    "Similarity of mean spike heights"
 
+@requires('spike_threshold')
+@stacked_mean('spike_threshold')
 def spike_threshold_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
-    return _evaluate_single(sim.mean_spike_threshold, measurement.mean_spike_threshold, error=error)
+    "Similarity of mean spike thresholds"
 
+@requires('spike_ahp')
 def spike_ahp_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     m1, m2 = _select(sim, measurement, measurement.spike_count >= 1)
 
@@ -304,6 +622,7 @@ def _pick_spikes(wave1, wave2):
     else:
         return np.linspace(0, n-1, 10, dtype=int)
 
+@requires('spike_count', 'spike_ahp_window', 'spike_ahp', 'spike_ahp_position')
 def ahp_curve_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     ''' Calculates
     '''
@@ -333,11 +652,13 @@ class WaveHistogram:
     range. This is done by doing a frequency histogram, which
     abstracts away the number of points in either plot.
     """
-    def __init__(self, wave1, wave2, left=-np.inf, right=+np.inf):
+    def __init__(self, wave1, wave2, left=-np.inf, right=+np.inf, sorted_y2=None):
         self.wave1 = wave1
         self.wave2 = wave2
         self.left = left
         self.right = right
+        # y2() sorted, given by a MeasurementProfile
+        self._sorted_y2 = sorted_y2 if sorted_y2 is not None and sorted_y2.size else None
 
     def x1(self):
         return self.wave1.x[(self.wave1.x >= self.left) & (self.wave1.x <= self.right)]
@@ -356,16 +677,34 @@ class WaveHistogram:
         else:
             return hist
 
+    def _hist2(self, bins, cumulative=True):
+        "hist(bins, y2()), using the sorted y2 if available"
+        y = self._sorted_y2
+        if y is None:
+            return self.hist(bins, self.y2(), cumulative)
+        # what np.histogram does with an array of bins
+        n = np.diff(np.concatenate((y.searchsorted(bins[:-1], 'left'),
+                                    y.searchsorted(bins[-1:], 'right'))))
+        hist = n / np.diff(bins) / n.sum()
+        hist /= hist.sum()
+        return np.cumsum(hist) if cumulative else hist
+
     def bins(self, n=50):
-        y1, y2 = self.y1(), self.y2()
-        low = min(y1.min(), y2.min())
-        high = max(y1.max(), y2.max())
+        y1 = self.y1()
+        y2 = self._sorted_y2
+        if y2 is None:
+            y2 = self.y2()
+            low2, high2 = y2.min(), y2.max()
+        else:
+            low2, high2 = (y2[0], y2[-1]) if not np.isnan(y2[-1]) else (y2[-1], y2[-1])
+        low = min(y1.min(), low2)
+        high = max(y1.max(), high2)
         return np.linspace(low, high, n)
 
     def diff(self, full=False):
         bins = self.bins()
         hist1 = self.hist(bins, self.y1())
-        hist2 = self.hist(bins, self.y2())
+        hist2 = self._hist2(bins)
         diff = (hist2 - hist1) * bins.ptp()
         if full:
             return diff
@@ -400,6 +739,7 @@ class WaveHistogram:
         figure.tight_layout()
         return ax1, ax2
 
+@requires('spike_count', 'injection_start', 'injection_end')
 def spike_range_y_histogram_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     """Match histograms of y-values in spiking regions
 
@@ -413,9 +753,13 @@ def spike_range_y_histogram_fitness(sim, measurement, full=False, error=ErrorCal
     to detect mismatches in other regions.
     """
     m1, m2 = _select(sim, measurement)
+    profile = measurement_profile(measurement)
 
     diffs = np.array([WaveHistogram(wave1.wave, wave2.wave,
-                                    wave1.injection_start, wave1.injection_end).diff()
+                                    wave1.injection_start, wave1.injection_end,
+                                    profile.sorted_y(wave2, wave1.injection_start,
+                                                     wave1.injection_end)
+                                    if profile is not None else None).diff()
                       for wave1, wave2 in zip(m1, m2)
                       if max(wave1.spike_count, wave2.spike_count) > 0])
 
@@ -425,6 +769,7 @@ def spike_range_y_histogram_fitness(sim, measurement, full=False, error=ErrorCal
         return vartype.array_rms(diffs, nan_replacement=NAN_REPLACEMENT)
 
 # Used in work-aju.py somebody might use this.
+@requires('response', 'baseline_pre', 'baseline_post', 'rectification', 'falling_curve_tau', 'spike_count')
 def hyperpol_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     a = response_fitness(sim, measurement, error=error)
     b1 = baseline_pre_fitness(sim, measurement, error=error)
@@ -441,6 +786,7 @@ def hyperpol_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     else:
         return vartype.array_rms(arr, nan_replacement=NAN_REPLACEMENT)
 
+@requires('mean_isi', 'spike_latency', 'spike_width', 'spike_height', 'spike_ahp', 'spike_count', 'spikes', 'injection_interval')
 def spike_fitness(sim, measurement, full=False, error=ErrorCalc.relative):
     a = mean_isi_fitness(sim, measurement, error=error)
     b = spike_latency_fitness(sim, measurement, error=error)
@@ -531,11 +877,50 @@ class combined_fitness:
         if set(f for w,f in pairs1).intersection(set(f for w,f in pairs2)):
             raise ValueError('"known" function specified in extra')
         self.pairs = pairs1 + pairs2
+        self._terms = weakref.WeakKeyDictionary()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_terms']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._terms = weakref.WeakKeyDictionary()
+
+    def _remembered(self, sim, measurement):
+        """The values of the fitness functions computed for sim and measurement
+
+        A dictionary keyed by (function, error), kept while sim exists,
+        which is emptied when sim.waves, measurement.waves or the
+        measurement itself changes. None if sim cannot be weakly
+        referenced.
+        """
+        try:
+            entry = self._terms.get(sim)
+        except TypeError:
+            return None
+        waves = getattr(sim, 'waves', None), getattr(measurement, 'waves', None)
+        if (entry is None or entry[0] is not measurement or
+                entry[1] is not waves[0] or entry[2] is not waves[1]):
+            entry = self._terms[sim] = (measurement,) + waves + ({},)
+        return entry[3]
+
+    def _term(self, terms, func, sim, measurement):
+        "func(sim, measurement), taken from terms if it was computed before"
+        if terms is None:
+            return func(sim, measurement, error=self.error)
+        key = func, self.error
+        try:
+            return terms[key]
+        except KeyError:
+            return terms.setdefault(key, func(sim, measurement, error=self.error))
 
     def _parts(self, sim, measurement, *, full=False):
+        terms = self._remembered(sim, measurement)
         for w, func in self.pairs:
             if w or full:
-                yield (w, func(sim, measurement, error=self.error), func.__name__)
+                yield (w, self._term(terms, func, sim, measurement), func.__name__)
 
     def __call__(self, sim, measurement, full=False):
         # Computes feature fitnesses using _parts for one trace.
@@ -551,10 +936,74 @@ class combined_fitness:
             # Calculates RMS across feature. (fitness metrics.)
             return vartype.array_rms(arr, nan_replacement=NAN_REPLACEMENT)
 
+    def batch(self, sims, measurement, full=True):
+        """The fitness of many simulations at once
+
+        Returns an (n_sims, n_terms) array whose rows are
+        self(sim, measurement, full=True), or with full=False the
+        totals self(sim, measurement). Functions declared with
+        :func:`stacked` or :func:`stacked_mean` are computed for all
+        simulations together, the others one simulation at a time. Values
+        remembered from earlier calls are not computed again.
+
+        >>> scores = fitness.batch(fit, fit.measurement)
+        """
+        sims = list(sims)
+        remembered = [self._remembered(sim, measurement) for sim in sims]
+        columns = []
+        for w, func in self.pairs:
+            if not w:
+                continue
+            batch_values = getattr(func, 'batch_values', None)
+            if batch_values is not None:
+                key = func, self.error
+                values = np.empty(len(sims))
+                missing = []
+                for i, terms in enumerate(remembered):
+                    r = terms.get(key) if terms is not None else None
+                    if r is None:
+                        missing.append(i)
+                    else:
+                        values[i] = NAN_REPLACEMENT if r is vartype.vartype.nan else r
+                if missing:
+                    computed = batch_values([sims[i] for i in missing], measurement,
+                                            error=self.error)
+                    values[missing] = computed
+                    for i, r in zip(missing, computed):
+                        if remembered[i] is not None:
+                            remembered[i][key] = r
+                columns.append(w * values)
+            else:
+                columns.append([w*NAN_REPLACEMENT if r == vartype.vartype.nan else w*r
+                                for r in (self._term(terms, func, sim, measurement)
+                                          for terms, sim in zip(remembered, sims))])
+        arr = np.column_stack(columns) if columns else np.empty((len(sims), 0))
+        if full:
+            return arr
+        else:
+            return _rms_rows(arr.copy())
+
     @property
     def __name__(self):
         return self.__class__.__name__
 
+    @property
+    def requires(self):
+        """The attributes of the simulation used by the functions with non-zero weight
+
+        None if one of them does not declare its attributes with :func:`requires`.
+        The features needed to compute them are given by
+        :func:`ajustador.loader.required_features`.
+        """
+        attributes = set()
+        for w, func in self.pairs:
+            if w:
+                needed = getattr(func, 'requires', None)
+                if needed is None:
+                    return None
+                attributes.update(needed)
+        return attributes
+
     def report(self, sim, measurement, *, full=False):
         parts = [(w, NAN_REPLACEMENT if r is vartype.vartype.nan else r, name) for w, r, name in self._parts(sim, measurement, full=full)]
         desc = '\n'.join('{}={}*{:.2g}={:.2g}'.format(name, w, r, w*r)
@@ -562,8 +1011,16 @@ class combined_fitness:
         total = desc + '\n' + 'total: {:.02g}'.format(self.__call__(sim, measurement))
         return total
 
+def group_fitness(group, measurement, fitness, full=False):
+    "The fitness of each sim in group, with combined_fitness.batch if possible"
+    if isinstance(fitness, combined_fitness):
+        return fitness.batch(group, measurement, full=full)
+    if full:
+        return np.array([fitness(sim, measurement, full=full) for sim in group])
+    return np.array([fitness(sim, measurement) for sim in group])
+
 def fit_sort(group, measurement, fitness):
-    w = np.array([fitness(sim, measurement) for sim in group])
+    w = group_fitness(group, measurement, fitness)
     w[np.isnan(w)] = np.inf
     return np.array(group)[w.argsort()]
 
@@ -579,7 +1036,7 @@ def fit_finished(fitness, cutoff=0.01, window=10):
         return quit.values.flatten()
 
 def find_best(group, measurement, fitness):
-    w = np.array([fitness(sim, measurement) for sim in group])
+    w = group_fitness(group, measurement, fitness)
     w[np.isnan(w)] = np.inf
     return group[w.argmin()]
 
@@ -589,8 +1046,7 @@ def find_multi_best(group, measurement, fitness,
     best = np.empty(0, dtype=object)
     scores = np.empty(0)
 
-    for sim in group:
-        score = fitness(sim, measurement, full=1)
+    for sim, score in zip(group, group_fitness(group, measurement, fitness, full=True)):
 
         # ignore misfits
         if np.isnan(score).any():
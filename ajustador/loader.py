@@ -12,13 +12,14 @@ import functools
 import os
 import operator
 import copy
-from collections import namedtuple
+import time
+from collections import namedtuple, OrderedDict
 import numpy as np
 from numpy.lib import recfunctions
 from igor import binarywave
 
 from . import utilities
-from .vartype import vartype
+from .vartype import vartype, vararray
 
 Fileinfo = namedtuple('fileinfo', 'group ident experiment protocol number extra')
 
@@ -41,17 +42,154 @@ def _calculate_current(fileinfo, IV, IF):
         assert tulength==2 or tulength==3
         #tulength == 3 refers to NEW data files with 3 variables including trace number (usually 3 or 4) in tuple IV
 
+def _feature_graph(features):
+    """Check the requires and provides of features and map attributes to them
+
+    The features must be listed after the features they depend on. The
+    result is computed once for every sequence of features.
+    """
+    features = tuple(features)
+    try:
+        return _feature_graphs[features]
+    except (KeyError, TypeError):
+        pass
+    graph = {'wave': None, 'injection': None}
+    for feature in features:
+        missing = set(feature.requires) - set(graph)
+        if missing:
+            raise ValueError('Unknown attribute: ' + ', '.join(sorted(missing)))
+        doubled = set(feature.provides).intersection(graph)
+        if doubled:
+            raise ValueError('Doubled attribute: ' + ', '.join(sorted(doubled)))
+        graph.update((p, feature) for p in feature.provides)
+    try:
+        _feature_graphs[features] = graph
+    except TypeError:
+        pass
+    return graph
+
+_feature_graphs = {}
+
+def required_features(features, attributes):
+    """The features which are needed to compute attributes
+
+    This is the part of the dependency graph given by requires and
+    provides which is reachable from attributes, in the original order,
+    so it can be passed as the features of a Trace.
+    """
+    graph = _feature_graph(features)
+    needed = set()
+    todo = list(attributes)
+    while todo:
+        feature = graph[todo.pop()]
+        if feature is not None and feature not in needed:
+            needed.add(feature)
+            todo.extend(feature.requires)
+    return [feature for feature in features if feature in needed]
+
+class Timebase(namedtuple('Timebase', 'start stop num endpoint')):
+    """A uniform time axis, equal to np.linspace(start, stop, num, endpoint)
+
+    The samples are only computed when x is used, and are shared by all
+    waves with the same time base.
+    """
+    __slots__ = ()
+
+    def __new__(cls, start, stop, num, endpoint=True):
+        return super().__new__(cls, float(start), float(stop), int(num), bool(endpoint))
+
+    @property
+    def t0(self):
+        return self.start
+
+    @property
+    def dt(self):
+        div = self.num - 1 if self.endpoint else self.num
+        return (self.stop - self.start) / div if div > 0 else float('nan')
+
+    @property
+    def x(self):
+        return _timebase_x(self)
+
+@functools.lru_cache(maxsize=32)
+def _timebase_x(timebase):
+    x = np.linspace(*timebase)
+    x.flags.writeable = False
+    return x
+
+class Wave(object):
+    """The samples of a Trace, a compact stand-in for np.rec.fromarrays((x, y))
+
+    y is kept as given, without a copy, unless it must be converted to
+    dtype. x is an array or a Timebase, which is materialized on first
+    use. Indexing gives the same result as indexing the record array:
+    a single record for an integer, otherwise a new record array.
+    """
+    __slots__ = ('_x', 'y')
+
+    def __init__(self, x, y, dtype=None):
+        y = np.ascontiguousarray(y, dtype=dtype)
+        if not isinstance(x, Timebase):
+            x = np.asarray(x)
+        size = x.num if isinstance(x, Timebase) else x.size
+        if y.ndim != 1 or size != y.size:
+            raise ValueError('x and y must be 1-dimensional and of the same size')
+        self._x = x
+        self.y = y
+
+    @property
+    def x(self):
+        x = self._x
+        return x.x if isinstance(x, Timebase) else x
+
+    @property
+    def timebase(self):
+        "The Timebase of the wave, or None if x was given as an array"
+        return self._x if isinstance(self._x, Timebase) else None
+
+    @property
+    def size(self):
+        return self.y.size
+
+    def __len__(self):
+        return self.y.size
+
+    @property
+    def nbytes(self):
+        "The memory used by the samples held only by this wave"
+        return self.y.nbytes + (0 if isinstance(self._x, Timebase) else self._x.nbytes)
+
+    def __getitem__(self, index):
+        try:
+            i = operator.index(index)
+        except TypeError:
+            return np.rec.fromarrays((self.x[index], self.y[index]), names='x,y')
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('index {} is out of bounds for size {}'.format(index, self.size))
+        return np.rec.fromarrays((self.x[i:i+1], self.y[i:i+1]), names='x,y')[0]
+
+    def __repr__(self):
+        return '{}(x={!r}, y={!r})'.format(self.__class__.__name__, self._x, self.y)
+
 class Trace(object):
-    def __init__(self, injection, x, y, features):
-        self.injection = injection
+    """A single recorded or simulated trace and its features
 
-        self.wave = np.rec.fromarrays((x, y), names='x,y')
+    x may be a Timebase, which is much cheaper to keep than the time of
+    every sample. y is converted to dtype if given, e.g. np.float32 to
+    halve the memory used by the voltage.
+    """
+    __slots__ = ('injection', 'wave', '_attributes')
+
+    def __init__(self, injection, x, y, features, dtype=None):
+        self.injection = injection
 
-        self._attributes = {'wave':self,
-                            'injection':self}
+        self.wave = Wave(x, y, dtype=dtype)
 
-        for feature in features:
-            self.register_feature(feature)
+        # Features are instantiated on first use, see _feature
+        self._attributes = dict(_feature_graph(features))
+        self._attributes.update(wave=self, injection=self)
 
     def register_feature(self, feature):
         # check requirements and provides
@@ -63,13 +201,21 @@ class Trace(object):
             raise ValueError('Doubled attribute: ' + ', '.join(sorted(doubled)))
 
         # register
-        obj = feature(self) if isinstance(feature, type) else feature
         for p in feature.provides:
-            self._attributes[p] = obj
+            self._attributes[p] = feature
+
+    def _feature(self, name):
+        "The feature object which provides name"
+        obj = self._attributes[name]
+        if isinstance(obj, type):
+            feature, obj = obj, obj(self)
+            for p in feature.provides:
+                self._attributes[p] = obj
+        return obj
 
     def __getattr__(self, name):
         if name != '_attributes' and name in self._attributes:
-            return getattr(self._attributes[name], name)
+            return getattr(self._feature(name), name)
         raise AttributeError(name)
 
     @property
@@ -90,7 +236,7 @@ class IVCurve(Trace):
     >>> wave.time
     0.89990000000000003
     >>> type(wave.wave)
-    <class 'numpy.recarray'>
+    <class 'ajustador.loader.Wave'>
     >>> wave.wave.x
     array([  0.00000000e+00,   1.00000000e-04,   2.00000000e-04, ...,
              8.99700000e-01,   8.99800000e-01,   8.99900000e-01])
@@ -99,8 +245,10 @@ class IVCurve(Trace):
            -0.08034375, -0.08034375], dtype=float32)
     """
 
-    def __init__(self, filename, fileinfo, injection, x, y, features):
-        super().__init__(injection, x, y, features)
+    __slots__ = ('filename', 'fileinfo', 'simulation_time')
+
+    def __init__(self, filename, fileinfo, injection, x, y, features, dtype=None):
+        super().__init__(injection, x, y, features, dtype=dtype)
 
         self.filename = filename
         self.fileinfo = fileinfo
@@ -117,7 +265,7 @@ class IVCurve(Trace):
         numpts=binarywave.load(path)['wave']['wave_header']['npnts']
         tot_time=dt*numpts
         #time = np.linspace(0, endtime, num=data.size, endpoint=False)
-        time = np.linspace(0, tot_time, num=numpts, endpoint=False)
+        time = Timebase(0, tot_time, num=numpts, endpoint=False)
         #optionally shorten the data
         #if endtime<tot_time:
         #    end_index=np.abs(time-endtime).argmin()
@@ -132,6 +280,23 @@ class IVCurve(Trace):
         return cls(filename, fileinfo, injection, time, data, features)
 
 
+# arrays and lengths map attribute names to the gathered values and the
+# number of elements each wave contributed, means holds the mean_
+# attributes, views maps wave indices to the objects returned by
+# __getitem__ (the most recently used MAX_VIEWS), parent is
+# (state, wave indices) for such an object
+_batch_state = namedtuple('_batch_state', 'waves arrays lengths means done stacked views parent')
+
+MAX_VIEWS = 16
+
+def _readonly(arr):
+    "A view of arr (or of x and dev of a vararray) which cannot be modified"
+    if isinstance(arr, vararray):
+        return vararray(_readonly(arr.x), _readonly(arr.dev))
+    view = arr.view()
+    view.flags.writeable = False
+    return view
+
 class Attributable(object):
     def __init__(self, features=None):
         # TODO: check duplicates, check dependencies between mean_attrs and array_attrs
@@ -152,28 +317,139 @@ class Attributable(object):
             raise AttributeError(attr)
 
         if not attr.startswith('_') and attr in getattr(self, '_array_attributes', {}):
-            arr = [getattr(wave, attr) for wave in self.waves]
-            if not arr:
-                return np.empty(0)
-            if isinstance(arr[0], vartype):
-                return vartype.array(arr)
-            if isinstance(arr[0], np.recarray):
-                return recfunctions.stack_arrays(arr, asrecarray=True, usemask=False)
-            if isinstance(arr[0], np.ndarray):
-                return np.hstack(arr)
-            return np.array(arr)
+            state = self._batch_state()
+            if attr not in state.arrays:
+                if not self._derive(state, attr):
+                    self._batch_compute(state, attr)
+                    state.arrays[attr], state.lengths[attr] = self._gather(attr)
+            return _readonly(state.arrays[attr])
 
         if attr.startswith('mean_') and attr[5:] in getattr(self, '_mean_attributes', {}):
-            values = self.__getattr__(attr[5:])
-            return vartype.average(values)
+            state = self._batch_state()
+            if attr not in state.means:
+                state.means[attr] = vartype.average(self.__getattr__(attr[5:]))
+            return state.means[attr]
 
         raise AttributeError('{} object does not have {} attribute'.format(
             self.__class__.__name__, attr))
 
+    def _gather(self, attr):
+        """Join the values of attr of all waves
+
+        Returns the array and the number of its elements which come from
+        each wave, or None if the array cannot be split up like that.
+        """
+        arr = [getattr(wave, attr) for wave in self.waves]
+        if not arr:
+            return np.empty(0), None
+        ones = np.ones(len(arr), dtype=int)
+        if isinstance(arr[0], vartype):
+            return vartype.array(arr), ones
+        lengths = np.array([len(a) if getattr(a, 'ndim', None) == 1 else -1 for a in arr])
+        if lengths.min() < 0:
+            lengths = None
+        if (isinstance(arr[0], vararray) or
+                getattr(getattr(arr[0], 'dtype', None), 'names', None) == ('x', 'dev')):
+            return vararray.concatenate(arr), lengths
+        if isinstance(arr[0], np.recarray):
+            return recfunctions.stack_arrays(arr, asrecarray=True, usemask=False), lengths
+        if isinstance(arr[0], np.ndarray):
+            return np.hstack(arr), lengths
+        arr = np.array(arr)
+        return arr, ones if arr.ndim == 1 and arr.dtype != object else None
+
+    def _derive(self, state, attr):
+        """Take the values of attr from the object which self was indexed from
+
+        This is only done when they were already gathered there. Returns
+        True if state.arrays[attr] was set.
+        """
+        if state.parent is None:
+            return False
+        parent, index = state.parent
+        lengths = parent.lengths.get(attr)
+        if lengths is None or index.size == 0:
+            return False
+        lengths = lengths[index]
+        starts = (np.cumsum(parent.lengths[attr]) - parent.lengths[attr])[index]
+        offsets = np.cumsum(lengths) - lengths
+        elements = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        state.arrays[attr] = parent.arrays[attr][elements]
+        state.lengths[attr] = lengths
+        return True
+
+    def _batch_state(self):
+        """Gathered attributes and batch computation results
+
+        They are valid as long as self.waves is the same object, so
+        waves must be replaced, not modified in place.
+        """
+        waves = self.waves
+        state = self.__dict__.get('_aggregated')
+        if state is None or state.waves is not waves:
+            state = self._aggregated = _batch_state(waves, {}, {}, {}, set(), [], OrderedDict(), None)
+        return state
+
+    def _stacked(self, state):
+        """The common x and the (n_waves, n_samples) array of y of all waves
+
+        Returns None if the waves do not share the same time base.
+        """
+        if not state.stacked:
+            x = state.waves[0].wave.x
+            y = state.waves[0].wave.y
+            same = all(wave.wave.x.size == x.size and
+                       wave.wave.x[0] == x[0] and wave.wave.x[-1] == x[-1] and
+                       wave.wave.y.dtype == y.dtype
+                       for wave in state.waves)
+            state.stacked.append((x, np.vstack([wave.wave.y for wave in state.waves]))
+                                 if same else None)
+        return state.stacked[0]
+
+    def _batch_compute(self, state, attr):
+        """Let the feature which provides attr compute it for all waves at once
+
+        Returns True if the values were provided by Feature.batch.
+        """
+        waves = state.waves
+        if len(waves) < 2:
+            return False
+        if attr not in getattr(waves[0], '_attributes', {}):
+            return False
+        feature = waves[0]._feature(attr)
+        if getattr(feature, 'batch', None) is None:
+            return False
+        cls = type(feature)
+        if cls not in state.done:
+            state.done.add(cls)
+            stacked = self._stacked(state)
+            if stacked is not None:
+                cls.batch([wave._feature(attr) for wave in waves], *stacked)
+        return self._stacked(state) is not None
+
     def __getitem__(self, index):
+        """A wave for an integer index, otherwise a copy of self with some waves
+
+        The copies are remembered, so indexing again with the same waves
+        returns the same object, and its array attributes are taken from
+        those of self when possible. Only the MAX_VIEWS most recently
+        used copies are kept.
+        """
         if isinstance(index, (slice, np.ndarray, list)):
+            state = self._batch_state()
+            index = np.arange(len(state.waves))[index]
+            key = index.tobytes()
+            view = state.views.get(key)
+            if view is not None and view[0].waves is view[1]:
+                state.views.move_to_end(key)
+                return view[0]
             c = copy.copy(self)
-            c.waves = self.waves[index]
+            c.waves = state.waves[index]
+            c._aggregated = _batch_state(c.waves, {}, {}, {}, set(), [], OrderedDict(),
+                                        (state, index))
+            state.views[key] = c, c.waves
+            while len(state.views) > MAX_VIEWS:
+                state.views.popitem(last=False)
             return c
         else:
             return self.waves[index]
@@ -181,6 +457,56 @@ class Attributable(object):
     def __len__(self):
         return len(self.waves)
 
+def feature_times(obj, attributes):
+    """Compute attributes of obj and return the time spent in each feature
+
+    obj is an Attributable, like a measurement or a simulation result,
+    for which nothing was computed yet. Features are evaluated in
+    dependency order and only for the attributes which are needed, so
+    the time of a feature does not include its requirements. Array
+    attributes are computed through obj, so that batch computations
+    are timed as they happen in a fitness evaluation.
+
+    Returns an OrderedDict of feature name → seconds.
+
+    >>> loader.feature_times(sim, fitness.requires)
+    OrderedDict([('SteadyState', 0.0041), ('SmoothedWave', 0.0017), ...])
+    """
+    times = OrderedDict()
+    waves = obj.waves
+    if len(waves) == 0:
+        return times
+    wave = waves[0]
+
+    providers = OrderedDict()
+    for name, feature in wave._attributes.items():
+        if feature is not wave:
+            providers.setdefault(id(feature), (feature, []))[1].append(name)
+    needed = set()
+    todo = list(attributes)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            feature = wave._attributes[name]
+            if feature is not wave:
+                todo.extend(feature.requires)
+
+    for feature, names in providers.values():
+        names = [name for name in names if name in needed]
+        if not names:
+            continue
+        start = time.perf_counter()
+        for name in names:
+            if name in obj._array_attributes:
+                getattr(obj, name)
+            else:
+                for w in waves:
+                    getattr(w, name)
+        label = feature.__name__ if isinstance(feature, type) else type(feature).__name__
+        times[label] = time.perf_counter() - start
+    return times
+
 
 class Measurement(Attributable):
     def __init__(self, dirname, params, *, features=None):
@@ -11,13 +11,16 @@ import subprocess
 import glob
 import re
 import pickle
+import json
 import multiprocessing
+import time
+import atexit
 
 import numpy as np
 import cma
 
 # _features holds all feature classes.
-from . import loader, features as _features, fitnesses, utilities
+from . import loader, features as _features, fitnesses, utilities, executors, cache as _cache, tracestore
 
 from ajustador.helpers.loggingsystem import getlogger #SRIRAM 02152018
 import logging
@@ -29,19 +32,45 @@ def filtereddict(**kwargs):
 
 
 _exe = None
+def get_executor():
+    "The executor used for simulations, a ProcessExecutor unless set_executor was called"
+    global _exe
+    if _exe is None:
+        _exe = executors.ProcessExecutor()
+    return _exe
+
+def set_executor(executor):
+    """Run simulations using executor, see ajustador.executors
+
+    The previous executor, if any, is shut down.
+    """
+    global _exe
+    if _exe is not None and _exe is not executor:
+        _exe.shutdown()
+    _exe = executor
+
+@atexit.register
+def _shutdown_executor():
+    if _exe is not None:
+        _exe.shutdown(cancel=True)
+
 def exe_map(single=False, do_async=False, map_func = None):
     if single and not do_async:
         return map
     elif map_func is not None:
         return map_func
     else:
-        global _exe
-        if _exe is None:
-            _exe = multiprocessing.Pool(multiprocessing.cpu_count() * 1)
+        executor = get_executor()
         if do_async:
-            return _exe.map_async
+            return executor.map
         else:
-            return _exe.map
+            return lambda func, iterable: executor.wait(executor.map(func, iterable))
+
+def exe_workers(map_func=None):
+    "The number of simulations which can run in parallel"
+    if map_func is None:
+        return get_executor().workers
+    return multiprocessing.cpu_count()
 
 def iv_filename(injection_current):
     return 'ivdata-{}.npy'.format(injection_current)
@@ -51,22 +80,65 @@ def iv_filename_to_current(ivfile):
     injection_current = float(name[7:-4])
     return injection_current
 
-def execute(p):
-    #print("starting execute")
+def _prepare_execute(p):
+    """Return basic_simulation arguments for the job p
+
+    The injection in p is either a single current or a tuple of
+    currents which are simulated with one model build.
+    """
     from . import basic_simulation
-    #print('imported basic_simulation in execute')
-    dirname, injection, junction_potential, params, features = p
-    simtime = params['simtime']
+    dirname, injection, junction_potential, params, features, trace_store = p
     logger.debug("Unseralized params:\n {} inject {}".format(params,injection)) #SRIRAM 02192018
+    params = dict(params)
     params['injection_delay'] = params['injection_delay'][0] #SRIRAM 02192018
     params['injection_width'] = params['injection_width'][0] #SRIRAM 02192018
-    params = basic_simulation.serialize_options(params)
-    result = iv_filename(injection) #result is filename
+    if isinstance(injection, tuple):
+        args = ['--injection-currents={}'.format(','.join(str(i) for i in injection)),
+                '--save-vm={}'.format(iv_filename('{}'))]
+    else:
+        args = ['-i={}'.format(injection),
+                '--save-vm={}'.format(iv_filename(injection))]
+    if trace_store is not None:
+        args += ['--trace-store={}'.format(trace_store),
+                 '--junction-potential={}'.format(junction_potential)]
+    return args + basic_simulation.serialize_options(params)
+
+def _load_execute_result(p, start):
+    """Load the traces saved by the job p (a list if p has many currents)
+
+    Each trace gets a .simulation_time attribute, the wall time of the
+    job since start, split evenly between the currents.
+    """
+    dirname, injection, junction_potential, params, features, trace_store = p
+    injections = injection if isinstance(injection, tuple) else (injection,)
+    elapsed = time.time() - start
+    if trace_store is not None:
+        # only send back where the traces are, the parent maps them itself
+        ivs = [stored_trace(os.path.basename(dirname), inj, elapsed / len(injections))
+               for inj in injections]
+        return ivs if isinstance(injection, tuple) else ivs[0]
+    ivs = [load_simulation(os.path.join(dirname, iv_filename(inj)),
+                           simtime=params['simtime'],
+                           junction_potential=junction_potential,
+                           features=features)
+           for inj in injections]
+    for iv in ivs:
+        iv.simulation_time = elapsed / len(ivs)
+    return ivs if isinstance(injection, tuple) else ivs[0]
+
+def execute(p):
+    #print("starting execute")
+    from . import basic_simulation
+    #print('imported basic_simulation in execute')
+    start = time.time()
+    dirname = p[0]
+    params = _prepare_execute(p)
     
     # Ensure PYTHONPATH is correct when calling basic_simulation (below) in a 
     # subprocess from a different directory than the main optimization script.
-    # Updates the os.environ['PYTHONPATH'] and passes it to 
-    # subprocess.check_call `env` kwarg 
+    # The environment of the subprocess gets the updated PYTHONPATH, the
+    # environment of this process is left alone since execute may run in
+    # many threads at once.
     import pathlib
     # Ensure we get absolute path of sys.path[0]--the directory of the main optimization script
     pythonpath_string = str(pathlib.Path(sys.path[0]).absolute())
@@ -75,37 +147,70 @@ def execute(p):
     # prepend pythonpath_string to existing PYTHONPATH
     if current_python_path is not None:
         pythonpath_string = pythonpath_string + ':' + current_python_path
-    # update PYTHONPATH environment variable 
-    os.environ['PYTHONPATH']=pythonpath_string
-    #print('os.environ: ', os.environ['PYTHONPATH'],basic_simulation.__name__)
+    env = dict(os.environ, PYTHONPATH=pythonpath_string)
     cmdline = [sys.executable, '-m',
                basic_simulation.__name__, #basic_simulation.__file__,
-               '-i={}'.format(injection),
-               '--save-vm={}'.format(result),
     ] + params
     print('+', ' '.join(shlex.quote(term) for term in cmdline), flush=True)  # shell command print for debug use.
     #logger.debug("Seralized params:\n {}".format(params))
     logger.debug("Basic_simulation command:\n {}".format(cmdline))
+    # No chdir: the working directory is shared by all threads of the process
+    subprocess.check_call(cmdline, cwd=dirname, env=env)
+    return _load_execute_result(p, start)
+
+def execute_persistent(p):
+    """Like execute, but run basic_simulation in the calling process
+
+    The first call in a given (pool worker) process pays for importing
+    moose and moose_nerp, later calls only rebuild and run the model, or
+    only run it if the previous call used the same parameters (see
+    basic_simulation.main). The saved traces are the same as with
+    execute. The working directory of the process is changed while the
+    model runs, so this must not be used from threads.
+    """
+    from . import basic_simulation
+    start = time.time()
+    dirname = p[0]
+    args = _prepare_execute(p)
+    logger.debug("Basic_simulation in-process arguments:\n {}".format(args))
     with utilities.chdir(dirname):
-        subprocess.check_call(cmdline,env=os.environ) # 'env' updates environment with PYTHONPATH
-        iv = load_simulation(result,
-                             simtime=simtime,
-                             junction_potential=junction_potential,
-                             features=features)
+        basic_simulation.main(args, persistent=True)
+        iv = _load_execute_result(p, start)
     return iv
 
 def load_simulation(ivfile, simtime, junction_potential, features):
     injection_current = iv_filename_to_current(ivfile)
     voltage = np.load(ivfile)
-    x = np.linspace(0, float(simtime), voltage.size)
+    x = loader.Timebase(0, float(simtime), voltage.size)
     logger.debug("type of voltage {} type of junction_potential {}".format(type(voltage),
                                                                            type(junction_potential)))
     iv = loader.IVCurve(None, None,
                         injection=injection_current,
                         x=x, y=voltage - float(junction_potential),
-                        features=features)
+                        features=features, dtype=TRACE_DTYPE)
     return iv
 
+# Name of the TraceStore in the fit directory, used with trace_store=True
+TRACE_STORE = 'traces.dat'
+
+# The dtype of loaded simulated voltages, np.float32 halves their memory
+TRACE_DTYPE = None
+
+stored_trace = collections.namedtuple('stored_trace', 'key injection simulation_time')
+
+def load_stored_simulation(store, key, injection, simtime, features):
+    """Like load_simulation, but for a trace in a TraceStore
+
+    The junction potential was already subtracted when the trace was
+    stored, the voltage is a view of the memory mapped store.
+    """
+    voltage = store.get(key, injection)
+    x = loader.Timebase(0, float(simtime), voltage.size)
+    return loader.IVCurve(None, None,
+                          injection=injection,
+                          x=x, y=voltage,
+                          features=features, dtype=TRACE_DTYPE)
+
 
 class Simulation(loader.Attributable):
     def __init__(self, dir, *, params, constant=None, features):
@@ -134,17 +239,28 @@ class Simulation(loader.Attributable):
             self.__class__.__name__,
             self.tmpdir, self._param_str())
 
+    # per-task timeout for futures returned by map_func
+    timeout = 300
+
     def wait(self):
         if self._result is not None:
             if type(self._result)==list:
-                import concurrent.futures
-                concurrent.futures.wait(self._result,timeout=300)
-                result = [f.result() for f in self._result]
+                result = executors.wait(self._result, timeout=self.timeout)
                 self._set_result(result)
+                self._result = None
 
             else:
                 self._result.wait()
 
+    def ready(self):
+        "Check if all traces are available, i.e. wait() would not block"
+        result = getattr(self, '_result', None)
+        if result is None:
+            return True
+        if type(result) == list:
+            return all(f.done() for f in result)
+        return result.ready()
+
 class MooseSimulation(Simulation):
     def __init__(self, dir,
                  currents=None,
@@ -157,7 +273,10 @@ class MooseSimulation(Simulation):
                  do_async=True,
                  features=None,
                  params,
-                 map_func=None):
+                 map_func=None,
+                 persistent=False,
+                 batch=False,
+                 trace_store=False):
 
         junction_potential = params['junction_potential'].value # FIXME: nicer syntax?
         params = filtereddict(simtime=simtime,
@@ -165,6 +284,11 @@ class MooseSimulation(Simulation):
                               injection_width=injection_width,   #SRIRAM 02192018
                               **dict(params.items()))
         super().__init__(dir, params=params, features=features)
+        self._execute = execute_persistent if persistent else execute
+        self._batch = batch
+        # all simulations in dir append their traces to one TraceStore
+        self._trace_store = (os.path.abspath(os.path.join(dir, TRACE_STORE))
+                             if trace_store else None)
 
         if currents is None:
             self.waves = np.array([], dtype=object)
@@ -173,37 +297,61 @@ class MooseSimulation(Simulation):
             self.execute_for(currents, junction_potential, single, do_async=do_async,map_func=map_func)
 
     def execute_for(self, injection_currents, junction_potential, single, do_async,map_func=None):
-        params = ((self.tmpdir.name, inj, junction_potential, self.params, self.features)
+        if self._batch:
+            # one job which builds the model once and loops over the currents
+            injection_currents = [tuple(injection_currents)]
+        params = ((self.tmpdir.name, inj, junction_potential, self.params, self.features,
+                   self._trace_store)
                   for inj in injection_currents)
         if map_func is not None:
             logger.debug("MooseSimulation, Params in execute_for \n {}".format(params)) #SRIRAM
-            self._result = map_func(execute, params)
-            #self._result[-1].add_done_callback(self._map_func_set_result)
+            self._result = map_func(self._execute, params)
     
 
         elif do_async:
             logger.debug("MooseSimulation, Params in execute_for \n {}".format(params)) #SRIRAM
-            self._result = exe_map(single=False, do_async=True,map_func=map_func)(execute, params, callback=self._set_result)
+            # each current is a separate task in the executor queue shared by
+            # all candidates, so idle workers pick up currents of other candidates
+            self.timeout = get_executor().timeout
+            self._result = exe_map(single=False, do_async=True,map_func=map_func)(self._execute, params)
         else:
             self._result = None
             logger.debug("MooseSimulation, Params in execute_for \n {} featues {}".format(self.params, self.features)) #SRIRAM
-            result = exe_map(single=single, do_async=False,map_func=map_func)(execute, params)
+            result = exe_map(single=single, do_async=False,map_func=map_func)(self._execute, params)
             self._set_result(result)
 
-    def _map_func_set_result(self, result):
-        import concurrent.futures
-        concurrent.futures.wait(self._result,timeout=300)
-        self._set_result(self._result)
-
     def _set_result(self, result):
+        if self._batch:
+            result = list(itertools.chain.from_iterable(result))
+        if self._trace_store is not None:
+            result = [self._load_stored(r) for r in result]
         self.waves = np.array(result, dtype=object)
 
         tag = os.path.join(self.tmpdir.name, '.complete')
         open(tag, 'w').close()
 
+    def _load_stored(self, trace):
+        store = tracestore.open_store(self._trace_store)
+        iv = load_stored_simulation(store, trace.key, trace.injection,
+                                    simtime=self.params['simtime'],
+                                    features=self.features)
+        iv.simulation_time = trace.simulation_time
+        return iv
+
     @classmethod
-    def make(cls, *, dir, model, measurement, params,map_func=None):
-        # A hack wrapper to push moose-specific stuff out from Fit
+    def make(cls, *, dir, model, measurement, params,map_func=None, persistent=False, batch=False,
+             trace_store=False, features=None):
+        # A hack wrapper to push moose-specific stuff out from Fit.
+        # Use functools.partial(MooseSimulation.make, persistent=True) as
+        # _make_simulation to run simulations inside the pool workers,
+        # batch=True to simulate all currents with one model build,
+        # and trace_store=True to keep the traces of the whole fit in
+        # one memory mapped file instead of ivdata-*.npy files.
+        # features defaults to the features of the measurement.
+        if persistent and map_func is None and isinstance(get_executor(), executors.ThreadExecutor):
+            # execute_persistent changes the working directory of the
+            # process and MOOSE is not thread safe
+            raise ValueError('persistent simulations cannot run in a ThreadExecutor')
         simtime = measurement.waves[0].time
         injection_delay=measurement.features[0].injection_start,    #SRIRAM 02192018
         injection_width=measurement.features[0].injection_interval,  #SRIRAM 02192018
@@ -218,24 +366,30 @@ class MooseSimulation(Simulation):
                    injection_width=injection_width,  #SRIRAM 02192018
                    currents=measurement.injection,
                    simtime=simtime,
-                   features=measurement.features,
+                   features=features if features is not None else measurement.features,
                    params=params,
-                   map_func=map_func)
+                   map_func=map_func,
+                   persistent=persistent,
+                   batch=batch,
+                   trace_store=trace_store)
 
 class SimulationResult(loader.Attributable):
-    def __init__(self, dirname, features):
+    def __init__(self, dirname, features, params=None, simtime=None):
         self.name = os.path.basename(dirname)
+        self.dirname = dirname
+        self.simtime = simtime
 
         if not isinstance(features, (list, tuple)):
             features = [features, *_features.standard_features]
 
-        jar = os.path.join(dirname, 'params.pickle')
-        if os.path.exists(jar):
-            with open(jar, 'rb') as f:
-                params = pickle.load(f)
-        else:
-            params = {}
-        params = ParamSet(*params)
+        if params is None:
+            jar = os.path.join(dirname, 'params.pickle')
+            if os.path.exists(jar):
+                with open(jar, 'rb') as f:
+                    params = pickle.load(f)
+            else:
+                params = {}
+            params = ParamSet(*params)
 
         super().__init__(features)
         self.features = features
@@ -269,31 +423,92 @@ class SimulationResult(loader.Attributable):
         pass
 
 class MooseSimulationResult(SimulationResult):
-    def __init__(self, dirname, features):
-        super().__init__(dirname, features)
-
-        ivfiles = glob.glob(os.path.join(dirname, 'ivdata-*.npy'))
+    """Traces of a finished simulation, loaded from dirname on first use of .waves
+    """
+    @property
+    @utilities.once
+    def waves(self):
+        simtime = self.simtime if self.simtime is not None else self.params.get('simtime')
+        store = os.path.join(os.path.dirname(self.dirname), TRACE_STORE)
+        if os.path.exists(store) and self.name in tracestore.open_store(store):
+            store = tracestore.open_store(store)
+            waves = [load_stored_simulation(store, self.name, injection,
+                                            simtime=simtime, features=self.features)
+                     for injection in store.injections(self.name)]
+            return np.array(waves, dtype=object)
+
+        ivfiles = glob.glob(os.path.join(self.dirname, 'ivdata-*.npy'))
 
         junction_potential = self.params.get('junction_potential', 0)
-        simtime = self.params.get('simtime')
         waves = [load_simulation(ivfile,
                                  simtime=simtime,
                                  junction_potential=junction_potential,
-                                 features=features)
+                                 features=self.features)
                  for ivfile in ivfiles]
 
         waves.sort(key=operator.attrgetter('injection'))
-        self.waves = np.array(waves, dtype=object)
+        return np.array(waves, dtype=object)
+
+    @waves.setter
+    def waves(self, value):
+        self._waves_value = value
+
+MANIFEST = 'manifest.jsonl'
+
+def append_manifest(dirname, sim, params, fitness):
+    """Record a finished simulation in the manifest of the fit in dirname
+
+    The manifest has one JSON object per line, with the simulation
+    directory, the unscaled parameter values, the injection currents,
+    the simulated time and the fitness.
+    """
+    entry = dict(dir=os.path.basename(sim.tmpdir.name),
+                 params=params,
+                 injections=[wave.injection for wave in sim.waves],
+                 simtime=sim.waves[0].time if len(sim.waves) else None,
+                 fitness=fitness)
+    line = json.dumps(entry, default=lambda o: o.tolist() if hasattr(o, 'tolist') else float(o))
+    with open(os.path.join(dirname, MANIFEST), 'a') as f:
+        f.write(line + '\n')
 
 class SimulationResults(object):
-    def __init__(self, dirname, features, *, constructor=MooseSimulationResult):
+    """The finished simulations in dirname
+
+    If the fit has a manifest and params (the ParamSet of the fit) is
+    given, results are read from the manifest. Each call to load only
+    reads the entries appended since the previous call, and the traces
+    are only read when .waves is used. Directories with a .complete tag
+    which are not in the manifest (e.g. from before it was started) are
+    loaded too. Without a manifest all directories with a .complete tag
+    are loaded.
+
+    With last, only the newest last results are loaded, the older ones
+    are kept for the next call.
+    """
+    def __init__(self, dirname, features, *, constructor=MooseSimulationResult, params=None):
         self.dirname = dirname
         self.features = features
         self._constructor = constructor
-
-    def _dirs(self, last=None):
+        self.params = params
+        self._manifest_offset = 0
+        self._pending = []
+        self._seen = set()
+
+    def _manifest_entries(self):
+        entries = []
+        with open(os.path.join(self.dirname, MANIFEST), 'rb') as f:
+            f.seek(self._manifest_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break       # still being written
+                entries.append(json.loads(line.decode()))
+                self._manifest_offset += len(line)
+        return entries
+
+    def _dirs(self, last=None, exclude=()):
         paths = glob.glob(os.path.join(self.dirname, '*/.complete'))
         dirs = (os.path.dirname(path) for path in paths)
+        dirs = [dir for dir in dirs if dir not in exclude]
         # sort by the simulation initialization order
         compare = lambda dir: os.stat(os.path.join(dir, 'params.pickle')).st_mtime
         ans = sorted(dirs, key=compare)
@@ -303,6 +518,35 @@ class SimulationResults(object):
             return ans[-last:]
 
     def load(self, last=None):
+        if self.params is not None and os.path.exists(os.path.join(self.dirname, MANIFEST)):
+            entries = [(os.path.join(self.dirname, entry['dir']), entry)
+                       for entry in self._manifest_entries()]
+            listed = {dir for dir, entry in entries}
+            # a directory found by glob earlier may have been added to the manifest since
+            items = [item for item in self._pending if item[0] not in listed] + entries
+            known = self._seen.union(dir for dir, entry in items)
+            items.extend((dir, None) for dir in self._dirs(exclude=known))
+
+            if last is not None:
+                self._pending, items = items[:-last], items[-last:]
+            else:
+                self._pending = []
+            n = len(items)
+            for i, (dir, entry) in enumerate(items):
+                if dir in self._seen:
+                    continue
+                self._seen.add(dir)
+                if entry is None:
+                    sim = self._constructor(dir, self.features)
+                else:
+                    sim = self._constructor(dir,
+                                            self.features,
+                                            params=self.params.updated(**entry['params']),
+                                            simtime=entry.get('simtime'))
+                    sim.fitness = entry['fitness']
+                yield i, n, sim
+            return
+
         dirs = self._dirs(last=last)
         n = len(dirs)
         for i, dir in enumerate(dirs):
@@ -456,28 +700,98 @@ class ParamSet:
     def scaled(self):
         return self.scale(p.value for p in self.ajuparams)
 
+    @property
+    @utilities.once
+    def _scaling(self):
+        """Per-parameter arrays describing the scaling of ajuparams
+
+        Each parameter is scaled linearly to [0, 10] between min and max,
+        logarithmically if min > 0 and max/min >= 10, or divided by the
+        power of ten of its starting value if it has no bounds.
+        """
+        linear, log, factor = [], [], []
+        for i, p in enumerate(self.ajuparams):
+            if p.min is None or p.max is None:
+                factor.append((i, p._scaling, 0))
+            elif p.min <= 0 or p.max / p.min < 10.0:
+                linear.append((i, p.min, p.max))
+            else:
+                log.append((i, p.min, p.max))
+        groups = []
+        for kind, items in (('linear', linear), ('log', log), ('factor', factor)):
+            if items:
+                index, lo, hi = (np.array(col) for col in zip(*items))
+                groups.append((kind, index.astype(int), lo.astype(float), hi.astype(float)))
+        return groups
+
+    def scale_array(self, values):
+        "Scale an (..., P) array of values of the ajuparams in one go"
+        values = np.asarray(values, dtype=float)
+        assert values.shape[-1:] == (len(self.ajuparams),), values.shape
+        out = np.empty_like(values)
+        for kind, index, lo, hi in self._scaling:
+            v = values[..., index]
+            if kind == 'linear':
+                out[..., index] = 10.0 * (v - lo) / (hi - lo)
+            elif kind == 'log':
+                out[..., index] = np.log10(v / lo) / np.log10(hi / lo) * 10.0
+            else:
+                out[..., index] = v / lo
+        return out
+
+    def unscale_array(self, scaled_values):
+        """Unscale an (..., P) array of scaled values in one go
+
+        >>> params.unscale_array(optimizer.ask())   # (popsize, P)
+        """
+        scaled_values = np.asarray(scaled_values, dtype=float)
+        assert scaled_values.shape[-1:] == (len(self.ajuparams),), scaled_values.shape
+        out = np.empty_like(scaled_values)
+        for kind, index, lo, hi in self._scaling:
+            v = scaled_values[..., index]
+            if kind == 'linear':
+                out[..., index] = lo + (hi - lo) * v / 10.0
+            elif kind == 'log':
+                out[..., index] = lo * (hi / lo) ** (v / 10.0)
+            else:
+                out[..., index] = v * lo
+        return out
+
     def scale(self, values):
         assert (isinstance(values, types.GeneratorType) or
                 len(values) == len(self.ajuparams)), values
-        return [p.scale(v) for p, v in zip(self.ajuparams, values)]
+        return self.scale_array(list(values)).tolist()
 
     def scale_dict(self, values):
         return self.scale(values[p.name] for p in self.ajuparams)
 
     def unscale(self, scaled_values):
         assert len(scaled_values) == len(self.ajuparams)
-        return [p.unscale(v) for p, v in zip(self.ajuparams, scaled_values)]
+        return self.unscale_array(scaled_values).tolist()
+
+    @property
+    @utilities.once
+    def _dependent_params(self):
+        "Values of fixedparams and the constrained params, in unscaled_dict order"
+        fixed = [(p.name, p.value) for p in self.fixedparams]
+        constrained = [(p.name, p.constant, p.fixed) for p in self.constrainparams]
+        return fixed, constrained
 
     def unscaled_dict(self, scaled_values):
         assert len(scaled_values) == len(self.ajuparams)
-        x=((p.name, p.unscale(v)) for (p,v) in zip(self.ajuparams, scaled_values))
-        y=((p.name, p.value) for p in self.fixedparams)
-        X={p.name : p.unscale(v) for (p,v) in zip(self.ajuparams, scaled_values)}
-        Y={p.name : p.value for p in self.fixedparams}
-        X.update(Y)
-        yy=((p.name, p.constant*X[p.fixed]) for p in self.constrainparams)
-        X.update({p.name: p.constant*X[p.fixed] for p in self.constrainparams})
-        Z={}
+        return self._unscaled_dict(self.unscale(scaled_values))
+
+    def unscaled_dicts(self, population):
+        "unscaled_dict for each row of an (N, P) array of scaled values"
+        return [self._unscaled_dict(values)
+                for values in self.unscale_array(population).tolist()]
+
+    def _unscaled_dict(self, values):
+        fixed, constrained = self._dependent_params
+        X = collections.OrderedDict(zip((p.name for p in self.ajuparams), values))
+        X.update(fixed)
+        for name, constant, other in constrained:
+            X[name] = constant * X[other]
         total=0
         for param in self.summedparams:
             for amount in param.fixed['molecules']:
@@ -485,10 +799,8 @@ class ParamSet:
                     total+=(X[amount]/param.fixed['radius'])
                 else:
                     total+=X[amount]
-            Z.update({param.name: total})
-        z=((p.name, p.constant-Z[p.name]) for p in self.summedparams)
-        gen = itertools.chain(x,y,yy,z)
-        return collections.OrderedDict(gen)
+            X[param.name] = param.constant - total
+        return X
 
     def updated(self, **kwargs):
         args = (p.updated(kwargs[p.name]) if p.name in kwargs else p
@@ -530,14 +842,39 @@ class ParamSet:
                       for p in self.params)
         return 'ParamSet ' + vv
 
+generation_stats = collections.namedtuple('generation_stats',
+                                          'wall busy workers utilisation '
+                                          'finish_median finish_max straggler')
+
+def _generation_stats(sims, finished, wall, workers):
+    """Summarize the timing of one generation of simulations
+
+    finished holds the time (since the start of the generation) when
+    the traces of each sim became available. busy is the sum of
+    simulation_time of all traces and utilisation is busy divided by the
+    available worker time. The straggler is the index of the slowest sim.
+    """
+    busy = sum(getattr(wave, 'simulation_time', 0)
+               for sim in sims for wave in sim.waves)
+    finished = np.array(finished)
+    utilisation = busy / (wall * workers) if wall > 0 else np.nan
+    return generation_stats(wall, busy, workers, utilisation,
+                            np.median(finished), finished.max(),
+                            finished.argmax())
+
 class Fit:
     fitness_max = 200
+    generation_poll_interval = 0.02
+    # in asynchronous mode, results of candidates sampled before the
+    # last max_result_age updates of the distribution are not told
+    max_result_age = 1
 
     def __init__(self, dirname, measurement, model, neuron_type, fitness_func, params,
                  feature_list=None,
                  _make_simulation=None,
                  _result_constructor=MooseSimulationResult,
-                 map_func = None):
+                 map_func = None,
+                 cache=None):
         self.dirname = dirname
         self.measurement = measurement
         self.model = model
@@ -545,27 +882,46 @@ class Fit:
         self.fitness_func = fitness_func
         self.params = params
         self._history = []
+        self._generation_stats = []
         self._async = False
+        self._untold = []
         self.optimizer = None
         self._make_simulation = _make_simulation
         self._result_constructor = _result_constructor
         self.map_func = map_func
+        if isinstance(cache, str):
+            cache = _cache.EvaluationCache(cache)
+        self.cache = cache
+
+        # Only the features needed for the attributes which the fitness
+        # function requires are attached to the simulations, unless
+        # feature_list is given. Without requires all features are used.
+        if feature_list is None:
+            requires = getattr(fitness_func, 'requires', None)
+            feature_list = (loader.required_features(measurement.features, requires)
+                            if requires is not None else measurement.features)
+        self.features = tuple(feature_list)
 
         # we assume that the first param value does not need penalties
         self._fitness_worst = None
         utilities.mkdir_p(dirname)
 
+        # the measurement side of the fitness functions is computed only once
+        self.measurement_profile = (
+            fitnesses.MeasurementProfile(measurement, getattr(fitness_func, 'requires', None))
+            if isinstance(measurement, loader.Measurement) else None)
+
     def load(self, last=None):
         try:
             self._sim_value
         except AttributeError:
             self._sim_value = collections.OrderedDict()
-
-        new = SimulationResults(self.dirname,
-                                features=self.measurement.features,
-                                constructor=self._result_constructor)
+            self._results = SimulationResults(self.dirname,
+                                              features=self.features,
+                                              constructor=self._result_constructor,
+                                              params=self.params)
         need_erase = False
-        for i, n, sim in new.load(last=last):
+        for i, n, sim in self._results.load(last=last):
             print('{}/{} {}'.format(i, n, sim.name), end='\r')
             need_erase = True
             key = tuple(sim.params.scaled)
@@ -580,17 +936,34 @@ class Fit:
     def param_names(self):
         return [p.name for p in self.params.ajuparams]
 
+    def _cache_key(self, params):
+        features = self.measurement.features[0]
+        return self.cache.key(params,
+                              model=self.model,
+                              neuron_type=self.neuron_type,
+                              simtime=self.measurement.waves[0].time,
+                              injections=tuple(self.measurement.injection),
+                              injection_start=getattr(features, 'injection_start', None),
+                              injection_interval=getattr(features, 'injection_interval', None))
+
     @utilities.cached
     def sim(self, scaled_params):
         unscaled = self.params.unscaled_dict(scaled_params)
+        params = self.params.updated(**unscaled)
+        if self.cache is not None:
+            sim = self.cache.load(self._cache_key(params), params, self.features)
+            if sim is not None:
+                return sim
         sim = self._make_simulation(dir=self.dirname,
                                     model=self.model,
                                     measurement=self.measurement,
-                                    params=self.params.updated(**unscaled),
-                                    map_func=self.map_func) #define params here SRIRAM
+                                    params=params,
+                                    map_func=self.map_func,
+                                    features=self.features) #define params here SRIRAM
         return sim
 
     def sim_fitness(self, sim, full=False, max_fitness=None):
+        sim.wait()
         fitness = self.fitness_func(sim, self.measurement, full=full)
         if full and max_fitness is not None:
             for i in range(len(fitness)):
@@ -606,7 +979,28 @@ class Fit:
     @utilities.cached
     def fitness(self, scaled_params):
         sim = self.sim(scaled_params)
-        return self.sim_fitness(sim)
+        if self.cache is None:
+            fitness = self.sim_fitness(sim)
+            self._record(scaled_params, sim, fitness)
+            return fitness
+
+        key = self._cache_key(self.params.updated(**self.params.unscaled_dict(scaled_params)))
+        signature = _cache.fitness_signature(self.fitness_func, self.measurement)
+        fitness = self.cache.fitness(key, signature)
+        if fitness is not None:
+            self._history.append(fitness)
+            return fitness
+        fitness = self.sim_fitness(sim)
+        self._record(scaled_params, sim, fitness)
+        if key not in self.cache:
+            self.cache.store(key, sim, self.measurement.waves[0].time)
+        self.cache.store_fitness(key, signature, fitness)
+        return fitness
+
+    def _record(self, scaled_params, sim, fitness):
+        # Simulations restored from the cache have no directory of their own
+        if hasattr(sim, 'tmpdir'):
+            append_manifest(self.dirname, sim, self.params.unscaled_dict(scaled_params), fitness)
 
     @utilities.cached
     def fitness_full(self, scaled_params):
@@ -619,6 +1013,7 @@ class Fit:
         sim = self.sim(scaled_params)
         ans = self.sim_fitness(sim, full=True, max_fitness=18)
         ans[np.isnan(ans)] = self.fitness_max
+        self._record(scaled_params, sim, ans)
         if self._fitness_worst is None:
             self._fitness_worst = ans
         else:
@@ -630,10 +1025,34 @@ class Fit:
     def fitness_multi(self, many_values):
         self._async = True
         #many values is the population_size set of parameter values
+        start = time.time()
         sims = [self.sim(values) for values in many_values]
-        for sim in sims:
-            sim.wait()
-        results = [self.fitness(values) for values in many_values]
+        results = [None] * len(sims)
+        finished = [None] * len(sims)
+        pending = list(range(len(sims)))
+        # All currents of all candidates are queued in the pool at this
+        # point. Compute the fitness of each candidate as soon as its
+        # traces are done, while the rest are still being simulated.
+        while pending:
+            done = [i for i in pending if sims[i].ready()]
+            if not done:
+                time.sleep(self.generation_poll_interval)
+                continue
+            now = time.time() - start
+            for i in done:
+                finished[i] = now
+            for i in done:
+                sims[i].wait()
+                results[i] = self.fitness(many_values[i])
+                pending.remove(i)
+
+        stats = _generation_stats(sims, finished, time.time() - start,
+                                  exe_workers(self.map_func))
+        self._generation_stats.append(stats)
+        logger.info('generation: {:.1f} s wall, {} workers, {:.0%} utilisation, '
+                    'candidates done after {:.1f} s (median) {:.1f} s (max, #{})'.format(
+                        stats.wall, stats.workers, stats.utilisation,
+                        stats.finish_median, stats.finish_max, stats.straggler))
         return results
 
     def finished(self):
@@ -652,7 +1071,26 @@ class Fit:
                 values[i, j] = item.params[param].value
         return values
 
-    def do_fit(self, count, params=None, sigma=2, popsize=8, seed=123):
+    def do_fit(self, count, params=None, sigma=2, popsize=8, seed=123,
+               asynchronous=False, inflight=None):
+        """Run count generations of CMA-ES
+
+        With asynchronous=True, candidates are not simulated in lockstep
+        generations: inflight candidates (popsize by default, more to
+        oversample) are kept running, a new one is sampled as soon as one
+        finishes, and the optimizer is told the first popsize results
+        that come in. Slow candidates are told in a later generation,
+        unless they were sampled more than max_result_age generations
+        before, then they are only kept in the fit history. After the
+        last generation, the candidates still running are waited for,
+        and the results not told yet are told in one more update if
+        there are enough of them for CMA-ES (at least mu). Otherwise they
+        are told by the next asynchronous do_fit.
+
+        There is no completion callback: a candidate only gets its waves
+        and the .complete tag in its directory when Simulation.wait() is
+        called, which Fit.fitness does once sim.ready() is true.
+        """
         # what is the order of params which position represents which params?
         if self.optimizer is None:
             if params is None:
@@ -660,12 +1098,87 @@ class Fit:
             bounds = self.params.scaled_bounds
             opts = dict(bounds=bounds, popsize=popsize, seed=seed)
             self.optimizer = cma.CMAEvolutionStrategy(params, sigma, opts)
+            self._untold = []
 
-        for i in range(count):
-            if self.optimizer.stop():
-                break
-            points = self.optimizer.ask()
-            values = self.fitness_multi(points) # runs simulation and computes total fitness across featuers.
-            self.optimizer.tell(points, values)
-            self.optimizer.logger.add()  # write plottable data to disc.
-            self.optimizer.disp()
+        start = time.time()
+        if asynchronous:
+            evaluations = self._do_fit_async(count, inflight or self.optimizer.popsize)
+        else:
+            evaluations = 0
+            for i in range(count):
+                if self.optimizer.stop():
+                    break
+                points = self.optimizer.ask()
+                values = self.fitness_multi(points) # runs simulation and computes total fitness across featuers.
+                self.optimizer.tell(points, values)
+                self.optimizer.logger.add()  # write plottable data to disc.
+                self.optimizer.disp()
+                evaluations += len(points)
+
+        elapsed = time.time() - start
+        if elapsed > 0:
+            logger.info('{} mode: {} evaluations in {:.0f} s, {:.0f} evaluations/hour'.format(
+                'asynchronous' if asynchronous else 'synchronous',
+                evaluations, elapsed, evaluations / elapsed * 3600))
+
+    def _do_fit_async(self, count, inflight):
+        self._async = True
+        popsize = self.optimizer.popsize
+        queued = []             # sampled from the current distribution, not started yet
+        running = []            # (point, generation, sim)
+        untold = self._untold   # (point, generation, value), finished, not told yet
+        generations = evaluations = 0
+
+        while generations < count and not self.optimizer.stop():
+            while len(running) < inflight:
+                if not queued:
+                    queued = list(self.optimizer.ask())
+                point = queued.pop()
+                running.append((point, self.optimizer.countiter, self.sim(point)))
+
+            ready = [sim.ready() for point, generation, sim in running]
+            if not any(ready):
+                time.sleep(self.generation_poll_interval)
+                continue
+            for (point, generation, sim), done in zip(running, ready):
+                if done:
+                    untold.append((point, generation, self.fitness(point)))
+                    evaluations += 1
+            running = [item for item, done in zip(running, ready) if not done]
+            self._drop_stale()
+
+            if len(untold) >= popsize:
+                self._tell(untold[:popsize])
+                del untold[:popsize]
+                # the distribution has changed, and cma needs an ask before the next tell
+                queued = list(self.optimizer.ask())
+                generations += 1
+
+        # let the simulations which are still running finish, and tell
+        # the leftover results if there are enough for CMA-ES
+        for point, generation, sim in running:
+            untold.append((point, generation, self.fitness(point)))
+            evaluations += 1
+        self._drop_stale()
+        if len(untold) >= self.optimizer.sp.weights.mu:
+            self._tell(untold)
+            del untold[:]
+        elif untold:
+            logger.info('{} results are too few for another CMA-ES update, '
+                        'they are kept for the next do_fit'.format(len(untold)))
+        return evaluations
+
+    def _drop_stale(self):
+        "Forget the untold results sampled more than max_result_age generations ago"
+        generation = self.optimizer.countiter
+        fresh = [item for item in self._untold
+                 if generation - item[1] <= self.max_result_age]
+        if len(fresh) < len(self._untold):
+            logger.debug('dropping {} stale results'.format(len(self._untold) - len(fresh)))
+            self._untold[:] = fresh
+
+    def _tell(self, results):
+        self.optimizer.tell([point for point, generation, value in results],
+                            [value for point, generation, value in results])
+        self.optimizer.logger.add()  # write plottable data to disc.
+        self.optimizer.disp()
@@ -1,7 +1,28 @@
 # http://wiki.scipy.org/Cookbook/SignalSmooth
 
+import functools
 import numpy
 
+WINDOWS = ('flat', 'hanning', 'hamming', 'bartlett', 'blackman')
+
+@functools.lru_cache(maxsize=None)
+def window_kernel(window_len, window='hanning'):
+    """The normalized convolution kernel used by smooth
+
+    Kernels are computed once for every (window_len, window) and
+    returned read-only.
+    """
+    if not window in WINDOWS:
+        raise ValueError("Window is not one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
+
+    if window == 'flat': #moving average
+        w=numpy.ones(window_len,'d')
+    else:
+        w=getattr(numpy, window)(window_len)
+    kernel = w/w.sum()
+    kernel.flags.writeable = False
+    return kernel
+
 def smooth(x, window_len=11, window='hanning'):
     """smooth the data using a window with requested size.
 
@@ -44,17 +65,28 @@ def smooth(x, window_len=11, window='hanning'):
     if window_len<3:
         return x
 
+    return smooth_range(x, 0, x.size, window_len, window)
 
-    if not window in ['flat', 'hanning', 'hamming', 'bartlett', 'blackman']:
-        raise ValueError("Window is not one of 'flat', 'hanning', 'hamming', 'bartlett', 'blackman'")
-
+def smooth_range(x, start, stop, window_len=11, window='hanning'):
+    """The same as smooth(x, window_len, window)[start:stop]
 
-    s=numpy.r_[x[window_len-1:0:-1],x,x[-1:-window_len:-1]]
-    #print(len(s))
-    if window == 'flat': #moving average
-        w=numpy.ones(window_len,'d')
+    Only the requested part of the signal is convolved, and the result
+    is identical to smoothing the whole signal.
+    """
+    if window_len<3:
+        return x[start:stop]
+
+    kernel = window_kernel(window_len, window)
+    stop = max(start, min(stop, x.size))
+    if stop == start:
+        return numpy.empty(0)
+
+    # s is x with the reflected ends, output i uses s[i+offset:i+offset+window_len]
+    offset = window_len // 2 - 1
+    lo, hi = start + offset, stop + offset + window_len - 1
+    pad = window_len - 1
+    if lo >= pad and hi <= pad + x.size:
+        s = x[lo - pad:hi - pad]
     else:
-        w=eval('numpy.'+window+'(window_len)')
-
-    y=numpy.convolve(w/w.sum(),s,mode='valid')
-    return y[window_len // 2 - 1 : -window_len//2]
+        s = numpy.r_[x[window_len-1:0:-1],x,x[-1:-window_len:-1]][lo:hi]
+    return numpy.convolve(s,kernel,mode='valid')
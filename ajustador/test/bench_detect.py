@@ -0,0 +1,30 @@
+"""Compare detect.detect_peaks with the sample-by-sample detect_peaks_loop
+
+Run as ``python ajustador/test/bench_detect.py [directory-with-ibw-files]``.
+"""
+import os
+import sys
+import timeit
+
+from igor import binarywave
+
+from ajustador import detect
+
+DEFAULT = os.path.join(os.path.dirname(__file__),
+                       '../../docs/static/recording/042811-6ivifcurves_Waves')
+
+def main(dirname=DEFAULT, number=20):
+    for name in sorted(os.listdir(dirname)):
+        y = binarywave.load(os.path.join(dirname, name))['wave']['wData']
+        old = detect.detect_peaks_loop(y, P_low=0.75, P_high=0.50)
+        new = detect.detect_peaks(y, P_low=0.75, P_high=0.50)
+        assert (old == new).all(), name
+        t_old = timeit.timeit(lambda: detect.detect_peaks_loop(y, P_low=0.75, P_high=0.50),
+                              number=number) / number
+        t_new = timeit.timeit(lambda: detect.detect_peaks(y, P_low=0.75, P_high=0.50),
+                              number=number) / number
+        print('{:30} {:6} samples {:4} peaks  loop {:7.2f} ms  numpy {:6.2f} ms  {:5.1f}x'.format(
+            name, y.size, new.size, t_old * 1e3, t_new * 1e3, t_old / t_new))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
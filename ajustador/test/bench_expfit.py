@@ -0,0 +1,39 @@
+"""Compare features._fit_negative_exp with optimize.curve_fit
+
+Run as ``python ajustador/test/bench_expfit.py``. The curves are
+exponential charging and falling curves with noise, of the lengths
+found in the sample recordings.
+"""
+import timeit
+
+import numpy as np
+from scipy import optimize
+
+from ajustador import features
+
+def curves(seed=0):
+    rng = np.random.RandomState(seed)
+    for size in (100, 1000, 3000, 6000):
+        for amp, tau in ((-0.013, 0.0025), (0.028, 0.013), (0.002, 0.004)):
+            x = 0.2 + np.arange(size) * 1e-4
+            y = features.negative_exp(x, amp, tau) + rng.normal(0, 2e-4, size)
+            yield x, y.astype(np.float32)
+
+def main(number=20):
+    np.seterr(over='ignore')    # curve_fit tries huge exponents from p0
+    for x, y in curves():
+        p0 = (-1, 1) if y[-1] < 0 else (.02, .02)
+        old, old_cov = optimize.curve_fit(features.negative_exp, x, y, p0, maxfev=100000)
+        new, new_cov = features._fit_negative_exp(x, y, p0, maxfev=100000)
+        t_old = timeit.timeit(lambda: optimize.curve_fit(features.negative_exp, x, y, p0,
+                                                         maxfev=100000),
+                              number=number) / number
+        t_new = timeit.timeit(lambda: features._fit_negative_exp(x, y, p0, maxfev=100000),
+                              number=number) / number
+        diff = np.abs(new / old - 1).max()
+        print('{:5} samples  amp {:8.5f}  tau {:.5f}  rel. diff {:.1e}  '
+              'curve_fit {:6.2f} ms  new {:5.2f} ms  {:5.1f}x'.format(
+                  x.size, new[0], new[1], diff, t_old * 1e3, t_new * 1e3, t_old / t_new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Time combined_fitness on the sample recording
+
+Run as ``python ajustador/test/bench_fitness.py [directory-with-ibw-files]``.
+The "simulation" is the recording with a different scale, offset and
+noise. Features are computed before timing, so only the fitness
+functions and the gathering of array attributes are measured. "cold"
+forgets the gathered attributes before every call, "warm" reuses them
+like repeated fitness evaluations of the same simulation do. Both forget
+the values of the fitness functions remembered by combined_fitness,
+"report" is a call of combined_fitness.report which reuses them. "batch"
+rescores a group of simulations with combined_fitness.batch instead of
+one at a time. "features" is the time spent in each of the features
+which a simulation gets in Fit, those needed for the required attributes.
+"""
+import copy
+import os
+import sys
+import timeit
+
+import numpy as np
+
+from ajustador import fitnesses, loader
+
+DEFAULT = os.path.join(os.path.dirname(__file__),
+                       '../../docs/static/recording/042811-6ivifcurves_Waves')
+
+class params:
+    requires = ()
+    provides = ('baseline_before', 'baseline_after',
+                'steady_after', 'steady_before', 'steady_cutoff',
+                'injection_start', 'injection_end', 'injection_interval',
+                'falling_curve_window')
+    baseline_before, baseline_after = 0.2, 0.6
+    steady_after, steady_before, steady_cutoff = 0.25, 0.6, 80
+    injection_start, injection_end, injection_interval = 0.2, 0.6, 0.4
+    falling_curve_window = 20
+    def __init__(self, obj):
+        pass
+
+def load(dirname=DEFAULT):
+    return loader.IVCurveSeries(dirname, params, IV=(-500e-12, 50e-12),
+                                IF=(220e-12, 100e-12), time=0.9)
+
+def perturbed(measurement, shift=0.002, scale=1.05, seed=0, features=None):
+    if features is None:
+        features = measurement.features
+    rng = np.random.RandomState(seed)
+    waves = []
+    for wave in measurement.waves:
+        y = wave.wave.y.astype(float)
+        y = (y - y.mean()) * scale + y.mean() + shift + rng.normal(0, 2e-4, y.size)
+        waves.append(loader.Trace(wave.injection, wave.wave.x, y, features))
+    sim = copy.copy(measurement)
+    sim.waves = np.array(waves, dtype=object)
+    return sim
+
+def forget(*objs):
+    for obj in objs:
+        obj.__dict__.pop('_aggregated', None)
+
+def main(dirname=DEFAULT, number=50):
+    measurement = load(dirname)
+    sim = perturbed(measurement)
+    for preset in ('new_combined_fitness', 'simple_combined_fitness'):
+        fitness = fitnesses.combined_fitness(preset)
+        value = fitness(sim, measurement)
+        def cold():
+            forget(sim, measurement)
+            return warm()
+        def warm():
+            fitness._terms.clear()
+            return fitness(sim, measurement)
+        t_cold = timeit.timeit(cold, number=number) / number
+        t_warm = timeit.timeit(warm, number=number) / number
+        t_report = timeit.timeit(lambda: fitness.report(sim, measurement), number=number) / number
+        print('{:25} fitness {:.6f}  cold {:6.2f} ms  warm {:6.2f} ms  {:5.1f}x  '
+              'report {:6.3f} ms'.format(preset, value, t_cold * 1e3, t_warm * 1e3,
+                                         t_cold / t_warm, t_report * 1e3))
+
+    group = [perturbed(measurement, shift=1e-4 * i, seed=i) for i in range(20)]
+    repeat = max(number // 10, 1)
+    for preset in ('new_combined_fitness', 'simple_combined_fitness'):
+        fitness = fitnesses.combined_fitness(preset)
+        fitness.batch(group, measurement)
+        def loop():
+            fitness._terms.clear()
+            return [fitness(sim, measurement) for sim in group]
+        def batch():
+            fitness._terms.clear()
+            return fitness.batch(group, measurement, full=False)
+        t_loop = timeit.timeit(loop, number=repeat) / repeat
+        t_batch = timeit.timeit(batch, number=repeat) / repeat
+        print('{:25} {} sims  loop {:6.2f} ms  batch {:6.2f} ms  {:5.1f}x'.format(
+            preset, len(group), t_loop * 1e3, t_batch * 1e3, t_loop / t_batch))
+
+    for preset in ('new_combined_fitness', 'simple_combined_fitness'):
+        requires = fitnesses.combined_fitness(preset).requires
+        needed = loader.required_features(measurement.features, requires)
+        times = loader.feature_times(perturbed(measurement, features=needed), requires)
+        print('{:25} features {}'.format(
+            preset, '  '.join('{} {:.2f} ms'.format(name, t * 1e3)
+                              for name, t in times.items())))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,53 @@
+"""Compare the ways of running basic_simulation for a few injection currents
+
+Run as ``python ajustador/test/bench_persistent.py [model] [neuron-type]``.
+"fresh" starts ``python -m ajustador.basic_simulation`` for each current,
+like optimize.execute. "rebuild" runs each current with other model
+parameters in one process, like optimize.execute_persistent for
+alternating candidates, "reuse" with the same parameters, like
+execute_persistent for the currents of one candidate. "batch" builds
+the model once for an --injection-currents call with all currents.
+"""
+import subprocess
+import sys
+import tempfile
+import time
+
+from ajustador import basic_simulation, utilities
+
+CURRENTS = -2e-10, -1e-10, 1e-10, 2e-10
+
+def fresh(options, dirname):
+    for i in CURRENTS:
+        subprocess.check_call([sys.executable, '-m', basic_simulation.__name__,
+                               *options, '-i={}'.format(i)], cwd=dirname)
+
+def persistent(options, dirname, rebuild):
+    for n, i in enumerate(CURRENTS):
+        extra = ['--RA={}'.format(4 + n % 2)] if rebuild else []
+        basic_simulation.main(options + extra + ['-i={}'.format(i)], persistent=True)
+
+def batch(options, dirname):
+    basic_simulation.main(options + ['--RA=6', '--injection-currents=' +
+                                     ','.join(str(i) for i in CURRENTS)],
+                          persistent=True)
+
+def main(model='d1d2', neuron_type='D1'):
+    options = ['--model={}'.format(model), '--neuron-type={}'.format(neuron_type),
+               '--simtime=0.35']
+    runs = [('fresh', fresh),
+            ('rebuild', lambda *args: persistent(*args, rebuild=True)),
+            ('reuse', lambda *args: persistent(*args, rebuild=False)),
+            ('batch', batch)]
+    with tempfile.TemporaryDirectory() as dirname, utilities.chdir(dirname):
+        # import moose and the model once, so "rebuild" does not pay for it
+        persistent(options, dirname, rebuild=True)
+        for name, func in runs:
+            start = time.time()
+            func(options, dirname)
+            elapsed = time.time() - start
+            print('{:8} {} currents {:7.2f} s  {:6.2f} s per current'.format(
+                name, len(CURRENTS), elapsed, elapsed / len(CURRENTS)))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
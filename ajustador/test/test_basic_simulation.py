@@ -0,0 +1,53 @@
+import concurrent.futures
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('moose')
+pytest.importorskip('moose_nerp.d1d2')
+
+from ajustador import basic_simulation
+
+MODEL = ['--model=d1d2', '--neuron-type=D1', '--simtime=0.35']
+CURRENTS = -2e-10, 2e-10
+
+def fresh(dirname, *args):
+    "Run basic_simulation in a new process, like optimize.execute"
+    subprocess.check_call([sys.executable, '-m', basic_simulation.__name__, *MODEL, *args],
+                          cwd=str(dirname))
+
+def persistent(runs):
+    for args in runs:
+        basic_simulation.main(MODEL + args, persistent=True)
+
+def test_persistent_runs_match_fresh(tmp_path):
+    for i in CURRENTS:
+        fresh(tmp_path, '-i={}'.format(i), '--save-vm=fresh-{}.npy'.format(i))
+
+    # a model with other parameters first, then the same runs twice,
+    # all in one long-lived worker like execute_persistent uses
+    runs = [['-i=1e-10', '--RA=5', '--save-vm={}'.format(tmp_path / 'other.npy')]]
+    for k in range(2):
+        runs += [['-i={}'.format(i),
+                  '--save-vm={}'.format(tmp_path / 'persistent{}-{}.npy'.format(k, i))]
+                 for i in CURRENTS]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+        pool.submit(persistent, runs).result()
+
+    for i in CURRENTS:
+        expected = np.load(str(tmp_path / 'fresh-{}.npy'.format(i)))
+        for k in range(2):
+            vm = np.load(str(tmp_path / 'persistent{}-{}.npy'.format(k, i)))
+            assert np.array_equal(vm, expected)
+
+def test_injection_currents_match_single_runs(tmp_path):
+    for i in CURRENTS:
+        fresh(tmp_path, '-i={}'.format(i), '--save-vm=single-{}.npy'.format(i))
+    fresh(tmp_path, '--injection-currents=' + ','.join(str(i) for i in CURRENTS),
+          '--save-vm=batch-{}.npy')
+
+    for i in CURRENTS:
+        assert np.array_equal(np.load(str(tmp_path / 'batch-{}.npy'.format(i))),
+                              np.load(str(tmp_path / 'single-{}.npy'.format(i))))
@@ -0,0 +1,63 @@
+import collections
+
+import numpy as np
+
+from ajustador import cache, loader
+
+class FakeSim:
+    def __init__(self, waves):
+        self.waves = waves
+        self.params = collections.OrderedDict(RA=1.5, RM=2.5)
+
+def make_wave(injection, n):
+    x = np.linspace(0, 0.9, n)
+    return loader.IVCurve(None, None, injection=injection,
+                          x=x, y=np.sin(x * injection * 1e10), features=())
+
+def test_key():
+    a = cache.EvaluationCache.key({'RA': 1.5, 'RM': 2.5}, model='d1d2', simtime=0.9)
+    b = cache.EvaluationCache.key({'RM': 2.5, 'RA': 1.5}, simtime=0.9, model='d1d2')
+    c = cache.EvaluationCache.key({'RM': 2.5, 'RA': 1.5000001}, simtime=0.9, model='d1d2')
+    assert a == b
+    assert a != c
+
+def test_store_and_load(tmpdir):
+    store = cache.EvaluationCache(str(tmpdir.join('cache.sqlite')))
+    sim = FakeSim([make_wave(-2e-10, 100), make_wave(3e-10, 100)])
+
+    assert store.load('abc', sim.params, ()) is None
+    store.store('abc', sim, 0.9)
+    store.store_fitness('abc', 'f', 0.25)
+    assert 'abc' in store and len(store) == 1
+
+    # a new connection sees the same data
+    store = cache.EvaluationCache(store.filename)
+    loaded = store.load('abc', sim.params, ())
+    assert [w.injection for w in loaded.waves] == [-2e-10, 3e-10]
+    for w1, w2 in zip(loaded.waves, sim.waves):
+        np.testing.assert_array_equal(w1.wave.x, w2.wave.x)
+        np.testing.assert_array_equal(w1.wave.y, w2.wave.y)
+    assert store.fitness('abc', 'f') == 0.25
+    assert store.fitness('abc', 'g') is None
+
+def test_key_numpy_scalars():
+    a = cache.EvaluationCache.key({'RA': 1.5}, simtime=0.9, injections=(-2e-10, 3e-10))
+    b = cache.EvaluationCache.key({'RA': np.float64(1.5)}, simtime=np.float64(0.9),
+                                  injections=tuple(np.array([-2e-10, 3e-10])))
+    assert a == b
+
+class FakeMeasurement:
+    def __init__(self, dirname, waves):
+        self.dirname = dirname
+        self.waves = waves
+
+def test_fitness_signature_measurement():
+    def fitness(sim, measurement):
+        pass
+    waves = [make_wave(-2e-10, 100), make_wave(3e-10, 100)]
+    other = [make_wave(-2e-10, 100), make_wave(3e-10, 101)]
+    sig = cache.fitness_signature(fitness, FakeMeasurement('d1', waves))
+    assert sig == cache.fitness_signature(fitness, FakeMeasurement('d1', list(waves)))
+    assert sig != cache.fitness_signature(fitness, FakeMeasurement('d2', waves))
+    assert sig != cache.fitness_signature(fitness, FakeMeasurement('d1', other))
+    assert sig.startswith(cache.fitness_signature(fitness))
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from ajustador import detect
+
+def traces():
+    rng = np.random.RandomState(1)
+    for k in range(60):
+        y = np.cumsum(rng.normal(size=rng.randint(1, 3000)))
+        if k % 3 == 0:
+            y = y.astype(np.float32)
+        if k % 5 == 0:
+            y = np.round(y)
+        yield y
+    x = np.linspace(0, 1, 9000)
+    yield np.sin(100 * x) * (x > 0.2) * (x < 0.6) - 0.08 + rng.normal(0, 1e-4, x.size)
+
+options = [dict(P_low=0.75, P_high=0.5),
+           dict(both=True),
+           dict(min_high_ratio=0.9, P_low=0.3, P_high=0.7, both=True)]
+
+@pytest.mark.parametrize("kwargs", options)
+def test_same_as_loop(kwargs):
+    for y in traces():
+        np.testing.assert_array_equal(detect.detect_peaks(y, **kwargs),
+                                      detect.detect_peaks_loop(y, **kwargs))
+
+@pytest.mark.parametrize("kwargs", options)
+def test_chunks(kwargs):
+    rng = np.random.RandomState(2)
+    for y in traces():
+        threshold = y.max() * kwargs.get('min_high_ratio', 0.25)
+        if not (y > threshold).any():
+            continue
+        detector = detect.PeakDetector(threshold,
+                                       P_low=kwargs.get('P_low', 0.5),
+                                       P_high=kwargs.get('P_high', 0.5),
+                                       both=kwargs.get('both', False))
+        parts = np.split(y, np.sort(rng.randint(0, y.size, 5)))
+        peaks = np.concatenate([detector.feed(part) for part in parts])
+        np.testing.assert_array_equal(peaks, detect.detect_peaks_loop(y, **kwargs))
@@ -0,0 +1,85 @@
+import time
+import concurrent.futures
+
+import pytest
+
+from ajustador import executors
+
+def square(x):
+    if x < 0:
+        raise ValueError(x)
+    return x * x
+
+def sleep(t):
+    time.sleep(t)
+    return t
+
+def make(cls, **kwargs):
+    if cls is executors.SerialExecutor:
+        return cls(**kwargs)
+    return cls(workers=2, **kwargs)
+
+classes = [executors.SerialExecutor,
+           executors.ThreadExecutor,
+           executors.ProcessExecutor,
+           executors.FarmExecutor]
+
+@pytest.mark.parametrize("cls", classes, ids=[c.__name__ for c in classes])
+def test_map(cls):
+    with make(cls, queue_depth=3) as ex:
+        assert ex.wait(ex.map(square, range(7))) == [x * x for x in range(7)]
+
+        with pytest.raises(Exception):
+            ex.wait(ex.map(square, [1, -1]))
+
+@pytest.mark.parametrize("cls", classes[1:], ids=[c.__name__ for c in classes[1:]])
+def test_timeout(cls):
+    ex = make(cls, timeout=0.2)
+    try:
+        with pytest.raises(concurrent.futures.TimeoutError):
+            ex.wait(ex.map(sleep, [0.01, 1, 0.01, 0.01]))
+    finally:
+        ex.shutdown()
+
+@pytest.mark.parametrize("cls", classes[1:], ids=[c.__name__ for c in classes[1:]])
+def test_timeout_counts_from_start(cls):
+    # every task fits in the timeout, but the last ones wait longer than
+    # that for a free worker
+    with make(cls, timeout=0.5) as ex:
+        assert ex.wait(ex.map(sleep, [0.3] * 6)) == [0.3] * 6
+
+@pytest.mark.parametrize("cls", [executors.ProcessExecutor, executors.FarmExecutor],
+                         ids=['ProcessExecutor', 'FarmExecutor'])
+def test_shutdown_abandoned(cls):
+    ex = make(cls, timeout=0.2)
+    futures = ex.map(sleep, [30, 0.01])
+    with pytest.raises(concurrent.futures.TimeoutError):
+        ex.wait(futures)
+    assert futures[0].abandoned
+    start = time.time()
+    ex.shutdown()
+    assert time.time() - start < 10
+
+def test_persistent_needs_processes():
+    from ajustador import optimize
+    old = optimize._exe
+    optimize._exe = make(executors.ThreadExecutor)
+    try:
+        with pytest.raises(ValueError, match='ThreadExecutor'):
+            optimize.MooseSimulation.make(dir=None, model=None, measurement=None,
+                                          params=None, persistent=True)
+    finally:
+        optimize._exe.shutdown()
+        optimize._exe = old
+
+def touch(path):
+    open(path, 'w').close()
+
+def test_farm_cancel(tmpdir):
+    with executors.FarmExecutor(workers=1) as ex:
+        first = ex.submit(sleep, 0.5)
+        paths = [str(tmpdir.join(str(i))) for i in range(3)]
+        futures = ex.map(touch, paths)
+        assert all(f.cancel() for f in futures)
+        assert ex.wait([first, ex.submit(sleep, 0)]) == [0.5, 0]
+    assert tmpdir.listdir() == []
@@ -0,0 +1,185 @@
+import numpy as np
+from scipy import optimize
+
+from ajustador import features, loader, vartype
+from ajustador.signal_smooth import smooth
+
+def spiking_wave(rate, dtype, dt=1e-4, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.arange(0, 0.9, dt)
+    y = -0.08 + rng.normal(0, 5e-4, x.size)
+    for t in np.arange(0.2, 0.6, 1 / rate):
+        y += 0.11 * np.exp(-((x - t) / 3e-4)**2)
+    return np.rec.fromarrays((x, y.astype(dtype)), names='x,y')
+
+def thresholds_loop(wave, peaks, max_charge_time=0.004, charge_threshold=0.02):
+    thresholds = np.empty(peaks.size)
+    for i in range(len(peaks)):
+        start = (wave.x >= wave.x[peaks[i]] - max_charge_time).argmax()
+        y = wave.y[start:peaks[i] + 1]
+        yderiv = np.diff(y)
+        try:
+            ythresh = charge_threshold * yderiv.max()
+            thresholds[i] = y[1:][yderiv > ythresh].min()
+        except Exception:
+            thresholds[i] = np.nan
+    return thresholds
+
+def test_spike_thresholds():
+    for rate in (5, 50, 400):
+        for dtype in (np.float32, np.float64):
+            wave = spiking_wave(rate, dtype)
+            peaks, thresholds = features._find_spikes(wave)
+            assert peaks.size > 0
+            np.testing.assert_array_equal(thresholds, thresholds_loop(wave, peaks))
+
+    # a peak at the very start has no derivative window
+    wave = spiking_wave(50, np.float64)
+    peaks = np.array([0, 1, 2500])
+    np.testing.assert_array_equal(
+        features._spike_thresholds(wave, peaks, 0.004, 0.02),
+        thresholds_loop(wave, peaks))
+
+def bounds_loop(y, peaks, halfheight):
+    ans = []
+    for i, k in enumerate(peaks):
+        beg = end = k
+        while beg > 1 and y[beg - 1] > halfheight[i]:
+            beg -= 1
+        while end + 2 < y.size and y[end + 1] > halfheight[i]:
+            end += 1
+        ans.append((beg, end))
+    return ans
+
+class params:
+    requires = ()
+    provides = ('baseline_before', 'baseline_after',
+                'steady_after', 'steady_before', 'steady_cutoff',
+                'injection_start', 'injection_end', 'injection_interval',
+                'falling_curve_window')
+    baseline_before, baseline_after = 0.2, 0.6
+    steady_after, steady_before, steady_cutoff = 0.25, 0.6, 80
+    injection_start, injection_end, injection_interval = 0.2, 0.6, 0.4
+    falling_curve_window = 20
+    def __init__(self, obj):
+        pass
+
+def test_spike_bounds():
+    for rate in (5, 50, 400):
+        wave = spiking_wave(rate, np.float32)
+        trace = loader.Trace(1e-10, wave.x, wave.y, [params, features.Spikes, features.AHP])
+        halfheight = (trace.spikes.y - trace.spike_threshold) / 2 + trace.spike_threshold
+        expected = bounds_loop(wave.y, trace.spike_i, halfheight)
+        assert list(zip(*trace.spike_bounds_i)) == expected
+        assert [(b.left_i, b.right_i) for b in trace.spike_bounds] == expected
+        np.testing.assert_array_equal(trace.spike_width,
+                                      [b.width for b in trace.spike_bounds])
+        assert len(trace.spike_ahp_window) == len(trace.spike_ahp) == trace.spike_count
+
+def falling_curve_loop(wave, window=20, after=0.2, before=0.6):
+    d = vartype.array_diff(wave)
+    dd = smooth(d.y, window='hanning', window_len=window)[(d.x > after) & (d.x < before)]
+    end = dd.argmin() + (d.x <= after).sum()
+    sm = smooth(wave.y, window='hanning', window_len=window)
+    smallest = sm[end]
+    while (end+window < wave.size and wave[end+window].x < before
+           and sm[end:end + window].min() < smallest):
+        smallest = sm[end]
+        end += window // 2
+    start_override = (d.x > after).argmax()
+    return wave[start_override + 1 : end]
+
+class falling_params(params):
+    provides = params.provides + ('steady_before', 'falling_curve_window')
+    steady_before = 0.6
+    falling_curve_window = 20
+
+def test_falling_curve():
+    rng = np.random.RandomState(0)
+    x = np.arange(0, 0.9, 1e-4)
+    inside = (x > 0.2) & (x < 0.6)
+    for sag in (0, 0.005, 0.02):
+        for noise in (1e-5, 5e-4):
+            for window in (5, 20, 41):
+                t = np.where(inside, x - 0.2, 0)
+                y = (-0.08 - 0.02 * (1 - np.exp(-t / 0.003)) + sag * (1 - np.exp(-t / 0.05))
+                     + rng.normal(0, noise, x.size)).astype(np.float32)
+                p = type('p', (falling_params,), dict(falling_curve_window=window))
+                trace = loader.Trace(-1e-10, x, y, [p, features.SmoothedWave])
+                feature = features.FallingCurve(trace)
+                expected = falling_curve_loop(trace.wave, window, 0.2, 0.6)
+                np.testing.assert_array_equal(feature.falling_curve, expected)
+
+def test_percentiles():
+    rng = np.random.RandomState(0)
+    for n in (1, 2, 7, 100, 2001):
+        for dtype in (np.float32, np.float64):
+            data = rng.normal(-0.08, 1e-3, n).astype(dtype)
+            for q in ((40, 60), (80,), (0, 100), (12.5, 33.3, 99.9)):
+                expected = np.percentile(data, q)
+                got = features._percentiles(data, q)
+                assert got.dtype == expected.dtype
+                np.testing.assert_array_equal(got, expected)
+
+    assert np.isnan(features._percentiles(np.array([1, np.nan, 2]), (40, 60))).all()
+
+def test_trimmed_mean_rows():
+    rng = np.random.RandomState(0)
+    for n in (2, 7, 100, 2001):
+        data = rng.normal(-0.08, 1e-3, (5, n))
+        data[3, 1] = np.nan
+        np.testing.assert_array_equal(features._percentiles(data, (40, 60)),
+                                      [features._percentiles(row, (40, 60)) for row in data])
+        for rows, expected in ((features._trimmed_mean(data, 40, 60),
+                                [features._trimmed_mean(row, 40, 60) for row in data]),
+                               (features._cut_mean(data, 80),
+                                [features._cut_mean(row, 80) for row in data])):
+            for got, exp in zip(rows, expected):
+                np.testing.assert_array_equal([got.x, got.dev], [exp.x, exp.dev])
+
+def test_steady_regions():
+    x = np.linspace(0, 0.9, 9001)
+    regions = features._steady_regions(x, 0.2, 0.6, 0.5, 0.6)
+    np.testing.assert_array_equal(np.arange(x.size)[regions.pre], np.flatnonzero(x < 0.2))
+    np.testing.assert_array_equal(np.arange(x.size)[regions.post], np.flatnonzero(x > 0.6))
+    np.testing.assert_array_equal(np.arange(x.size)[regions.steady],
+                                  np.flatnonzero((x > 0.5) & (x < 0.6)))
+
+    regions = features._steady_regions(x, None, None, 0.5, 0.6)
+    assert x[regions.pre].size == x[regions.post].size == 0
+
+class Simulation(loader.Attributable):
+    pass
+
+def test_batch_matches_single_waves():
+    all_features = (params, *features.standard_features)
+    x = np.arange(0, 0.9, 1e-4)
+    step = np.where((x > 0.2) & (x < 0.6), 1 - np.exp(-(x - 0.2) / 0.01), 0)
+    def waves():
+        rng = np.random.RandomState(0)
+        return [loader.Trace(i, x, (-0.08 + step * i * 1e8
+                                    + rng.normal(0, 1e-4, x.size)).astype(np.float32),
+                             all_features)
+                for i in (-2e-10, -1e-10, -5e-11)]
+    sim, single = Simulation(all_features), waves()
+    sim.waves = np.array(waves(), dtype=object)
+    for attr in ('baseline', 'baseline_pre', 'steady', 'rectification', 'falling_curve_tau'):
+        batch = getattr(sim, attr)
+        assert not np.isnan(batch.x).any()
+        assert np.array_equal(batch.x, [getattr(wave, attr).x for wave in single])
+        assert np.array_equal(batch.dev, [getattr(wave, attr).dev for wave in single])
+
+def test_fit_negative_exp():
+    rng = np.random.RandomState(0)
+    x = 0.2 + np.arange(2000) * 1e-4
+    for amp, tau, p0 in ((-0.013, 0.0025, (-1, 1)), (0.028, 0.013, (.02, .02))):
+        y = features.negative_exp(x, amp, tau) + rng.normal(0, 2e-4, x.size)
+        expected, expected_cov = optimize.curve_fit(features.negative_exp, x, y, p0)
+        popt, pcov = features._fit_negative_exp(x, y, p0)
+        np.testing.assert_allclose(popt, expected, rtol=1e-5)
+        np.testing.assert_allclose(np.diag(pcov), np.diag(expected_cov), rtol=1e-3)
+
+    # no exponential to start from, curve_fit is used
+    y = np.zeros_like(x)
+    popt, pcov = features._fit_negative_exp(x, y, (.02, .02))
+    np.testing.assert_array_equal(popt, optimize.curve_fit(features.negative_exp, x, y, (.02, .02))[0])
@@ -0,0 +1,45 @@
+import numpy as np
+
+from ajustador.optimize import AjuParam, ParamSet, Fit
+
+TARGET = dict(RA=5.0, RM=1.5)
+
+class FakeSim:
+    "A simulation which is ready after a number of polls"
+    def __init__(self, params, polls):
+        self.params = params
+        self.polls = polls
+
+    def ready(self):
+        self.polls -= 1
+        return self.polls <= 0
+
+    def wait(self):
+        self.polls = 0
+
+def distance(sim, measurement, full=False):
+    return sum((sim.params[name].value - value)**2 for name, value in TARGET.items())
+
+def make_fit(tmpdir):
+    started = []
+    def make_simulation(params, **kwargs):
+        # every third candidate takes as long as several generations
+        started.append(FakeSim(params, 40 if len(started) % 3 == 0 else 2))
+        return started[-1]
+    params = ParamSet(AjuParam('RA', 2, min=1, max=10),
+                      AjuParam('RM', 3, min=0.5, max=4))
+    fit = Fit(str(tmpdir.join('fit')), None, None, None, distance, params,
+              feature_list=(), _make_simulation=make_simulation)
+    fit.generation_poll_interval = 0
+    return fit, started
+
+def test_async_fit_with_slow_candidates(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)       # cma writes its logs to outcmaes/
+    fit, started = make_fit(tmpdir)
+    fit.do_fit(40, sigma=0.5, popsize=8, asynchronous=True)
+    assert fit.optimizer.result.fbest < 1e-4
+    # the slow candidates are too old to be told, but kept in the history
+    assert len(fit._history) == len(started)
+    assert fit.optimizer.countevals < len(started)
+    assert all(fit.optimizer.countiter - generation <= fit.max_result_age
+               for point, generation, value in fit._untold)
@@ -0,0 +1,116 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from ajustador import fitnesses, loader
+from test_loader import all_features, make_sim
+
+class spiking:
+    def __init__(self, injection, x):
+        self.injection = injection
+        self.spikes = np.rec.fromarrays((np.asarray(x, dtype=float), np.zeros(len(x))), names='x,y')
+
+def test_measurement_profile():
+    waves = [spiking(1e-10, [0.21, 0.3, 0.4]), spiking(2e-10, [0.22, 0.25])]
+    measurement = make_sim(waves)
+    profile = fitnesses.MeasurementProfile(measurement)
+    assert fitnesses.measurement_profile(measurement) is profile
+    assert fitnesses.measurement_profile(make_sim(waves)) is None
+
+    spikes = profile.spikes(measurement)
+    for a, b in zip(spikes, fitnesses._spike_times(measurement)):
+        assert np.array_equal(a, b)
+    assert profile.spikes(measurement) is spikes
+
+    measurement.waves = np.array(waves[:1], dtype=object)
+    assert fitnesses.measurement_profile(measurement) is None
+
+def test_wave_histogram_sorted():
+    rng = np.random.RandomState(1)
+    x = np.arange(0, 0.9, 1e-4)
+    wave1 = np.rec.fromarrays((x, rng.normal(-0.06, 0.01, x.size)), names='x,y')
+    wave2 = np.rec.fromarrays((x, rng.normal(-0.05, 0.02, x.size).astype(np.float32)), names='x,y')
+    ref = fitnesses.WaveHistogram(wave1, wave2, 0.2, 0.6)
+    sorted_y2 = np.sort(ref.y2())
+    new = fitnesses.WaveHistogram(wave1, wave2, 0.2, 0.6, sorted_y2)
+    assert np.array_equal(new.bins(), ref.bins())
+    assert np.array_equal(new.diff(full=True), ref.diff(full=True))
+
+@pytest.mark.parametrize("counts2", [(3, 2), (2, 4), (0, 0), (3,)])
+def test_align_spike_times(counts2):
+    m1 = [spiking(1e-10, [0.21, 0.3, 0.4]), spiking(2e-10, [0.22, 0.25])]
+    m2 = [spiking(inj, np.linspace(0.2, 0.5, n)) for inj, n in zip((1e-10, 2e-10), counts2)]
+    ref1, ref2 = fitnesses._measurement_to_spikes(m1).align(fitnesses._measurement_to_spikes(m2), axis=0)
+    x1, x2 = fitnesses._align_spike_times(fitnesses._spike_times(m1), fitnesses._spike_times(m2), 0.4)
+    assert np.array_equal(x1, ref1['x'].fillna(0.4).values)
+    assert np.array_equal(x2, ref2['x'].fillna(0.4).values)
+
+    if sum(counts2):
+        doubled = fitnesses._spike_times(m1 + m1)
+        assert fitnesses._align_spike_times(doubled, fitnesses._spike_times(m2), 0.4) is None
+
+def test_join_injections():
+    a = np.array([2.2e-10, -5e-10, 0, 2.2e-10, 3.2e-10 + 5e-13, 4.2e-10])
+    b = np.array([0, 3.2e-10, -5e-10, 2.2e-10, 2.2e-10 + 2e-12, 2.2e-10, 0])
+    ref = np.where(np.abs(a[:, None] - b) < 1e-12)
+    i, j = fitnesses.join_injections(a, b)
+    assert np.array_equal(i, ref[0]) and np.array_equal(j, ref[1])
+    assert fitnesses.join_injections(a, b)[0] is i
+    assert fitnesses.join_injections(a[:0], b)[0].size == 0
+
+@pytest.mark.parametrize("error", list(fitnesses.ErrorCalc))
+def test_combined_fitness_batch(error):
+    x = np.arange(0, 0.9, 1e-4)
+    step = (x > 0.2) & (x < 0.6)
+    def sim(injections, offset, gain, seed):
+        rng = np.random.RandomState(seed)
+        return make_sim([loader.Trace(i, x, -0.08 + offset + step * i * gain
+                                      + rng.normal(0, 1e-4, x.size), all_features)
+                         for i in injections])
+
+    injections = [-2e-10, -1e-10, 5e-11]
+    measurement = sim(injections, 0, 1e8, 0)
+    sims = [sim(injections, 1e-3 * i, 1e8 * (1 + i / 10), i + 1) for i in range(3)]
+    sims.append(sim(injections[:2], 0, 1e8, 9))
+    def extra_fitness(sim, measurement, full=False, error=None):
+        return len(sim.waves)
+
+    f = fitnesses.combined_fitness('empty', error=error, response=1, response_variance=0.5,
+                                   baseline=2, spike_count=1, spike_width=1, rectification=0,
+                                   extra={extra_fitness: 0.1})
+    scores = f.batch(sims, measurement)
+    assert scores.shape == (4, 6)
+    for s, row, total in zip(sims, scores, f.batch(sims, measurement, full=False)):
+        assert np.array_equal(row, f(s, measurement, full=True))
+        assert total == f(s, measurement)
+
+def test_combined_fitness_remembers_terms():
+    calls = []
+    def counted_fitness(sim, measurement, full=False, error=None):
+        calls.append(sim)
+        return 2
+    class obj:
+        waves = np.array([], dtype=object)
+    sim, measurement = obj(), obj()
+    f = fitnesses.combined_fitness('empty', extra={counted_fitness: 0.5})
+    assert f.report(sim, measurement) == 'counted_fitness=0.5*2=1\ntotal: 1'
+    assert f(sim, measurement, full=True).tolist() == [1] and len(calls) == 1
+
+    sim.waves = np.array([], dtype=object)
+    f(sim, measurement)
+    f(sim, obj())
+    assert len(calls) == 3
+    del sim, calls[:]
+    assert len(f._terms) == 0
+
+    # batch only computes the values which are not remembered
+    counted_fitness.batch_values = lambda sims, measurement, error: calls.extend(sims) or \
+        np.full(len(sims), 2.0)
+    sim, other = obj(), obj()
+    f(sim, measurement)
+    assert f.batch([sim, other], measurement, full=False).tolist() == [1, 1]
+    assert calls == [sim, other]
+
+    f = pickle.loads(pickle.dumps(fitnesses.combined_fitness('simple_combined_fitness')))
+    assert len(f._terms) == 0
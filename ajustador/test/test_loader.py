@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from ajustador import features, fitnesses, loader
+
+class params:
+    requires = ()
+    provides = ('baseline_before', 'baseline_after',
+                'steady_after', 'steady_before', 'steady_cutoff',
+                'injection_start', 'injection_end', 'injection_interval',
+                'falling_curve_window')
+    baseline_before, baseline_after = 0.2, 0.6
+    steady_after, steady_before, steady_cutoff = 0.25, 0.6, 80
+    injection_start, injection_end, injection_interval = 0.2, 0.6, 0.4
+    falling_curve_window = 20
+    def __init__(self, obj):
+        pass
+
+all_features = (params, *features.standard_features)
+
+class Simulation(loader.Attributable):
+    pass
+
+def make_sim(waves):
+    "An Attributable holding waves, like a simulation or measurement"
+    sim = Simulation(all_features)
+    sim.waves = np.array(waves, dtype=object)
+    return sim
+
+def test_required_features():
+    assert loader.required_features(all_features, ['baseline_pre']) == [params, features.SteadyState]
+    assert loader.required_features(all_features, ['rectification']) == [
+        params, features.SteadyState, features.SmoothedWave,
+        features.FallingCurve, features.Rectification]
+    assert loader.required_features(all_features, ['wave']) == []
+    with pytest.raises(KeyError):
+        loader.required_features(all_features, ['no_such_attribute'])
+
+    with pytest.raises(ValueError):
+        loader.Trace(0, np.zeros(3), np.zeros(3), [features.SteadyState])
+
+def test_fitness_requires():
+    f = fitnesses.combined_fitness('empty', response=1, falling_curve_time=1, spike_count=0)
+    assert f.requires == {'response', 'falling_curve_tau'}
+    assert fitnesses.combined_fitness('empty', extra={lambda *args, **kwargs: 0: 1}).requires is None
+
+def test_lazy_features():
+    x = np.arange(0, 0.9, 1e-4)
+    y = np.where((x > 0.2) & (x < 0.6), -0.09, -0.08) + np.random.RandomState(0).normal(0, 1e-4, x.size)
+    trace = loader.Trace(-1e-10, x, y, all_features)
+    assert trace.baseline_pre.x == pytest.approx(-0.08, abs=1e-4)
+    instantiated = {type(f) for f in trace._attributes.values() if not isinstance(f, type)}
+    assert instantiated == {params, features.SteadyState, loader.Trace}
+
+def test_feature_times():
+    x = np.arange(0, 0.9, 1e-4)
+    sim = make_sim([loader.Trace(i * 1e-10, x, np.full(x.size, -0.08), all_features)
+                    for i in range(3)])
+    times = loader.feature_times(sim, ['baseline_pre', 'spike_count'])
+    assert list(times) == ['params', 'SteadyState', 'Spikes']
+    assert all(t >= 0 for t in times.values())
+
+def test_wave():
+    timebase = loader.Timebase(0, 0.9, 9000)
+    assert np.array_equal(timebase.x, np.linspace(0, 0.9, 9000))
+    assert timebase.x is loader.Timebase(0.0, 0.9, 9000).x
+    assert timebase.dt == pytest.approx(1e-4, rel=1e-3)
+    assert np.array_equal(loader.Timebase(0, 0.9, 9000, endpoint=False).x,
+                          np.linspace(0, 0.9, 9000, endpoint=False))
+
+    y = np.random.RandomState(0).normal(-0.08, 1e-3, 9000)
+    wave = loader.Wave(timebase, y)
+    assert wave.y is y and wave.nbytes == y.nbytes
+    rec = np.rec.fromarrays((timebase.x, y), names='x,y')
+    for index in (slice(10, 20), slice(None, None, -3), np.arange(5), y > -0.078):
+        part = wave[index]
+        assert isinstance(part, np.recarray)
+        assert np.array_equal(part.x, rec[index].x) and np.array_equal(part.y, rec[index].y)
+    assert wave[-1].x == rec[-1].x and wave[3].y == rec[3].y
+    with pytest.raises(IndexError):
+        wave[9000]
+    with pytest.raises(ValueError):
+        loader.Wave(timebase, y[1:])
+
+    trace = loader.IVCurve(None, None, 1e-10, timebase, y, all_features, dtype=np.float32)
+    assert trace.wave.y.dtype == np.float32 and trace.time == 0.9
+    trace.simulation_time = 1.5
+    with pytest.raises(AttributeError):
+        trace.no_such_attribute = 1
+
+def test_aggregated_views():
+    x = np.arange(0, 0.9, 1e-4)
+    sim = make_sim([loader.Trace(i * 1e-10, x, np.full(x.size, -0.08 + i * 1e-3), all_features)
+                    for i in range(-2, 3)])
+
+    baseline = sim.baseline
+    assert baseline.x == pytest.approx([-0.082, -0.081, -0.08, -0.079, -0.078])
+    with pytest.raises(ValueError):
+        sim.baseline.x[0] = 0
+    with pytest.raises(ValueError):
+        sim.injection[0] = 0
+
+    hyper = sim[sim.injection < 0]
+    assert sim[sim.injection < 0] is hyper
+    assert hyper._aggregated.parent[0] is sim._aggregated
+    assert np.array_equal(hyper.baseline.x, baseline.x[:2])
+    assert np.array_equal(hyper[[1]].injection, [-1e-10])
+
+    sim.waves = sim.waves[::-1]
+    assert sim.baseline.x[0] == baseline.x[-1]
+    assert sim[sim.injection < 0] is not hyper
+
+    for i in range(loader.MAX_VIEWS + 1):
+        sim[[i % 5, (i // 5) % 5]]
+    assert len(sim._aggregated.views) == loader.MAX_VIEWS
@@ -0,0 +1,26 @@
+import numpy as np
+
+from ajustador.optimize import AjuParam, ParamSet
+
+def make_params():
+    return ParamSet(AjuParam('junction_potential', -0.013, fixed=1),
+                    AjuParam('RA', 4, min=1, max=200),
+                    AjuParam('Eleak', -0.056, min=-0.080, max=-0.030),
+                    AjuParam('Cond_Kir', 9.5, min=0, max=20),
+                    AjuParam('Cond_NaF_0', 1e5, min=1e3, max=1e6),
+                    AjuParam('Cond_KaS_0', 100, constant=2, fixed='Cond_Kir'))
+
+def test_unscale_matches_params():
+    params = make_params()
+    population = np.random.RandomState(0).uniform(0, 10, size=(20, len(params.ajuparams)))
+    unscaled = params.unscale_array(population)
+    for row, values in zip(population, unscaled):
+        expected = [p.unscale(v) for p, v in zip(params.ajuparams, row)]
+        assert values.tolist() == expected
+        assert params.unscale(row) == expected
+        np.testing.assert_allclose(params.scale(expected), row)
+
+    dicts = params.unscaled_dicts(population)
+    assert dicts[3] == params.unscaled_dict(population[3])
+    assert dicts[3]['Cond_KaS_0'] == 2 * dicts[3]['Cond_Kir']
+    assert dicts[3]['junction_potential'] == -0.013
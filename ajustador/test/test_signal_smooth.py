@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from ajustador.signal_smooth import smooth, smooth_range, window_kernel
+
+def smooth_whole(x, window_len, window):
+    s = np.r_[x[window_len-1:0:-1], x, x[-1:-window_len:-1]]
+    w = np.ones(window_len) if window == 'flat' else getattr(np, window)(window_len)
+    y = np.convolve(w/w.sum(), s, mode='valid')
+    return y[window_len // 2 - 1 : -window_len//2]
+
+@pytest.mark.parametrize("window", ['flat', 'hanning', 'hamming', 'bartlett', 'blackman'])
+def test_smooth_range(window):
+    rng = np.random.RandomState(0)
+    for window_len in (3, 4, 11, 20):
+        for dtype in (np.float32, np.float64):
+            x = rng.normal(size=500).astype(dtype)
+            expected = smooth_whole(x, window_len, window)
+            np.testing.assert_array_equal(smooth(x, window_len, window), expected)
+            for start, stop in ((0, 500), (0, 1), (499, 500), (3, 40), (250, 260), (470, 500)):
+                np.testing.assert_array_equal(smooth_range(x, start, stop, window_len, window),
+                                              expected[start:stop])
+            assert smooth_range(x, 10, 10, window_len, window).size == 0
+
+def test_window_kernel():
+    assert window_kernel(20, 'hanning') is window_kernel(20, 'hanning')
+    with pytest.raises(ValueError):
+        window_kernel(20, 'triangle')
@@ -0,0 +1,54 @@
+import json
+import os
+import time
+
+from ajustador.optimize import AjuParam, ParamSet, SimulationResults, MANIFEST
+
+class FakeResult:
+    def __init__(self, dirname, features, params=None, simtime=None):
+        self.name = os.path.basename(dirname)
+        self.params = params
+
+def make_dir(tmpdir, name):
+    dir = tmpdir.mkdir(name)
+    dir.join('params.pickle').write('')
+    dir.join('.complete').write('')
+    time.sleep(0.01)            # the glob is sorted by mtime
+
+def append(tmpdir, name, RA):
+    with open(str(tmpdir.join(MANIFEST)), 'a') as f:
+        f.write(json.dumps(dict(dir=name, params=dict(RA=RA), fitness=RA)) + '\n')
+
+def names(results, last=None):
+    return [sim.name for i, n, sim in results.load(last=last)]
+
+def test_manifest_last(tmpdir):
+    results = SimulationResults(str(tmpdir), (), constructor=FakeResult,
+                                params=ParamSet(AjuParam('RA', 4, min=1, max=200)))
+    for i in range(5):
+        make_dir(tmpdir, 'sim{}'.format(i))
+        append(tmpdir, 'sim{}'.format(i), i + 1)
+
+    assert names(results, last=2) == ['sim3', 'sim4']
+    # the skipped entries are loaded later
+    assert names(results, last=2) == ['sim1', 'sim2']
+    make_dir(tmpdir, 'sim5')
+    append(tmpdir, 'sim5', 6)
+    assert names(results) == ['sim0', 'sim5']
+    assert names(results) == []
+
+def test_manifest_and_unlisted_dirs(tmpdir):
+    results = SimulationResults(str(tmpdir), (), constructor=FakeResult,
+                                params=ParamSet(AjuParam('RA', 4, min=1, max=200)))
+    make_dir(tmpdir, 'old')
+    make_dir(tmpdir, 'sim0')
+    append(tmpdir, 'sim0', 1)
+    make_dir(tmpdir, 'sim1')     # not in the manifest yet
+
+    sims = {sim.name: sim for i, n, sim in results.load()}
+    assert sorted(sims) == ['old', 'sim0', 'sim1']
+    assert sims['sim0'].params['RA'].value == 1
+    assert sims['old'].params is None
+
+    append(tmpdir, 'sim1', 2)
+    assert names(results) == []
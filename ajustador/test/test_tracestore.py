@@ -0,0 +1,32 @@
+import multiprocessing
+
+import numpy as np
+
+from ajustador import tracestore
+
+def append(args):
+    filename, key = args
+    store = tracestore.TraceStore(filename)
+    for injection in (-1e-10, 2e-10):
+        store.append(key, injection, np.full(1000, injection))
+
+def test_append_get(tmpdir):
+    filename = str(tmpdir.join('traces.dat'))
+    keys = ['sim{}'.format(i) for i in range(8)]
+    with multiprocessing.Pool(4) as pool:
+        pool.map(append, [(filename, key) for key in keys])
+
+    store = tracestore.TraceStore(filename)
+    assert sorted(store.keys()) == keys
+    assert store.injections('sim3') == [-1e-10, 2e-10]
+    y = store.get('sim3', 2e-10)
+    assert y.size == 1000
+    assert (y == 2e-10).all()
+    assert not y.flags.owndata
+    assert 'sim9' not in store
+
+    store2 = tracestore.TraceStore(filename)
+    store2.get('sim0', -1e-10)
+    store2.append('sim9', 0.0, np.arange(5.))
+    np.testing.assert_array_equal(store2.get('sim9', 0.0), np.arange(5.))
+    assert 'sim9' in store
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from ajustador.vartype import vartype, vararray, array_rms, array_sub
+
+def test_vararray_matches_vartype():
+    items = [vartype(x, 0.1 + x/10) for x in np.linspace(-2, 2, 6)]
+    other = [vartype(x, 0.3) for x in np.linspace(1, 4, 6)]
+    X, Y = vartype.array(items), vartype.array(other)
+    assert isinstance(X, vararray) and len(X) == 6
+
+    for a, b, c in zip(X + Y, items, other):
+        d = b + c
+        assert (a.x, a.dev) == pytest.approx((d.x, d.dev))
+    for a, b, c in zip(X * Y, items, other):
+        d = b * c
+        assert (a.x, a.dev) == pytest.approx((d.x, d.dev))
+    for a, b in zip(X / 4, items):
+        d = b / 4
+        assert (a.x, a.dev) == pytest.approx((d.x, d.dev))
+
+    # first order propagation, checked on the relative uncertainties
+    Q = X / Y
+    assert Q.dev == pytest.approx(abs(Q.x) * ((X.dev/X.x)**2 + (Y.dev/Y.x)**2)**0.5)
+    P = X ** 3
+    assert P.dev == pytest.approx(3 * X.dev * X.x**2)
+
+    assert vartype.average(X).x == pytest.approx(vartype.average(X.to_records()).x)
+    assert vararray([], []).average() is vartype.nan
+    assert array_rms(array_sub(X, Y)) == array_rms(array_sub(X.to_records(), Y.to_records()))
+
+def test_vararray_indexing():
+    X = vararray([1., np.nan, 3.], [0.1, np.nan, 0.3])
+    assert isinstance(X[0], vartype) and X[-1].dev == 0.3
+    assert isinstance(X[1:], vararray) and X[X.x > 2].x.tolist() == [3.]
+    assert X.isnan.tolist() == [False, True, False]
+    assert (np.arange(3) + X).x.tolist()[::2] == [1, 5]
+    assert vararray.concatenate([X, X.to_records()]).size == 6
+    assert np.isnan(vararray.from_items([vartype(1, 2), 3]).dev[1])
+
+def test_vararray_record_compatibility():
+    X = vararray([1., -2., 3.], [0.1, 0.2, 0.2])
+    assert X['x'] is X.x and X['dev'] is X.dev
+    assert X.dev.flags.writeable and vararray([1., 2.], 0.1).dev.flags.writeable
+    assert np.abs(X).x.tolist() == [1, 2, 3] and np.abs(X).dev is X.dev
+    assert np.negative(X).x.tolist() == (-X).x.tolist()
+    for Y in (np.ones(3) + X, np.float64(2) * X, np.ones(3) - X, np.ones(3) / X):
+        assert isinstance(Y, vararray)
+    assert (np.ones(3) < X).tolist() == [False, False, True]
+    with pytest.raises(TypeError, match='numpy.exp is not supported'):
+        np.exp(X)
+    with pytest.raises(KeyError):
+        X['y']
@@ -0,0 +1,111 @@
+"""A single append-only file holding the voltage traces of a whole fit
+
+Normally every simulated injection current is saved in its own
+``ivdata-*.npy`` file, in a separate directory for each evaluation.
+A :class:`TraceStore` instead appends the raw samples to one data file
+and records where each trace starts in an index next to it
+(``<filename>.index``, one JSON object per line). Traces are read back
+as views into a memory map of the data file, without copying.
+
+Many processes may append to the same store at the same time, writes
+are serialized with a lock on the index file.
+
+>>> store = TraceStore('fit/traces.dat')
+>>> store.append('tmpabc123', -1e-10, vm)
+>>> store.get('tmpabc123', -1e-10)
+memmap([...])
+"""
+
+import fcntl
+import json
+import os
+
+import numpy as np
+
+class TraceStore:
+    dtype = np.dtype(np.float64)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + '.index'
+        self._entries = {}
+        self._index_offset = 0
+        self._data = None
+
+    def append(self, key, injection, y):
+        "Add trace y for (key, injection) and return its offset in samples"
+        y = np.ascontiguousarray(y, dtype=self.dtype)
+        with open(self.index_filename, 'a') as index:
+            fcntl.flock(index, fcntl.LOCK_EX)
+            try:
+                with open(self.filename, 'ab') as data:
+                    offset = data.tell() // self.dtype.itemsize
+                    data.write(y.tobytes())
+                entry = dict(key=key, injection=float(injection),
+                             offset=offset, size=y.size)
+                index.write(json.dumps(entry) + '\n')
+                index.flush()
+            finally:
+                fcntl.flock(index, fcntl.LOCK_UN)
+        return offset
+
+    def _refresh(self):
+        "Read index entries written since the last call and remap the data"
+        if not os.path.exists(self.index_filename):
+            return
+        with open(self.index_filename, 'rb') as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                entry = json.loads(line.decode())
+                traces = self._entries.setdefault(entry['key'], {})
+                traces[entry['injection']] = entry['offset'], entry['size']
+                self._index_offset += len(line)
+        size = os.path.getsize(self.filename) // self.dtype.itemsize
+        if size and (self._data is None or self._data.size < size):
+            self._data = np.memmap(self.filename, dtype=self.dtype, mode='r', shape=(size,))
+
+    def _traces(self, key):
+        if key not in self._entries:
+            self._refresh()
+        return self._entries[key]
+
+    def __contains__(self, key):
+        try:
+            self._traces(key)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        self._refresh()
+        return len(self._entries)
+
+    def keys(self):
+        self._refresh()
+        return self._entries.keys()
+
+    def injections(self, key):
+        "The injection currents stored for key, sorted"
+        return sorted(self._traces(key))
+
+    def get(self, key, injection):
+        "A read-only view of the trace for (key, injection)"
+        traces = self._traces(key)
+        if injection not in traces:
+            self._refresh()
+        offset, size = traces[injection]
+        if self._data is None or self._data.size < offset + size:
+            self._refresh()
+        return self._data[offset:offset + size]
+
+_stores = {}
+
+def open_store(filename):
+    "Return a TraceStore for filename, shared by all callers in this process"
+    filename = os.path.abspath(filename)
+    try:
+        return _stores[filename]
+    except KeyError:
+        return _stores.setdefault(filename, TraceStore(filename))
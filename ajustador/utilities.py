@@ -31,6 +31,15 @@ def once(function):
         return val
     return functools.update_wrapper(wrapper, function)
 
+def set_once(obj, name, value):
+    """Provide the value of the once-decorated property name of obj
+
+    Does nothing if the property was already computed.
+    """
+    attr = '_{}_value'.format(name)
+    if not hasattr(obj, attr):
+        setattr(obj, attr, value)
+
 
 def cached(function):
     "A decorator to store the return values of a function in a cache"
@@ -117,51 +117,277 @@ class vartype(object):
 
         >>> items = [vartype(x, 1 + x/10) for x in range(5)]
         >>> X = vartype.array(items)
-        >>> print(X)
-        rec.array([(0, 1.0), (1, 1.1), (2, 1.2), (3, 1.3), (4, 1.4)],
-                  dtype=[('x', '<i8'), ('dev', '<f8')])
         >>> vartype.average(X)
         vartype(1.66, 0.53)
         """
         if len(vect) == 0:
             return cls(np.nan, np.nan)
+        elif isinstance(vect, vararray):
+            return vect.average()
         elif isinstance(vect[0], numbers.Number):
             return array_mean(vect)
         else:
-            sq = vect.dev**-2
-            var = 1 / sq.sum()
-            x = (vect.x * sq * var).sum()
-            return cls(x, var**0.5)
+            return _weighted_average(vect.x, vect.dev)
 
     @classmethod
     def array(cls, items):
         """Create an array of vartypes
 
-        The array is a numpy structured array with .x and .dev attributes.
+        Items without an uncertainty (plain numbers) get a dev of nan.
 
         >>> items = [vartype(x, 1 + x/10) for x in range(5)]
         >>> X = vartype.array(items)
         >>> X
-        rec.array([(0, 1.0), (1, 1.1), (2, 1.2), (3, 1.3), (4, 1.4)],
-                  dtype=[('x', '<i8'), ('dev', '<f8')])
+        vararray([0, 1, 2, 3, 4], [1.0, 1.1, 1.2, 1.3, 1.4])
         >>> X.x
         array([0, 1, 2, 3, 4])
         >>> X.dev
         array([ 1. ,  1.1,  1.2,  1.3,  1.4])
         """
-        x = np.array([getattr(p, 'x', p) for p in items])
-        dev = np.array([getattr(p, 'dev', np.nan) for p in items])
-        return np.rec.fromarrays((x, dev), names='x,dev')
+        return vararray.from_items(items)
 
     @classmethod
     def format_array(cls, array, prefix=''):
-        prec = max(cls(*x)._prec() for x in array)
-        gen = ('{0:.{2}f}±{1:.{2}f}'.format(*x, prec) for x in array)
+        pairs = list(zip(array.x, array.dev))
+        prec = max(cls(*x)._prec() for x in pairs)
+        gen = ('{0:.{2}f}±{1:.{2}f}'.format(*x, prec) for x in pairs)
         joiner = '\n' + ' ' * len(prefix)
         return prefix + joiner.join(gen)
 
 vartype.nan = vartype(np.nan, np.nan)
 
+def _weighted_average(x, dev):
+    sq = dev**-2
+    var = 1 / sq.sum()
+    return vartype((x * sq * var).sum(), var**0.5)
+
+def _x_dev(other):
+    "Split other into values and uncertainties (None for plain numbers)"
+    if isinstance(other, (vartype, vararray)):
+        return other.x, other.dev
+    names = getattr(getattr(other, 'dtype', None), 'names', None)
+    if names is not None and 'dev' in names:
+        return other['x'], other['dev']
+    return other, None
+
+class vararray(object):
+    """An array of numbers with uncertainties, stored as two numpy arrays
+
+    This is the vectorized counterpart of :class:`vartype`. x and dev
+    are arrays of the same shape. Indexing with an integer gives a
+    vartype, anything else gives a vararray. Missing values are nan in
+    both x and dev, like vartype.nan.
+
+    The other operand of + - * / can be a vararray, a vartype, a record
+    array with x and dev fields, a number or an array. Uncertainties of
+    independent operands are combined to first order, as vartype does
+    for two vartypes. Plain numbers have no uncertainty, so they do not
+    change dev when added, and scale it by their absolute value when
+    multiplied. This differs from vartype, which adds the number to dev.
+
+    >>> X = vararray([1., 2., 3.], [0.1, 0.2, 0.2])
+    >>> X - vartype(1, 0.2)
+    vararray([0.00, 1.00, 2.00], [0.22, 0.28, 0.28])
+    >>> X ** 2
+    vararray([1.00, 4.00, 9.00], [0.20, 0.80, 1.20])
+    >>> X[1]
+    vartype(2.00, 0.20)
+    >>> X.average()
+    vartype(1.500, 0.082)
+
+    Like the record arrays which were used before, X['x'] and X['dev']
+    give the fields, and np.abs, np.negative and the numpy ufuncs of the
+    operators above work. Other ufuncs raise TypeError.
+    """
+    __slots__ = ('x', 'dev')
+
+    def __init__(self, x, dev=None):
+        self.x = np.asarray(x)
+        if dev is None:
+            self.dev = np.full(self.x.shape, np.nan)
+        else:
+            dev = np.asarray(dev, dtype=float)
+            if dev.shape != self.x.shape:
+                dev = np.broadcast_to(dev, self.x.shape).copy()
+            self.dev = dev
+
+    _ufuncs = {np.absolute: ('__abs__', None),
+               np.negative: ('__neg__', None),
+               np.positive: ('copy', None),
+               np.add: ('__add__', '__radd__'),
+               np.subtract: ('__sub__', '__rsub__'),
+               np.multiply: ('__mul__', '__rmul__'),
+               np.true_divide: ('__truediv__', '__rtruediv__'),
+               np.power: ('__pow__', None),
+               np.less: ('__lt__', '__gt__'),
+               np.greater: ('__gt__', '__lt__')}
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # numpy calls this for np.abs(X) and for array + X, so numbers
+        # and arrays on the left use our (reflected) operators
+        name, reflected = self._ufuncs.get(ufunc, (None, None))
+        if method == '__call__' and not kwargs and name is not None:
+            if len(inputs) == 1:
+                return getattr(inputs[0], name)()
+            if isinstance(inputs[0], vararray):
+                return getattr(inputs[0], name)(inputs[1])
+            if reflected is not None:
+                return getattr(inputs[1], reflected)(inputs[0])
+        if method != '__call__':
+            name = '{}.{}'.format(ufunc.__name__, method)
+        elif kwargs:
+            name = '{} with {}'.format(ufunc.__name__, ', '.join(kwargs))
+        else:
+            name = ufunc.__name__
+        raise TypeError('numpy.{} is not supported for vararray, use .x and .dev'.format(name))
+
+    @classmethod
+    def from_items(cls, items):
+        "Collect vartypes and plain numbers into a vararray"
+        items = list(items)
+        try:
+            x = [p.x for p in items]
+            dev = [p.dev for p in items]
+        except AttributeError:
+            x = [getattr(p, 'x', p) for p in items]
+            dev = [getattr(p, 'dev', np.nan) for p in items]
+        return cls(np.array(x), np.array(dev, dtype=float))
+
+    @classmethod
+    def concatenate(cls, arrays):
+        "Join vararrays and record arrays with x and dev fields"
+        parts = [_x_dev(a) for a in arrays]
+        return cls(np.concatenate([x for x, dev in parts]),
+                   np.concatenate([dev for x, dev in parts]))
+
+    @property
+    def shape(self):
+        return self.x.shape
+
+    @property
+    def ndim(self):
+        return self.x.ndim
+
+    @property
+    def size(self):
+        return self.x.size
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        if isinstance(index, str):
+            # the fields of the record arrays used before
+            if index not in ('x', 'dev'):
+                raise KeyError(index)
+            return getattr(self, index)
+        x, dev = self.x[index], self.dev[index]
+        if np.ndim(x) == 0:
+            return vartype(x, dev)
+        return vararray(x, dev)
+
+    def __iter__(self):
+        return (vartype(x, dev) for x, dev in zip(self.x, self.dev))
+
+    def copy(self):
+        return vararray(self.x.copy(), self.dev.copy())
+
+    def to_records(self):
+        "The same values as a record array with x and dev fields"
+        return np.rec.fromarrays((self.x, self.dev), names='x,dev')
+
+    @property
+    def isnan(self):
+        "Where x or dev is nan"
+        return np.isnan(self.x) | np.isnan(self.dev)
+
+    @property
+    def positive(self):
+        "Where the number is greater than 3σ"
+        return self.x > self.dev*3
+
+    @property
+    def negative(self):
+        "Where the number is smaller than -3σ"
+        return self.x < -self.dev*3
+
+    def __neg__(self):
+        return vararray(-self.x, self.dev)
+
+    def __abs__(self):
+        return vararray(abs(self.x), self.dev)
+
+    def __add__(self, other):
+        x, dev = _x_dev(other)
+        if dev is None:
+            return vararray(self.x + x, self.dev)
+        return vararray(self.x + x, (self.dev**2 + dev**2)**0.5)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        x, dev = _x_dev(other)
+        if dev is None:
+            return vararray(self.x - x, self.dev)
+        return vararray(self.x - x, (self.dev**2 + dev**2)**0.5)
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        x, dev = _x_dev(other)
+        if dev is None:
+            return vararray(self.x * x, self.dev * abs(x))
+        return vararray(self.x * x, (self.x**2*dev**2 + x**2*self.dev**2)**0.5)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        x, dev = _x_dev(other)
+        if dev is None:
+            return vararray(self.x / x, self.dev / abs(x))
+        q = self.x / x
+        return vararray(q, (self.dev**2 + q**2*dev**2)**0.5 / abs(x))
+
+    def __rtruediv__(self, other):
+        x, dev = _x_dev(other)
+        q = x / self.x
+        dev = 0 if dev is None else dev
+        return vararray(q, (dev**2 + q**2*self.dev**2)**0.5 / abs(self.x))
+
+    def __pow__(self, other):
+        return vararray(self.x**other,
+                        abs(other * self.x**(other - 1)) * self.dev)
+
+    def __lt__(self, other):
+        return self.x < getattr(other, 'x', other)
+
+    def __gt__(self, other):
+        return self.x > getattr(other, 'x', other)
+
+    def average(self):
+        """The weighted average, with weights 1/σ²
+
+        Returns vartype.nan for an empty array.
+        """
+        if self.x.size == 0:
+            return vartype.nan
+        return _weighted_average(self.x, self.dev)
+
+    def rms(self):
+        "The rms of x/σ, see :func:`array_rms`"
+        return ((self.x / self.dev)**2).mean()**0.5
+
+    def __repr__(self):
+        prec = max((vartype(x, dev)._prec() + 1 for x, dev in zip(self.x.flat, self.dev.flat)),
+                   default=0)
+        fmt = lambda a: '[{}]'.format(', '.join(
+            '{:.{}f}'.format(v, prec) if isinstance(v, float) else str(v) for v in a.tolist()))
+        return '{}({}, {})'.format(self.__class__.__name__, fmt(self.x), fmt(self.dev))
+
+    def __str__(self):
+        return vartype.format_array(self) if self.size else '[]'
+
 def array_mean(data):
     return vartype(data.mean(), data.var(ddof=1)**0.5)
 
@@ -175,9 +401,8 @@ def array_sub(reca, recb):
     The uncertainty is calculated in the usual way.
     """
     if len(reca) == len(recb) == 0:
-        return np.rec.fromarrays(([],[]), names='x,dev')
-    xy = (reca.x - recb.x, (reca.dev**2 + recb.dev**2)**0.5)
-    return np.rec.fromarrays(xy, names='x,dev')
+        return vararray(np.empty(0), np.empty(0))
+    return vararray(*_x_dev(reca)) - recb
 
 def array_rms(rec, nan_replacement=1.5):
     """Return the rms of an array
@@ -188,6 +413,8 @@ def array_rms(rec, nan_replacement=1.5):
     if isinstance(rec, vartype):
         return float(rec)
 
+    if isinstance(rec, vararray):
+        return rec.rms()
     if hasattr(rec, 'x'):
         return ((rec.x / rec.dev)**2).mean()**0.5
     else: